@@ -7,26 +7,163 @@ Created on Tue Mar 31 15:56:08 2020
 # this file will require the following package installation:
 # conda install -c conda-forge clickhouse-driver
 import os
-from dotenv import load_dotenv, find_dotenv
-from clickhouse_driver import Client
+import re
 import pandas as pd
 import logging
 import logging.config
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import time
+import threading
+from contextlib import contextmanager
 
 # in-house
 import utilities_timers
+import metrics
 
-# find .env automagically by walking up directories until it's found
-dotenv_path = find_dotenv()
-# load up the entries as environment variables
-load_dotenv(dotenv_path)
-usr = os.environ.get("CLICKHOUSE_USER")
-pwd = os.environ.get("CLICKHOUSE_PWD")
 apiname="Clickhouse::"
+# schema of candles tables. day is filled by server from time.
+# Candles keep only figi, attributes of instruments are in instruments table
+# and are read through instruments_dict, see create_instruments_table().
+# figi and interval are dictionary encoded (a few thousand distinct values),
+# times are regular steps (Delta), volumes use few of their 64 bits (T64).
+# Prices are on a grid of min_price_increment and compress best with plain ZSTD
+# (with Gorilla the table is 1.8x bigger, see benchmarks.benchmark_schema()).
+# Tables created before are moved to this schema by migrate_to_replacing_merge_tree().
+candles_columns = (
+    "day Date DEFAULT toDate(time) CODEC(Delta, ZSTD(1)), "
+    "figi LowCardinality(String), "
+    "interval LowCardinality(String), "
+    "o Float64 CODEC(ZSTD(1)), "
+    "c Float64 CODEC(ZSTD(1)), "
+    "h Float64 CODEC(ZSTD(1)), "
+    "l Float64 CODEC(ZSTD(1)), "
+    "v Int64 CODEC(T64, ZSTD(1)), "
+    "time DateTime CODEC(Delta, ZSTD(1))"
+)
+candles_output_columns = ["day", "figi", "interval", "o", "c", "h", "l", "v", "time"]
+instrument_columns = [
+    "ticker",
+    "isin",
+    "min_price_increment",
+    "lot",
+    "currency",
+    "name",
+    "type",
+]
+# dimension table of instruments, one row per figi. Row with the highest version wins.
+instruments_table = "instruments"
+instruments_dict = "instruments_dict"
+instruments_columns = (
+    "figi String, ticker String, "
+    "isin String, min_price_increment Float64, "
+    "lot Int64, currency LowCardinality(String), "
+    "name String, type LowCardinality(String), "
+    "version UInt64"
+)
+# defaults of dictionary attributes, returned for unknown FIGIs
+instruments_dict_columns = (
+    "figi String, ticker String DEFAULT '', "
+    "isin String DEFAULT '', min_price_increment Float64 DEFAULT 0, "
+    "lot Int64 DEFAULT 0, currency String DEFAULT '', "
+    "name String DEFAULT '', type String DEFAULT ''"
+)
+# order book snapshots of the stream (see stream_ingestor), one row per price level.
+# side is "bid" or "ask", level 0 is the best price.
+orderbooks_table = "orderbooks"
+orderbook_columns = (
+    "time DateTime64(3) CODEC(Delta, ZSTD(1)), "
+    "figi LowCardinality(String), "
+    "side LowCardinality(String), "
+    "level UInt8, "
+    "price Float64 CODEC(ZSTD(1)), "
+    "quantity Float64 CODEC(ZSTD(1))"
+)
+# seconds between reloads of instruments_dict, see upsert_instruments()
+instruments_dict_lifetime = (300, 600)
+# server side named collection with user and password of instruments_dict source,
+# see create_instruments_table()
+named_collection_variable = "CLICKHOUSE_NAMED_COLLECTION"
+# max rows per insert query, bounds client memory taken by one insert
+insert_chunk_size = 500000
+# default rows per dataframe yielded by streaming queries
+query_chunk_size = 100000
+# string columns returned as pandas categoricals by NumPy queries
+categorical_columns = ["figi", "interval", "ticker", "isin", "currency", "name", "type"]
+# pre-aggregated views of candles tables, see create_aggregate_views().
+# data_freq : (view name suffix, period column, period expression)
+aggregate_views = {
+    "hour": ("hourly", "hour", "toStartOfHour(time)"),
+    "day": ("daily", "day", "toDate(time)"),
+    "week": ("weekly", "monday", "toMonday(time)"),
+}
+# length of candles of every Tinkoff API interval. 1min candles are stored in
+# "minutes" table, candles of other intervals in their own tables, see interval_table().
+candle_intervals = {
+    "1min": timedelta(minutes=1),
+    "2min": timedelta(minutes=2),
+    "3min": timedelta(minutes=3),
+    "5min": timedelta(minutes=5),
+    "10min": timedelta(minutes=10),
+    "15min": timedelta(minutes=15),
+    "30min": timedelta(minutes=30),
+    "hour": timedelta(hours=1),
+    "day": timedelta(days=1),
+    "week": timedelta(days=7),
+    "month": timedelta(days=31),
+}
+# intervals able to answer query_data_by_time frequencies, from the coarsest
+freq_sources = {
+    "min": ["1min"],
+    "hour": ["hour", "30min", "15min", "10min", "5min", "3min", "2min", "1min"],
+}
+freq_sources["day"] = ["day"] + freq_sources["hour"]
+freq_sources["week"] = ["week"] + freq_sources["day"]
+# time zone of exchange days. Daily candles are stamped at session start or
+# at Moscow midnight, in both cases the Moscow date is the trading day
+exchange_time_zone = "Europe/Moscow"
+# allowed table and column names in generated queries
+identifier_pattern = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+# shared connection pools, see get_pool()
+_pools = {}
+_pools_lock = threading.Lock()
+# (user, password), read on first connection, see get_credentials()
+_credentials = None
+
+
+# -----------------------------------------------------------------------------
+def get_credentials():
+    """User and password of Clickhouse from CLICKHOUSE_USER and CLICKHOUSE_PWD.
+
+    .env file is found and loaded on the first call, not on import: import of
+    the module makes no file system walk and works without the file.
+
+    Returns:
+        (usr, pwd) : None if not set.
+    """
+    global _credentials
+    if _credentials is None:
+        from dotenv import load_dotenv, find_dotenv
+
+        # find .env automagically by walking up directories until it's found
+        load_dotenv(find_dotenv())
+        _credentials = (
+            os.environ.get("CLICKHOUSE_USER"),
+            os.environ.get("CLICKHOUSE_PWD"),
+        )
+    return _credentials
+
+
+def _new_client(server_ip, use_numpy=False):
+    """Client of clickhouse_driver. The driver is imported here, on the first
+    connection, it takes longer to import than the rest of the module."""
+    from clickhouse_driver import Client
+
+    usr, pwd = get_credentials()
+    return Client(server_ip, user=usr, password=pwd, settings={"use_numpy": use_numpy})
+
+
 # -----------------------------------------------------------------------------
-def connect(instance_name="localhost"):
+def connect(instance_name="localhost", use_numpy=False):
     """
     
 
@@ -35,6 +172,9 @@ def connect(instance_name="localhost"):
     instance_name : string
         ip adress of Clickhouse instance(i.e. 192.168.1.128). localhost by default.
         Username and password taken from .env file
+    use_numpy : bool
+        True to create client that reads results as NumPy arrays (see query_numpy_df).
+        False by default.
 
     Returns
     -------
@@ -45,7 +185,7 @@ def connect(instance_name="localhost"):
     logger = logging.getLogger(apiname + connect.__name__)
 
     logger.info(f"connection to {instance_name } is in progress ...")
-    client = Client(instance_name, user=usr, password=pwd)
+    client = _new_client(instance_name, use_numpy=use_numpy)
 
     try:
         ping = client.execute("SELECT 1")
@@ -85,10 +225,122 @@ def close_connection(client):
 
     """
 
-    if len(client.execute("SELECT 1")) > 0:
+    if client is not None:
         client.disconnect()
 
 
+# -----------------------------------------------------------------------------
+class ConnectionPool:
+    """Thread-safe pool of Clickhouse clients connected to one server.
+
+    Clients are reused between calls, so TCP connection and handshake
+    are made once per client instead of once per query. A client is
+    used by one thread at a time.
+    No ping is sent when client is taken from the pool: the driver
+    reconnects by itself if the connection was closed. Clients idle
+    for more than max_idle seconds are disconnected beforehand,
+    because the server most probably has dropped them already.
+
+    Usage:
+        with ConnectionPool("192.168.1.128") as pool:
+            with pool.connection() as con:
+                con.execute("SELECT 1")
+
+    Args:
+        server_ip (string) : ip adress of Clickhouse instance. localhost by default.
+            Username and password taken from .env file
+        max_size (int) : max number of clients used at the same time. 8 by default.
+        use_numpy (bool) : create clients that read results as NumPy arrays.
+        max_idle (float) : seconds after which idle client is reconnected.
+    """
+
+    def __init__(
+        self, server_ip="localhost", max_size=8, use_numpy=False, max_idle=300
+    ):
+        self.server_ip = server_ip
+        self.use_numpy = use_numpy
+        self.max_idle = max_idle
+        self._idle = []  # (client, time of release), the last released is reused first
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._is_closed = False
+
+    def acquire(self, timeout=None):
+        """Take client from the pool. Blocks while max_size clients are in use."""
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError(f"no free connection to {self.server_ip}")
+        client = None
+        with self._lock:
+            if self._idle:
+                client, released_at = self._idle.pop()
+                if time.monotonic() - released_at > self.max_idle:
+                    # reconnect lazily on the next query instead of pinging now
+                    client.disconnect()
+        if client is None:
+            client = _new_client(self.server_ip, use_numpy=self.use_numpy)
+        return client
+
+    def release(self, client):
+        """Return client to the pool."""
+        with self._lock:
+            if self._is_closed:
+                client.disconnect()
+            else:
+                self._idle.append((client, time.monotonic()))
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Context manager that takes client from the pool and returns it back."""
+        client = self.acquire()
+        try:
+            yield client
+        finally:
+            self.release(client)
+
+    def close(self):
+        """Disconnect idle clients. Clients in use are disconnected when released."""
+        with self._lock:
+            self._is_closed = True
+            idle, self._idle = self._idle, []
+        for client, _ in idle:
+            client.disconnect()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# -----------------------------------------------------------------------------
+def get_pool(server_ip="localhost", use_numpy=False):
+    """Get connection pool shared by all helpers of this process for given server.
+
+    Args:
+        server_ip (string) : ip adress of Clickhouse instance. localhost by default.
+        use_numpy (bool) : pool of clients that read results as NumPy arrays.
+
+    Returns:
+        pool (ConnectionPool)
+    """
+    key = (server_ip, use_numpy)
+    with _pools_lock:
+        if key not in _pools or _pools[key]._is_closed:
+            _pools[key] = ConnectionPool(server_ip, use_numpy=use_numpy)
+        return _pools[key]
+
+
+# -----------------------------------------------------------------------------
+def _pool_for(server_ip, pool=None, use_numpy=False):
+    """Pool passed by caller or shared pool of server_ip."""
+    if pool is None:
+        return get_pool(server_ip, use_numpy)
+    if pool.use_numpy != use_numpy:
+        return get_pool(pool.server_ip, use_numpy)
+    return pool
+
+
 # -----------------------------------------------------------------------------
 def get_databases(client):
     """
@@ -150,35 +402,361 @@ def get_column_names_in_table(client, table_name):
 
 
 # -----------------------------------------------------------------------------
-def get_SQL_table(connection, table_name):
+@utilities_timers.timed(apiname)
+def get_last_timestamps(client, table_name="minutes"):
+    """Get time of the last stored candle for every FIGI (watermarks for incremental download).
+
+    Args:
+        client : clickhouse connector. Client object of clickhouse_driver.client module
+        table_name (string) : table name in Clickhouse database. "minutes" by default.
+
+    Returns:
+        watermarks (dict) : {figi: time of the last stored candle}, timezone-aware UTC.
+            Read as unix time, so the result does not depend on time zone of the server.
+    """
+    logger = logging.getLogger(apiname + get_last_timestamps.__name__)
+
+    result = client.execute(
+        f"SELECT figi, toUnixTimestamp(max(time)) FROM {table_name} GROUP BY figi"
+    )
+    watermarks = {
+        figi: datetime.fromtimestamp(unix_time, timezone.utc)
+        for figi, unix_time in result
+    }
+    logger.info(f"found watermarks for {len(watermarks)} FIGIs in {table_name}")
+
+    return watermarks
+
+
+# -----------------------------------------------------------------------------
+def get_partition_versions(client, table_name="minutes"):
+    """Get last modification time of every monthly partition of candles table.
+
+    Every insert, merge or rebuild of a partition creates new parts, so the
+    time changes whenever stored data of the month may have changed,
+    e.g. after backfill of old days. Aggregate views of table_name and,
+    for "minutes", tables of other intervals (see choose_source_table)
+    are taken into account as well.
+
+    Args:
+        client : clickhouse connector. Client object of clickhouse_driver.client module
+        table_name (string) : candles table name. "minutes" by default.
+
+    Returns:
+        versions (dict) : {"YYYYMM": unix time of the last change}.
+    """
+    tables = [table_name] + [
+        f"{table_name}_{view_suffix}" for view_suffix, _, _ in aggregate_views.values()
+    ]
+    if table_name == interval_table("1min"):
+        tables += [interval_table(interval) for interval in candle_intervals]
+    result = client.execute(
+        "SELECT partition, toUnixTimestamp(max(modification_time)) FROM system.parts "
+        "WHERE database = currentDatabase() AND active AND table IN %(tables)s "
+        "GROUP BY partition",
+        {"tables": tuple(tables)},
+    )
+    return dict(result)
+
+
+# -----------------------------------------------------------------------------
+def interval_table(interval):
+    """Name of the table with candles of interval (see candle_intervals)."""
+    if interval not in candle_intervals:
+        raise ValueError(f"unsupported candles interval: {interval!r}")
+    if interval == "1min":
+        return "minutes"
+    return f"candles_{interval}"
+
+
+# -----------------------------------------------------------------------------
+def _trading_days(client, table_name, where, params, length=timedelta(0)):
+    """{figi: (first, last) exchange day} of candles matching where.
+
+    The range is widened by candle length: candles starting before startTime
+    (e.g. weekly one of its Monday) still cover it.
+    """
+    day = f"toDate(time, '{exchange_time_zone}')"
+    params = dict(params, length_start=params["start"] - length)
+    where = where.replace("%(start)s", "%(length_start)s")
+    result = client.execute(
+        f"SELECT figi, min({day}), max({day}) FROM {_quote_identifier(table_name)} "
+        f"WHERE {where} GROUP BY figi",
+        params,
+    )
+    return {figi: (first, last) for figi, first, last in result}
+
+
+def choose_source_table(
+    client,
+    data_freq,
+    startTime,
+    endTime,
+    instrument_type="Etf",
+    tickers=None,
+    figis=None,
+):
+    """Find the coarsest stored candles able to answer query of data_freq bars.
+
+    Coarser candles are fewer rows to aggregate. Candles of an interval answer
+    the query if their table exists and, for every requested instrument,
+    covers the exchange days 1min candles cover in [startTime, endTime].
+    So partly downloaded tables are not used. 1min candles are the last resort.
+
+    Args:
+        client : clickhouse connector. Client object of clickhouse_driver.client module
+        data_freq (string) : frequency of query_data_by_time: min, hour, day, week.
+        startTime, endTime (datetime) : requested time range.
+        instrument_type (string) : Etf, Bond or Stock.
+        tickers (list) : requested tickers. All tickers of instrument_type if None or empty.
+        figis (list) : requested FIGIs. All FIGIs if None or empty.
+
+    Returns:
+        table_name (string) : table to aggregate bars from.
+    """
+    logger = logging.getLogger(apiname + choose_source_table.__name__)
+
+    intervals = freq_sources[data_freq]
+    tables = [interval_table(interval) for interval in intervals]
+    existing = client.execute(
+        "SELECT name FROM system.tables "
+        "WHERE database = currentDatabase() AND name IN %(names)s",
+        {"names": tuple(tables)},
+    )
+    existing = set(row[0] for row in existing)
+    if not existing.intersection(tables[:-1]):
+        return tables[-1]
+
+    where, params = _instruments_where(
+        startTime, endTime, instrument_type, tickers, figis
+    )
+    # days with candles of every instrument, whatever the interval
+    expected = _trading_days(client, tables[-1], where, params)
+    for interval, table in zip(intervals[:-1], tables[:-1]):
+        if table not in existing:
+            continue
+        length = candle_intervals[interval]
+        covered = _trading_days(client, table, where, params, length=length)
+        # the last weekly (monthly) candle starts up to its length before the last day
+        tail = timedelta(days=max(length.days - 1, 0))
+        missing = [
+            figi
+            for figi, (first, last) in expected.items()
+            if figi not in covered
+            or covered[figi][0] > first
+            or covered[figi][1] + tail < last
+        ]
+        if not missing:
+            logger.info(f"{data_freq} bars are aggregated from {table}")
+            return table
+        logger.info(f"{table} does not cover {len(missing)} FIGIs, e.g. {missing[:5]}")
+    return tables[-1]
+
+
+# -----------------------------------------------------------------------------
+def _column_array(series):
+    """Convert dataframe column to array accepted by NumPy insert of clickhouse_driver."""
+    if isinstance(series.dtype, pd.DatetimeTZDtype):
+        # DatetimeIndex keeps time zone, so aware times are written the same way
+        # as datetime objects in row inserts. Naive times are taken in server time zone.
+        return pd.DatetimeIndex(series)
+    return series.to_numpy()
+
+
+# -----------------------------------------------------------------------------
+def insert_df(
+    client, table_name, df, columns=None, is_columnar=True, chunk_size=insert_chunk_size
+):
+    """Insert dataframe to existing table.
+
+    Args:
+        client : clickhouse connector. Client object of clickhouse_driver.client module
+        table_name (string) : table name in Clickhouse database.
+        df (Pandas.DataFrame) : data to be written.
+        columns (list) : columns of df to write, matched to table columns by name.
+            None (default) to write all columns of df by position.
+        is_columnar (bool) :
+            True (default) to send every column as one typed NumPy array.
+            False to send rows as Python tuples (slow, takes ~3x memory).
+        chunk_size (int) : max rows per insert. Bounds memory taken by one insert.
+
+    Returns:
+        n_rows (int) : number of inserted rows
+    """
+    if columns is None:
+        query = f"INSERT INTO {table_name} VALUES"
+        columns = list(df.columns)
+    else:
+        query = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES"
+
+    registry = metrics.get_registry()
+    n_rows = len(df)
+    for chunk_start in range(0, n_rows, chunk_size):
+        chunk = df.iloc[chunk_start : chunk_start + chunk_size]
+        with registry.timer("insert_seconds", table=table_name):
+            if is_columnar:
+                client.execute(
+                    query,
+                    [_column_array(chunk[col]) for col in columns],
+                    columnar=True,
+                    settings={"use_numpy": True},
+                )
+            else:
+                client.execute(query, [tuple(x) for x in chunk[columns].values])
+        registry.inc("inserted_rows_total", len(chunk), table=table_name)
+
+    return n_rows
+
+
+def insert_rate(table_name=None):
+    """Rows per second of insert time measured by insert_df in this process
+    (all tables by default). None before the first insert."""
+    snapshot = metrics.get_registry().snapshot()
+    n_rows = sum(
+        metric["value"]
+        for metric in snapshot["counters"]
+        if metric["name"] == "inserted_rows_total"
+        and table_name in (None, metric["labels"]["table"])
+    )
+    seconds = sum(
+        metric["sum"]
+        for metric in snapshot["histograms"]
+        if metric["name"] == "insert_seconds"
+        and table_name in (None, metric["labels"]["table"])
+    )
+    if n_rows == 0 or seconds == 0:
+        return None
+    return n_rows / seconds
+
+
+# -----------------------------------------------------------------------------
+@utilities_timers.timed(apiname)
+def get_SQL_table(connection, table_name, is_numpy=False):
     """Get data from given table stored on SQL server.
     Warning: Can take extreme amount of memory if you will querry whole minutes table!
+    Use iter_SQL_table() to read big tables chunk by chunk.
 
     Args:
         client : clickhouse connector. Client object of clickhouse_driver.client module
         table_name (string) : table name in Clickhouse database. If not exists will crush.
+        is_numpy (bool) : fast path, see query_numpy_df. Client must be created
+            with connect(..., use_numpy=True). False by default.
 
     Returns:
         df (Pandas.DataFrame) : table with data
     """
 
-    start = time.time()
     logger = logging.getLogger(apiname + get_SQL_table.__name__)
     logger.info(f"read table {table_name} from Clickhouse")
 
-    result, columns = connection.execute(
-        f"SELECT * FROM {table_name}", with_column_types=True
-    )
-    df = pd.DataFrame(result, columns=[tuple[0] for tuple in columns])
+    if is_numpy:
+        df = query_numpy_df(connection, f"SELECT * FROM {table_name}")
+    else:
+        result, columns = connection.execute(
+            f"SELECT * FROM {table_name}", with_column_types=True
+        )
+        df = pd.DataFrame(result, columns=[tuple[0] for tuple in columns])
+
+    return df
 
-    timer_string = utilities_timers.format_timer_string(time.time() - start)
-    logger.info(timer_string)
 
+# -----------------------------------------------------------------------------
+def query_numpy_df(client, query, params=None, categorical=categorical_columns):
+    """Run SELECT query and build dataframe from NumPy columns.
+
+    Numbers and times are decoded by the driver straight to typed arrays
+    (time becomes datetime64), no Python object is created per cell.
+    String columns listed in categorical become pandas categoricals;
+    LowCardinality columns are categoricals already.
+
+    Args:
+        client : clickhouse connector created with connect(..., use_numpy=True).
+        query (string) : SELECT query.
+        params (dict) : query parameters, see clickhouse_driver.Client.execute.
+        categorical (list) : names of string columns to convert to categoricals.
+
+    Returns:
+        df (Pandas.DataFrame) : query result
+    """
+    data, columns = client.execute(query, params, columnar=True, with_column_types=True)
+    names = [col[0] for col in columns]
+    if not data:
+        return pd.DataFrame(columns=names)
+
+    df = pd.DataFrame(dict(zip(names, data)), columns=names)
+    for name in categorical:
+        if name in df.columns and not isinstance(df[name].dtype, pd.CategoricalDtype):
+            df[name] = df[name].astype("category")
     return df
 
 
+# -----------------------------------------------------------------------------
+def iter_query_df(client, query, params=None, chunk_size=query_chunk_size):
+    """Stream result of SELECT query as dataframes of chunk_size rows.
+
+    Rows are read from server block by block (execute_iter), so memory
+    does not depend on the size of the whole result.
+
+    Args:
+        client : clickhouse connector. Client object of clickhouse_driver.client module
+        query (string) : SELECT query.
+        params (dict) : query parameters, see clickhouse_driver.Client.execute.
+        chunk_size (int) : number of rows in every yielded dataframe (last one can be shorter).
+
+    Yields:
+        df (Pandas.DataFrame) : next chunk of result
+    """
+    rows = client.execute_iter(
+        query,
+        params,
+        with_column_types=True,
+        settings={"max_block_size": chunk_size},
+    )
+    is_complete = False
+    try:
+        # first item of the stream is list of (name, type) of columns
+        columns = [col[0] for col in next(rows)]
+        buffer = []
+        for row in rows:
+            buffer.append(row)
+            if len(buffer) == chunk_size:
+                yield pd.DataFrame(buffer, columns=columns)
+                buffer = []
+        if buffer:
+            yield pd.DataFrame(buffer, columns=columns)
+        is_complete = True
+    except StopIteration:
+        is_complete = True
+    finally:
+        if not is_complete:
+            # consumer stopped early, the rest of the stream is still on the wire
+            client.disconnect()
+
+
+# -----------------------------------------------------------------------------
+def iter_SQL_table(connection, table_name, chunk_size=query_chunk_size):
+    """Get data from given table stored on SQL server chunk by chunk.
+    Memory consumption is bounded by chunk_size, so it is safe to read whole minutes table.
+
+    Args:
+        client : clickhouse connector. Client object of clickhouse_driver.client module
+        table_name (string) : table name in Clickhouse database. If not exists will crush.
+        chunk_size (int) : number of rows in every yielded dataframe.
+
+    Yields:
+        df (Pandas.DataFrame) : next chunk of table
+    """
+    logger = logging.getLogger(apiname + iter_SQL_table.__name__)
+    logger.info(f"stream table {table_name} from Clickhouse by {chunk_size} rows")
+
+    return iter_query_df(
+        connection, f"SELECT * FROM {table_name}", chunk_size=chunk_size
+    )
+
+
 # -------------------------------
 ##-------------------------------------------------------------------------------------------------
+@utilities_timers.timed(apiname)
 def query_data_by_time(
     channels_list,
     startTime=None,
@@ -188,12 +766,21 @@ def query_data_by_time(
     table_name="minutes",
     instrument_type="Etf",
     data_freq="min",
+    chunk_size=None,
+    is_numpy=False,
+    pool=None,
+    cache=None,
+    tickers=None,
+    figis=None,
+    is_final=True,
 ):
     """
     Request data from SQL DataBase in time range [startTime, endTime].
 
     Args:
-        channels_list (list) : list of channels to be quired from DataBase
+        channels_list (list) : list of columns to be quired from DataBase.
+            All columns if None, empty or ["*"]. Only listed columns are
+            transferred from server.
         startTime (datetime) : data will be quired AFTER this time moment
             If not set: 1 year period from endTime.
         endTime (datetime) : data will be quired BEFORE this time moment
@@ -203,11 +790,34 @@ def query_data_by_time(
         ip adress of Clickhouse instance(i.e. 192.168.1.128). localhost by default.
         Username and password taken from .env file
         table_name (string) : table name in SQL database.minutes by default
+            With "minutes" bars are aggregated from the coarsest stored candles
+            that cover the time range (see choose_source_table). uniq(time) and
+            count() of such bars count the source candles, not minutes.
+        instrument_type (string) : Etf, Bond or Stock. Etf by default.
+        data_freq (string) : "min" for raw candles, "hour", "day" or "week"
+            for OHLCV bars. min by default.
+        chunk_size (int) : streaming mode. If set, generator of dataframes
+            with chunk_size rows is returned instead of one dataframe.
+        is_numpy (bool) : fast path, build dataframe from NumPy columns (see query_numpy_df).
+            Not used in streaming mode. False by default.
+        pool (ConnectionPool) : pool to take connection from.
+            Shared pool of server_ip is used by default (see get_pool).
+        cache (query_cache.QueryCache) : local cache to answer from.
+            Only missing periods are queried from server. Not used in streaming mode.
+            Cached data is filtered by channels_list, tickers and figis locally.
+        tickers (list) : query only these tickers (e.g. a basket of instruments).
+            All tickers of instrument_type by default.
+        figis (list) : query only these FIGIs. All FIGIs by default.
+        is_final (bool) : read raw candles of ReplacingMergeTree tables with FINAL,
+            so candles inserted several times and not merged yet are returned once.
+            True by default. False is faster, but duplicates of candles
+            written since the last merge are returned (and counted in bars).
+            Aggregate views are read as is in both cases.
 
     Returns
         (pd.DataFrame) : Table with requested channels in a given time range.
+            generator of pd.DataFrame if chunk_size is set.
     """
-    start = time.time()
     logger = logging.getLogger(apiname + query_data_by_time.__name__)
     logger.info("data query in progress ...")
 
@@ -225,49 +835,89 @@ def query_data_by_time(
         logger.error("Unsupported instrument type. Only Etf, Bond, Stock are supported")
         logger.error("Does not querry anything")
         return None
-    if data_freq not in ["min", "day", "week"]:
-        logger.error("Unsupported data frequency. Only min, day, week are supported")
+    if data_freq not in ["min", "hour", "day", "week"]:
+        logger.error(
+            "Unsupported data frequency. Only min, hour, day, week are supported"
+        )
         logger.error("Does not querry anything")
         return None
 
-    con, _ = connect(server_ip)
-    channel_string = (" ,").join(channels_list)
-    # converting values to strings to get clickhouse-compatible time format
-    startTime = startTime.strftime("%Y-%m-%d %H:%M:%S")
-    endTime = endTime.strftime("%Y-%m-%d %H:%M:%S")
-    if data_freq == "min":
-
-        msg1 = f"select * from {table_name} "
-        msg2 = f"where time BETWEEN '{startTime}' AND '{endTime}' "
-        msg3 = f"AND type='{instrument_type}' AND name={channel_string}"
-        query = msg1 + msg2 + msg3
-    elif data_freq == "day":
-
-        logger.info(f"startTime is {startTime}")
-        logger.info(f"endTIme is {endTime}")
-        msg1 = f"select uniq(time), count(), ticker, type,currency,name, day, argMin(o, time) as o,max(h) as h, min(l) as l, argMax(c, time) as c, sum(v) as v "
-        msg2 = f"from minutes "
-
-        msg3 = f"where time BETWEEN '{startTime}' AND '{endTime}' AND type='{instrument_type}' "
-        msg4 = "GROUP BY day, ticker, type, currency, name ORDER BY day desc"
-        query = msg1 + msg2 + msg3 + msg4
-    elif data_freq == "week":
-
-        msg1 = "SELECT uniq(time), count(),ticker,currency, name, toMonday(day) as monday, argMin(o, time) as o, max(h) as h, min(l) as l, argMax(c, time) as c, sum(v) as v "
-        msg2 = f"from minutes "
-        msg3 = f"where time BETWEEN '{startTime}' AND '{endTime}' AND type='{instrument_type}' "
-        msg4 = "GROUP BY monday, ticker, type, currency, name ORDER BY monday desc"
-        query = msg1 + msg2 + msg3 + msg4
+    # bars do not keep figi, so figi filter can not be applied to cached bars
+    if cache is not None and chunk_size is None and not (figis and data_freq != "min"):
+        df = cache.query(
+            startTime=startTime,
+            endTime=endTime,
+            server_ip=server_ip,
+            table_name=table_name,
+            instrument_type=instrument_type,
+            data_freq=data_freq,
+            is_numpy=is_numpy,
+            pool=pool,
+        )
+        if df is None:
+            return None
+        if tickers:
+            df = df[df.ticker.isin(tickers)]
+        if figis:
+            df = df[df.figi.isin(figis)]
+        if "*" not in channels_list:
+            df = df[channels_list]
+        return df.reset_index(drop=True)
+
+    source_table = table_name
+    is_view = False
+    with _pool_for(server_ip, pool).connection() as con:
+        if data_freq != "min":
+            if table_name == interval_table("1min"):
+                source_table = choose_source_table(
+                    con,
+                    data_freq,
+                    startTime,
+                    endTime,
+                    instrument_type,
+                    tickers=tickers,
+                    figis=figis,
+                )
+            if source_table == table_name:
+                is_view = data_freq in get_aggregate_views(con, table_name)
+            logger.info(
+                f"source table: {source_table}, aggregate view is used: {is_view}"
+            )
+        # FINAL is an error for engines without merge logic
+        is_final = is_final and is_replacing_table(con, source_table)
+    try:
+        query, params = build_candles_query(
+            startTime,
+            endTime,
+            table_name=source_table,
+            instrument_type=instrument_type,
+            data_freq=data_freq,
+            columns=channels_list,
+            tickers=tickers,
+            figis=figis,
+            is_view=is_view,
+            is_final=is_final,
+        )
+    except ValueError as exc:
+        logger.error(f"generated an exception: {exc}")
+        logger.error("Does not querry anything")
+        return None
 
     logger.info(f"query string: {query}")
+    logger.info(f"query parameters: {params}")
 
-    result, columns = con.execute(query, with_column_types=True)
-    df = pd.DataFrame(result, columns=[tuple[0] for tuple in columns])
-
-    close_connection(con)
+    if chunk_size is not None:
+        logger.info(f"streaming result by {chunk_size} rows")
+        return _stream_from_pool(
+            _pool_for(server_ip, pool), query, params, chunk_size=chunk_size
+        )
 
-    timer_string = utilities_timers.format_timer_string(time.time() - start)
-    logger.info(timer_string)
+    with _pool_for(server_ip, pool, use_numpy=is_numpy).connection() as con:
+        if is_numpy:
+            df = query_numpy_df(con, query, params)
+        else:
+            result, columns = con.execute(query, params, with_column_types=True)
+            df = pd.DataFrame(result, columns=[tuple[0] for tuple in columns])
     logger.info(f"data query complete. Dataframe has shape : {df.shape}.")
     logger.info("--------------------------")
 
@@ -275,19 +925,40 @@ def query_data_by_time(
 
 
 ##-------------------------------------------------------------------------------------------------
+def _stream_from_pool(pool, query, params=None, chunk_size=query_chunk_size):
+    """Streams query result. Connection is taken from pool until the stream is over."""
+    with pool.connection() as con:
+        for df in iter_query_df(con, query, params, chunk_size=chunk_size):
+            yield df
+
+
+##-------------------------------------------------------------------------------------------------
+@utilities_timers.timed(apiname)
 def append_df_to_SQL_table(
-    df=None, table_name="minutes", server_ip="localhost", is_tmp_table_to_delete=True,
+    df=None,
+    table_name="minutes",
+    server_ip="localhost",
+    is_tmp_table_to_delete=True,
+    is_columnar=True,
+    chunk_size=insert_chunk_size,
+    pool=None,
 ):
     """write dataframe to SQL server. Only values with unique columns will be append.
 
     Args:
         df (Pandas.DataFrame) : data to be written to SQL
         table_name (string) : table name in Clickhouse database."minutes" by default.
+            If None, candles of every interval are written to their own table
+            (see interval_table). Table is created if it does not exist.
         server_ip (string) : Server IP. 'localhost' by default
         is_tmp_table_to_delete (bool) :
             True (default) to delete temporary table,
             which was used to keep new data when merging with the existing table.
             Set False if you want to keep tmp table for any reason (e.g. merge this table to multiple tables).
+        is_columnar (bool) : True (default) to insert columns as NumPy arrays, see insert_df.
+        chunk_size (int) : max rows per insert query, see insert_df.
+        pool (ConnectionPool) : pool to take connection from.
+            Shared pool of server_ip is used by default (see get_pool).
 
     Returns:
         nothing
@@ -296,16 +967,16 @@ def append_df_to_SQL_table(
         nothing
 
     """
-    start = time.time()
-
     logger = logging.getLogger(apiname + append_df_to_SQL_table.__name__)
 
     ##---------------------------------------------------------------------------------------------
     n_rows, n_cols = df.shape
 
     logger.info(f"write (row x col) : ({n_rows} x {n_cols})")
-    expected_min = 1 * n_rows * n_cols / 130000 / 34  # experimental formula for ru0138
-    logger.info(f"expected time ~{int(expected_min)} minutes")
+    rate = insert_rate()
+    if rate is not None:
+        # measured by previous inserts of this process
+        logger.info(f"expected insert time ~{n_rows / rate:.0f} s at {rate:.0f} rows/s")
 
     if n_rows == 0:
         logger.info(f"DataFrame has 0 rows. Target table will not be modified. Exit.")
@@ -313,60 +984,884 @@ def append_df_to_SQL_table(
 
     logger.info(f"list of columns in df: {df.columns}.")
 
+    if table_name is None:
+        for interval, df_interval in df.groupby("interval", sort=False):
+            append_df_to_SQL_table(
+                df=df_interval,
+                table_name=interval_table(interval),
+                server_ip=server_ip,
+                is_tmp_table_to_delete=is_tmp_table_to_delete,
+                is_columnar=is_columnar,
+                chunk_size=chunk_size,
+                pool=pool,
+            )
+        return
+
     if table_name[0].isdigit():
         table_name = "_" + table_name
         logger.warning(f"table name started from digit. Rename as {table_name}.")
 
-    con, ping = connect(server_ip)
-    logger.info(f"data uploading to a temp table  ...")
-    # dropping table tmp
-    con.execute("DROP TABLE IF EXISTS tmp")
-    # creating new table
-    con.execute(
-        "CREATE TABLE tmp ("
-        "figi String, "
-        "interval String, o Float64, "
-        "c Float64, h Float64, "
-        "l Float64, v Int64, "
-        "time DateTime, ticker String, "
-        "isin String, min_price_increment Float64,"
-        "lot Int64, currency String,"
-        "name String, type String) ENGINE = Log "
+    with _pool_for(server_ip, pool).connection() as con:
+        logger.info(f"data uploading to a temp table  ...")
+        # dropping table tmp
+        con.execute("DROP TABLE IF EXISTS tmp")
+        # creating new table
+        con.execute(
+            "CREATE TABLE tmp ("
+            "figi String, "
+            "interval String, o Float64, "
+            "c Float64, h Float64, "
+            "l Float64, v Int64, "
+            "time DateTime, ticker String, "
+            "isin String, min_price_increment Float64,"
+            "lot Int64, currency String,"
+            "name String, type String) ENGINE = Log "
+        )
+        insert_df(con, "tmp", df, is_columnar=is_columnar, chunk_size=chunk_size)
+        create_candles_table(con, table_name)
+
+        inserted_rows_count = con.execute("SELECT count(*) FROM tmp")[0][0]
+        logger.info(
+            f"Inserted {inserted_rows_count} rows to temporary table. Moving to '{table_name}' table"
+        )
+        initial_rows_count = con.execute(f"SELECT count(*) FROM {table_name}")[0][0]
+        logger.info(f"initially {table_name} table has {initial_rows_count} rows")
+        # instrument attributes of tmp are not copied, candles keep only figi:
+        # write them to instruments table with upsert_instruments
+        con.execute(
+            f"INSERT INTO {table_name} (day, figi, interval, o, c, h, l, v, time) "
+            "SELECT DISTINCT "
+            "toDate(time) AS day,"
+            "figi, "
+            "interval, o, "
+            "c , h, "
+            "l , v, "
+            "time FROM tmp WHERE (figi, time) NOT IN "
+            f"(SELECT (figi, time) FROM {table_name})"
+        )
+
+        logger.info(f"merge complete")
+        new_rows_count = con.execute(f"SELECT count(*) FROM {table_name}")[0][0]
+        inserted_row_count = new_rows_count - initial_rows_count
+        logger.info(f"Inserted {inserted_row_count} unique rows to {table_name} table.")
+        logger.info(f"now {table_name} table has {new_rows_count} rows")
+        if is_tmp_table_to_delete:
+            con.execute("DROP TABLE IF EXISTS tmp")
+
+    logger.info(f"new data written to table '{table_name}'")
+
+
+##-------------------------------------------------------------------------------------------------
+def create_candles_table(client, table_name="minutes", columns=candles_columns):
+    """Create deduplicating candles table if it does not exist.
+
+    ReplacingMergeTree ordered by (figi, time) keeps one row per candle:
+    rows with the same key are collapsed by background merges, so data can be
+    inserted directly without checking what is already stored.
+    The key also serves queries: all of them select a time range,
+    most of them a few instruments. Monthly partitions limit long scans.
+    Instruments table and dictionary used by queries are created as well.
+
+    Args:
+        client : clickhouse connector. Client object of clickhouse_driver.client module
+        table_name (string) : table name in Clickhouse database. "minutes" by default.
+        columns (string) : schema of the table. candles_columns by default.
+
+    Returns:
+        nothing
+    """
+    client.execute(
+        f"CREATE TABLE IF NOT EXISTS {table_name} ({columns}) "
+        "ENGINE = ReplacingMergeTree() "
+        "PARTITION BY toYYYYMM(time) "
+        "ORDER BY (figi, time)"
     )
-    con.execute("INSERT INTO tmp VALUES", [tuple(x) for x in df.values])
+    create_instruments_table(client)
 
-    inserted_rows_count = con.execute("SELECT count(*) FROM tmp")[0][0]
-    logger.info(
-        f"Inserted {inserted_rows_count} rows to temporary table. Moving to 'minutes' table"
+
+##-------------------------------------------------------------------------------------------------
+def is_replacing_table(client, table_name="minutes"):
+    """Check that table collapses duplicates, i.e. has ReplacingMergeTree engine.
+
+    create_candles_table does not change engine of existing tables, so tables
+    created before it keep MergeTree until migrate_to_replacing_merge_tree.
+
+    Args:
+        client : clickhouse connector. Client object of clickhouse_driver.client module
+        table_name (string) : table name in Clickhouse database. "minutes" by default.
+
+    Returns:
+        (bool) : True for (Replicated)ReplacingMergeTree tables, False otherwise
+            and if there is no such table.
+    """
+    result = client.execute(
+        "SELECT engine FROM system.tables "
+        "WHERE database = currentDatabase() AND name = %(table)s",
+        {"table": table_name},
     )
-    initial_rows_count = con.execute("SELECT count(*) FROM minutes")[0][0]
-    logger.info(f"initially minutes table has {initial_rows_count} rows")
-    con.execute(
-        "INSERT INTO minutes "
-        "SELECT DISTINCT "
-        "toDate(time) AS day,"
-        "figi, "
-        "interval, o, "
-        "c , h, "
-        "l , v, "
-        "time, ticker, "
-        "isin, min_price_increment,"
-        "lot, currency,"
-        "name, type FROM tmp WHERE (ticker, time) NOT IN (SELECT (ticker, time) FROM minutes)"
+    return bool(result) and result[0][0].endswith("ReplacingMergeTree")
+
+
+##-------------------------------------------------------------------------------------------------
+def create_orderbooks_table(client, table_name=orderbooks_table):
+    """Create order book table if it does not exist.
+
+    Snapshots are only appended, every one has its own time,
+    so plain MergeTree is used. Ordered by (figi, time) as candles tables.
+
+    Args:
+        client : clickhouse connector. Client object of clickhouse_driver.client module
+        table_name (string) : table name in Clickhouse database. "orderbooks" by default.
+
+    Returns:
+        nothing
+    """
+    client.execute(
+        f"CREATE TABLE IF NOT EXISTS {table_name} ({orderbook_columns}) "
+        "ENGINE = MergeTree() "
+        "PARTITION BY toYYYYMM(time) "
+        "ORDER BY (figi, time, side, level)"
     )
 
-    logger.info(f"merge complete")
-    new_rows_count = con.execute("SELECT count(*) FROM minutes")[0][0]
-    inserted_row_count = new_rows_count - initial_rows_count
-    logger.info(f"Inserted {inserted_row_count} unique rows to minutes table.")
-    logger.info(f"now minutes table has {new_rows_count} rows")
-    if is_tmp_table_to_delete:
-        con.execute("DROP TABLE IF EXISTS tmp")
 
-    timer_string = utilities_timers.format_timer_string(time.time() - start)
-    logger.info(timer_string)
+##-------------------------------------------------------------------------------------------------
+@utilities_timers.timed(apiname)
+def append_orderbooks_to_SQL_table(
+    df, table_name=orderbooks_table, server_ip="localhost", pool=None
+):
+    """Write order book levels (see create_orderbooks_table).
+
+    Args:
+        df (Pandas.DataFrame) : rows with time, figi, side, level, price, quantity.
+        table_name (string) : "orderbooks" by default.
+        server_ip (string) : Server IP. 'localhost' by default
+        pool (ConnectionPool) : pool to take connection from.
+            Shared pool of server_ip is used by default (see get_pool).
+
+    Returns:
+        n_rows (int) : number of inserted rows
+    """
+    logger = logging.getLogger(apiname + append_orderbooks_to_SQL_table.__name__)
+
+    if len(df) == 0:
+        return 0
+    columns = ["time", "figi", "side", "level", "price", "quantity"]
+    with _pool_for(server_ip, pool).connection() as con:
+        create_orderbooks_table(con, table_name)
+        n_rows = insert_df(con, table_name, df, columns=columns)
+
+    logger.debug(f"Inserted {n_rows} rows to {table_name} table.")
+    return n_rows
+
+
+##-------------------------------------------------------------------------------------------------
+def create_instruments_table(client):
+    """Create instruments dimension table and dictionary if they do not exist.
+
+    Candles tables keep only figi. Ticker, type and other attributes are stored
+    once per instrument in instruments table and read by queries through
+    instruments_dict (dictGet by figi), which is kept in server memory.
+    ReplacingMergeTree(version) keeps the latest version of every instrument.
+
+    Dictionary reads the table with its own connection. If CLICKHOUSE_NAMED_COLLECTION
+    is set, user and password are taken from this named collection of the server.
+    Otherwise CLICKHOUSE_USER and CLICKHOUSE_PWD are written to the dictionary
+    definition: the password is stored in server metadata as plain text and
+    shown by SHOW CREATE DICTIONARY to users allowed to see the dictionary.
+
+    Args:
+        client : clickhouse connector. Client object of clickhouse_driver.client module
+
+    Returns:
+        nothing
+    """
+    client.execute(
+        f"CREATE TABLE IF NOT EXISTS {instruments_table} ({instruments_columns}) "
+        "ENGINE = ReplacingMergeTree(version) "
+        "ORDER BY figi"
+    )
+    usr, pwd = get_credentials()
+    collection = os.environ.get(named_collection_variable)
+    if collection:
+        source = f"NAME {_quote_identifier(collection)} "
+    elif usr:
+        source = f"USER {_quote_string(usr)} PASSWORD {_quote_string(pwd or '')} "
+    else:
+        source = ""
+    attributes = ", ".join(["figi"] + instrument_columns)
+    min_lifetime, max_lifetime = instruments_dict_lifetime
+    client.execute(
+        f"CREATE DICTIONARY IF NOT EXISTS {instruments_dict} "
+        f"({instruments_dict_columns}) "
+        "PRIMARY KEY figi "
+        f"SOURCE(CLICKHOUSE({source}"
+        f"QUERY 'SELECT {attributes} FROM {instruments_table} FINAL')) "
+        f"LIFETIME(MIN {min_lifetime} MAX {max_lifetime}) "
+        "LAYOUT(COMPLEX_KEY_HASHED())"
+    )
+
+
+##-------------------------------------------------------------------------------------------------
+@utilities_timers.timed(apiname)
+def upsert_instruments(client, df):
+    """Write new version of instruments (see create_instruments_table).
+
+    Only instruments missing in the table or with attributes different
+    from the stored ones are written, so it is cheap to call on every run
+    of a loader. Written rows get a version above the stored one of their figi:
+    a newer version of another instrument does not block the update.
+
+    Args:
+        client : clickhouse connector. Client object of clickhouse_driver.client module
+        df (Pandas.DataFrame) : instruments with figi, instrument_columns and version,
+            e.g. from instrument_cache.InstrumentCache.load().
+
+    Returns:
+        is_written (bool) : True if df was written.
+    """
+    logger = logging.getLogger(apiname + upsert_instruments.__name__)
+
+    if len(df) == 0:
+        logger.info("DataFrame has 0 rows. Instruments will not be modified. Exit.")
+        return False
+    create_instruments_table(client)
+    columns = ["figi"] + instrument_columns + ["version"]
+    stored = pd.DataFrame(
+        client.execute(f"SELECT {', '.join(columns)} FROM {instruments_table} FINAL"),
+        columns=columns,
+    )
+    df = df[columns].drop_duplicates("figi", keep="last")
+    df = df.merge(stored, on="figi", how="left", suffixes=("", "_stored"))
+    is_changed = df.version_stored.isna()
+    for col in instrument_columns:
+        new, old = df[col], df[col + "_stored"]
+        is_changed |= (new != old) & ~(new.isna() & old.isna())
+    df = df[is_changed]
+    if len(df) == 0:
+        logger.info("stored instruments are up to date")
+        return False
+
+    next_version = df.version_stored.fillna(-1) + 1
+    df = df.assign(
+        version=df.version.where(df.version >= next_version, next_version).astype(
+            "uint64"
+        )
+    )
+    insert_df(client, instruments_table, df, columns=columns)
+    client.execute(f"OPTIMIZE TABLE {instruments_table} FINAL")
+    client.execute(f"SYSTEM RELOAD DICTIONARY {instruments_dict}")
+    logger.info(f"written {len(df)} new or changed instruments")
+    return True
+
+
+##-------------------------------------------------------------------------------------------------
+def get_instruments(client, tickers=None):
+    """Read the latest version of instruments (see create_instruments_table).
+
+    Args:
+        client : clickhouse connector. Client object of clickhouse_driver.client module
+        tickers (list) : return only these tickers. All instruments if None or empty.
+
+    Returns:
+        df (Pandas.DataFrame) : figi and instrument_columns of instruments.
+    """
+    logger = logging.getLogger(apiname + get_instruments.__name__)
+
+    columns = ["figi"] + instrument_columns
+    query = f"SELECT {', '.join(columns)} FROM {instruments_table} FINAL"
+    params = {}
+    if tickers:
+        query += " WHERE ticker IN %(tickers)s"
+        params["tickers"] = tuple(tickers)
+    result = client.execute(query, params)
+    df = pd.DataFrame(result, columns=columns)
+    logger.info(f"{len(df)} instruments read")
+    return df
+
+
+##-------------------------------------------------------------------------------------------------
+@utilities_timers.timed(apiname)
+def upsert_df_to_SQL_table(
+    df=None,
+    table_name="minutes",
+    server_ip="localhost",
+    is_optimize=False,
+    is_columnar=True,
+    chunk_size=insert_chunk_size,
+    pool=None,
+):
+    """write dataframe to deduplicating candles table (see create_candles_table).
+
+    Unlike append_df_to_SQL_table it does not look at the existing data,
+    so insert cost depends only on size of df. Several loaders can write
+    to the same table at the same time.
+    Duplicates are removed by background merges; until then use FINAL
+    in queries (is_final of query_data_by_time) or set is_optimize=True.
+    Tables with other engines are refused (see is_replacing_table).
+
+    Args:
+        df (Pandas.DataFrame) : data to be written to SQL. Columns that are not
+            in the target table are ignored, e.g. instrument attributes
+            (they are written once per instrument by upsert_instruments).
+        table_name (string) : table name in Clickhouse database."minutes" by default.
+            If None, candles of every interval are written to their own table
+            (see interval_table).
+        server_ip (string) : Server IP. 'localhost' by default
+        is_optimize (bool) : merge partitions touched by df right after insert,
+            so duplicates disappear immediately. Aggregate views of these
+            partitions are rebuilt as well. False by default.
+        is_columnar (bool) : True (default) to insert columns as NumPy arrays, see insert_df.
+        chunk_size (int) : max rows per insert query, see insert_df.
+        pool (ConnectionPool) : pool to take connection from.
+            Shared pool of server_ip is used by default (see get_pool).
+
+    Returns:
+        nothing
+    """
+    logger = logging.getLogger(apiname + upsert_df_to_SQL_table.__name__)
+
+    n_rows, n_cols = df.shape
+    logger.info(f"write (row x col) : ({n_rows} x {n_cols})")
+    if n_rows == 0:
+        logger.info(f"DataFrame has 0 rows. Target table will not be modified. Exit.")
+        return
+
+    if table_name is None:
+        for interval, df_interval in df.groupby("interval", sort=False):
+            upsert_df_to_SQL_table(
+                df=df_interval,
+                table_name=interval_table(interval),
+                server_ip=server_ip,
+                is_optimize=is_optimize,
+                is_columnar=is_columnar,
+                chunk_size=chunk_size,
+                pool=pool,
+            )
+        return
+
+    with _pool_for(server_ip, pool).connection() as con:
+        create_candles_table(con, table_name)
+        # plain MergeTree keeps every inserted copy of a candle forever
+        if not is_replacing_table(con, table_name):
+            raise RuntimeError(
+                f"{table_name} does not deduplicate candles, run "
+                "migrate_to_replacing_merge_tree first or use append_df_to_SQL_table"
+            )
+
+        table_columns, _ = get_column_names_in_table(con, table_name)
+        columns = [col for col in df.columns if col in table_columns]
+        logger.info(f"list of columns to write: {columns}.")
+        insert_df(
+            con,
+            table_name,
+            df,
+            columns=columns,
+            is_columnar=is_columnar,
+            chunk_size=chunk_size,
+        )
+        logger.info(f"Inserted {n_rows} rows to {table_name} table.")
+
+        if is_optimize:
+            partitions = sorted(set(pd.to_datetime(df.time).dt.strftime("%Y%m")))
+            for partition in partitions:
+                con.execute(f"OPTIMIZE TABLE {table_name} PARTITION {partition} FINAL")
+            logger.info(f"merged partitions {partitions}")
+            refresh_aggregate_views(con, table_name, months=partitions)
+
+
+##-------------------------------------------------------------------------------------------------
+@utilities_timers.timed(apiname)
+def migrate_to_replacing_merge_tree(
+    client, table_name="minutes", is_keep_old=True, is_instruments_copied=False
+):
+    """Move existing candles table to the deduplicating engine (see create_candles_table).
+
+    Data is copied to a new table with the current schema (engine, column types
+    and codecs of candles_columns), which then replaces the old one.
+    Old table is renamed to <table_name>_old and kept as backup
+    (<table_name>_old_<YYYYmmddHHMMSS> if a backup of an earlier migration exists).
+    Aggregate views of the table are rebuilt, also when migration fails:
+    then the table is left as it was.
+    Stop loaders before migration: rows inserted during copy are lost.
+    Instrument columns are not copied: tables which still have them are
+    migrated by migrate_to_instruments_table, which saves them first.
+
+    Args:
+        client : clickhouse connector. Client object of clickhouse_driver.client module
+        table_name (string) : table name in Clickhouse database. "minutes" by default.
+        is_keep_old (bool) : True (default) to keep the old table as <table_name>_old.
+        is_instruments_copied (bool) : True if instrument columns are already
+            copied to instruments table (used by migrate_to_instruments_table).
+
+    Returns:
+        nothing
+    """
+    logger = logging.getLogger(apiname + migrate_to_replacing_merge_tree.__name__)
+
+    if not is_instruments_copied:
+        old_columns, _ = get_column_names_in_table(client, table_name)
+        if any(col in old_columns for col in instrument_columns):
+            logger.info(f"{table_name} has instrument columns, migrating them first")
+            migrate_to_instruments_table(client, table_name, is_keep_old=is_keep_old)
+            return
+
+    new_table = table_name + "_new"
+    old_table = table_name + "_old"
+    existing = client.execute(
+        "SELECT name FROM system.tables "
+        "WHERE database = currentDatabase() AND name = %(name)s",
+        {"name": old_table},
+    )
+    if existing:
+        # backup of an earlier migration, e.g. before migrate_to_instruments_table
+        old_table = f"{old_table}_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        logger.info(f"{table_name}_old exists, backup goes to {old_table}")
+
+    # materialized views would follow the renamed old table
+    freqs = tuple(get_aggregate_views(client, table_name))
+    drop_aggregate_views(client, table_name)
+    is_renamed = False
+    try:
+        client.execute(f"DROP TABLE IF EXISTS {new_table}")
+        create_candles_table(client, new_table)
+
+        old_columns, _ = get_column_names_in_table(client, table_name)
+        new_columns, _ = get_column_names_in_table(client, new_table)
+        columns = ", ".join(col for col in new_columns if col in old_columns)
+        logger.info(f"copying {table_name} to {new_table} ...")
+        client.execute(
+            f"INSERT INTO {new_table} ({columns}) SELECT {columns} FROM {table_name}"
+        )
+        client.execute(f"OPTIMIZE TABLE {new_table} FINAL")
+
+        client.execute(
+            f"RENAME TABLE {table_name} TO {old_table}, {new_table} TO {table_name}"
+        )
+        is_renamed = True
+    finally:
+        if not is_renamed:
+            logger.error(f"migration failed, {table_name} is not changed")
+            client.execute(f"DROP TABLE IF EXISTS {new_table}")
+        if freqs:
+            create_aggregate_views(client, table_name, freqs=freqs)
+    if not is_keep_old:
+        client.execute(f"DROP TABLE {old_table}")
+    rows_count = client.execute(f"SELECT count() FROM {table_name}")[0][0]
+    logger.info(f"migration complete. {table_name} has {rows_count} unique rows")
+
+
+##-------------------------------------------------------------------------------------------------
+@utilities_timers.timed(apiname)
+def migrate_to_instruments_table(client, table_name="minutes", is_keep_old=True):
+    """Move instrument attributes of candles table to instruments table.
+
+    Old candles tables repeat ticker, isin, name, etc. on every row.
+    Attributes are copied to instruments table (version 0, so any list
+    written by upsert_instruments replaces them), then candles are copied
+    to a table with candles_columns only (see migrate_to_replacing_merge_tree).
+    Stop loaders before migration: rows inserted during copy are lost.
+
+    Args:
+        client : clickhouse connector. Client object of clickhouse_driver.client module
+        table_name (string) : table name in Clickhouse database. "minutes" by default.
+        is_keep_old (bool) : True (default) to keep the old table as <table_name>_old.
+
+    Returns:
+        nothing
+    """
+    logger = logging.getLogger(apiname + migrate_to_instruments_table.__name__)
+
+    old_columns, _ = get_column_names_in_table(client, table_name)
+    missing = [col for col in instrument_columns if col not in old_columns]
+    if missing:
+        logger.info(f"{table_name} has no instrument columns {missing}. Exit.")
+        return
+
+    create_instruments_table(client)
+    # the latest attributes of every figi
+    attributes = ", ".join(
+        f"argMax({col}, time) AS {col}" for col in instrument_columns
+    )
+    client.execute(
+        f"INSERT INTO {instruments_table} "
+        f"SELECT figi, {attributes}, toUInt64(0) AS version "
+        f"FROM {table_name} GROUP BY figi"
+    )
+    client.execute(f"OPTIMIZE TABLE {instruments_table} FINAL")
+    client.execute(f"SYSTEM RELOAD DICTIONARY {instruments_dict}")
+    logger.info(f"instruments of {table_name} copied to {instruments_table}")
+
+    # aggregate views are rebuilt to keep figi instead of ticker
+    migrate_to_replacing_merge_tree(
+        client, table_name, is_keep_old=is_keep_old, is_instruments_copied=True
+    )
+
+
+##-------------------------------------------------------------------------------------------------
+def _quote_identifier(name):
+    """Quote table or column name. Only letters, digits and underscores are allowed,
+    optionally with a database prefix (db.table)."""
+    parts = str(name).split(".")
+    if len(parts) > 2 or not all(identifier_pattern.match(part) for part in parts):
+        raise ValueError(f"invalid identifier: {name!r}")
+    return ".".join(f"`{part}`" for part in parts)
+
+
+##-------------------------------------------------------------------------------------------------
+def _quote_string(value):
+    """String literal of value for DDL, where query parameters are not accepted."""
+    return "'" + str(value).replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+##-------------------------------------------------------------------------------------------------
+def _instrument_attribute(column):
+    """Expression reading attribute of instrument of the row from instruments_dict."""
+    return f"dictGet('{instruments_dict}', '{column}', figi)"
+
+
+##-------------------------------------------------------------------------------------------------
+def _instruments_where(startTime, endTime, instrument_type, tickers=None, figis=None):
+    """WHERE condition and its parameters of candles of instruments in time range."""
+    params = {"start": startTime, "end": endTime, "instrument_type": instrument_type}
+    # instrument attributes are not stored with candles, see create_instruments_table
+    where = (
+        "time BETWEEN %(start)s AND %(end)s "
+        f"AND {_instrument_attribute('type')} = %(instrument_type)s"
+    )
+    if tickers:
+        params["tickers"] = tuple(tickers)
+        where += f" AND {_instrument_attribute('ticker')} IN %(tickers)s"
+    if figis:
+        params["figis"] = tuple(figis)
+        where += " AND figi IN %(figis)s"
+    return where, params
+
+
+##-------------------------------------------------------------------------------------------------
+def _group_by(period):
+    """GROUP BY of OHLCV bars: period (column or expression) and instrument."""
+    dims = ["ticker", "type", "currency", "name"]
+    attributes = ", ".join(_instrument_attribute(dim) for dim in dims)
+    return f"GROUP BY {period}, {attributes}"
+
+
+##-------------------------------------------------------------------------------------------------
+def _aggregate_columns(data_freq, is_view=False):
+    """Output columns of OHLCV bars: {column name: select expression}.
+
+    is_view=False aggregates raw candles, is_view=True merges states
+    of the aggregate view. Both give the same column names.
+    """
+    _, period, expression = aggregate_views[data_freq]
+    # weekly output has no type column
+    if data_freq == "week":
+        dims = ["ticker", "currency", "name"]
+    else:
+        dims = ["ticker", "type", "currency", "name"]
+    columns = {}
+    if is_view:
+        columns["uniq(time)"] = "uniqMerge(uniq_time) AS `uniq(time)`"
+        columns["count()"] = "countMerge(cnt) AS `count()`"
+    else:
+        columns["uniq(time)"] = "uniq(time)"
+        columns["count()"] = "count()"
+    for dim in dims:
+        columns[dim] = f"{_instrument_attribute(dim)} AS {dim}"
+    if is_view:
+        columns[period] = period
+        columns["o"] = "argMinMerge(o) AS o"
+        columns["h"] = "maxMerge(h) AS h"
+        columns["l"] = "minMerge(l) AS l"
+        columns["c"] = "argMaxMerge(c) AS c"
+        columns["v"] = "sumMerge(v) AS v"
+    else:
+        columns[period] = f"{expression} AS {period}"
+        columns["o"] = "argMin(o, time) AS o"
+        columns["h"] = "max(h) AS h"
+        columns["l"] = "min(l) AS l"
+        columns["c"] = "argMax(c, time) AS c"
+        columns["v"] = "sum(v) AS v"
+    return columns
+
+
+##-------------------------------------------------------------------------------------------------
+def _state_select(table_name, data_freq, is_final=False):
+    """SELECT part of aggregation of candles table to the states stored by aggregate views.
+
+    Views keep figi, attributes of instruments are read at query time.
+    """
+    _, period, expression = aggregate_views[data_freq]
+    final = " FINAL" if is_final else ""
+    return (
+        f"SELECT {expression} AS {period}, figi, "
+        "uniqState(time) AS uniq_time, countState() AS cnt, "
+        "argMinState(o, time) AS o, maxState(h) AS h, minState(l) AS l, "
+        "argMaxState(c, time) AS c, sumState(v) AS v "
+        f"FROM {table_name}{final} "
+    )
+
+
+##-------------------------------------------------------------------------------------------------
+def _period_bounds(startTime, endTime, data_freq):
+    """Start of the first and end of the last whole period inside [startTime, endTime]."""
+    if data_freq == "hour":
+        step = timedelta(hours=1)
+        floor = lambda t: t.replace(minute=0, second=0, microsecond=0)
+    else:
+        step = timedelta(days=7 if data_freq == "week" else 1)
+        floor = lambda t: datetime.combine(
+            t.date() - timedelta(days=t.weekday() if data_freq == "week" else 0),
+            datetime.min.time(),
+        )
+    first = floor(startTime)
+    if first < startTime:
+        first = first + step
+    # BETWEEN includes endTime
+    last = floor(endTime + timedelta(seconds=1))
+    return first, last
+
+
+##-------------------------------------------------------------------------------------------------
+def build_candles_query(
+    startTime,
+    endTime,
+    table_name="minutes",
+    instrument_type="Etf",
+    data_freq="min",
+    columns=None,
+    tickers=None,
+    figis=None,
+    is_view=False,
+    is_final=False,
+):
+    """Build query of candles in time range [startTime, endTime].
+
+    Values are passed as query parameters and escaped by clickhouse_driver,
+    names of table and columns are checked and quoted, so nothing
+    from arguments is pasted into SQL as is.
+
+    Args:
+        startTime (datetime) : beginning of the time range, included.
+        endTime (datetime) : end of the time range, included.
+        table_name (string) : candles table name. "minutes" by default.
+        instrument_type (string) : Etf, Bond or Stock.
+        data_freq (string) : "min" for raw candles, "hour", "day" or "week" for OHLCV bars.
+        columns (list) : columns to return. All columns if None or empty.
+            Column names of bars are the same as in the output of query_data_by_time.
+        tickers (list) : return only these tickers. No filter if None or empty.
+        figis (list) : return only these FIGIs. No filter if None or empty.
+        is_view (bool) : read whole periods of bars from the aggregate view
+            (see create_aggregate_views). Partial periods at the range edges
+            are always aggregated from raw candles.
+        is_final (bool) : read raw candles with FINAL to skip not merged
+            duplicates. Only for ReplacingMergeTree tables (see is_replacing_table).
+
+    Returns:
+        query (string) : query with %(name)s placeholders.
+        params (dict) : values of placeholders. Pass both to client.execute().
+    """
+    if columns is not None:
+        columns = [col for col in columns if col != "*"]
+    where, params = _instruments_where(
+        startTime, endTime, instrument_type, tickers, figis
+    )
+    table = _quote_identifier(table_name)
+    if is_final:
+        table += " FINAL"
+
+    if data_freq == "min":
+        if not columns:
+            columns = candles_output_columns + instrument_columns
+        select = ", ".join(
+            (
+                f"{_instrument_attribute(col)} AS {col}"
+                if col in instrument_columns
+                else _quote_identifier(col)
+            )
+            for col in columns
+        )
+        return f"SELECT {select} FROM {table} WHERE {where}", params
+
+    view_suffix, period, expression = aggregate_views[data_freq]
+    raw_columns = _aggregate_columns(data_freq)
+    if not columns:
+        columns = list(raw_columns)
+    unknown = [col for col in columns if col not in raw_columns]
+    if unknown:
+        raise ValueError(f"unknown columns of {data_freq} bars: {unknown}")
+    # ordering by period requires it in the output of union
+    order_by = f"ORDER BY {period} desc" if period in columns else ""
+    raw_select = "SELECT " + ", ".join(raw_columns[col] for col in columns)
+
+    raw_group_by = _group_by(expression)
+
+    first, last = _period_bounds(startTime, endTime, data_freq)
+    if not is_view or first >= last:
+        query = f"{raw_select} FROM {table} WHERE {where} {raw_group_by} {order_by}"
+        return query.strip(), params
+
+    params["first_time"] = first
+    params["last_time"] = last
+    if data_freq != "hour":
+        # day and monday are Date columns
+        first, last = first.date(), last.date()
+    params["first"] = first
+    params["last"] = last
+    view_columns = _aggregate_columns(data_freq, is_view=True)
+    view_select = "SELECT " + ", ".join(view_columns[col] for col in columns)
+    view_where = where.replace(
+        "time BETWEEN %(start)s AND %(end)s",
+        f"{period} >= %(first)s AND {period} < %(last)s",
+    )
+    view = _quote_identifier(f"{table_name}_{view_suffix}")
+    edges_where = f"{where} AND (time < %(first_time)s OR time >= %(last_time)s)"
+    query = (
+        f"SELECT * FROM ({view_select} FROM {view} WHERE {view_where} "
+        f"{_group_by(period)} "
+        f"UNION ALL {raw_select} FROM {table} WHERE {edges_where} {raw_group_by}) "
+        f"{order_by}"
+    )
+    return query.strip(), params
 
-    logger.info("new data written to table 'minutes'")
+
+##-------------------------------------------------------------------------------------------------
+def get_aggregate_views(client, table_name="minutes"):
+    """Find aggregate views of candles table (see create_aggregate_views).
+
+    Args:
+        client : clickhouse connector. Client object of clickhouse_driver.client module
+        table_name (string) : candles table name. "minutes" by default.
+
+    Returns:
+        views (dict) : {data_freq: view table name} of views that exist.
+    """
+    names = {}
+    for data_freq, (view_suffix, _, _) in aggregate_views.items():
+        names[data_freq] = f"{table_name}_{view_suffix}"
+    candidates = list(names.values()) + [name + "_mv" for name in names.values()]
+    existing = client.execute(
+        "SELECT name FROM system.tables "
+        "WHERE database = currentDatabase() AND name IN %(names)s",
+        {"names": tuple(candidates)},
+    )
+    existing = set(row[0] for row in existing)
+    # view table without its materialized view is not maintained any more
+    return {
+        data_freq: name
+        for data_freq, name in names.items()
+        if name in existing and name + "_mv" in existing
+    }
+
+
+##-------------------------------------------------------------------------------------------------
+@utilities_timers.timed(apiname)
+def create_aggregate_views(client, table_name="minutes", freqs=("day", "week")):
+    """Create pre-aggregated OHLCV bars of candles table.
+
+    For every period a <table_name>_<daily|weekly|hourly> AggregatingMergeTree table
+    is created and filled from existing candles, and materialized view
+    <table_name>_<...>_mv keeps it updated on every insert to table_name.
+    query_data_by_time reads "day", "week" and "hour" data from these tables
+    when they exist.
+    Stop loaders while views are created: rows inserted in between are missed.
+    Views aggregate rows as inserted, so candles inserted twice are counted twice
+    until refresh_aggregate_views is called (upsert_df_to_SQL_table with
+    is_optimize=True does it).
+
+    Args:
+        client : clickhouse connector. Client object of clickhouse_driver.client module
+        table_name (string) : candles table name. "minutes" by default.
+        freqs (tuple) : periods to create views for: "day", "week", "hour".
+            Daily and weekly by default.
+
+    Returns:
+        nothing
+    """
+    logger = logging.getLogger(apiname + create_aggregate_views.__name__)
+
+    existing = get_aggregate_views(client, table_name)
+    for data_freq in freqs:
+        view_suffix, period, _ = aggregate_views[data_freq]
+        view = f"{table_name}_{view_suffix}"
+        if data_freq in existing:
+            logger.info(f"{view} already exists")
+            continue
+        state_select = _state_select(table_name, data_freq) + f"GROUP BY {period}, figi"
+        client.execute(f"DROP TABLE IF EXISTS {view}")
+        client.execute(
+            f"CREATE TABLE {view} "
+            "ENGINE = AggregatingMergeTree() "
+            f"PARTITION BY toYYYYMM({period}) "
+            f"ORDER BY ({period}, figi) "
+            f"AS {state_select}"
+        )
+        client.execute(
+            f"CREATE MATERIALIZED VIEW IF NOT EXISTS {view}_mv TO {view} "
+            f"AS {state_select}"
+        )
+        logger.info(f"created {view}")
+
+
+##-------------------------------------------------------------------------------------------------
+def drop_aggregate_views(client, table_name="minutes"):
+    """Drop all aggregate views of candles table (see create_aggregate_views)."""
+    for view_suffix, _, _ in aggregate_views.values():
+        client.execute(f"DROP TABLE IF EXISTS {table_name}_{view_suffix}_mv")
+        client.execute(f"DROP TABLE IF EXISTS {table_name}_{view_suffix}")
+
+
+##-------------------------------------------------------------------------------------------------
+@utilities_timers.timed(apiname)
+def refresh_aggregate_views(client, table_name="minutes", months=None):
+    """Rebuild aggregate views from deduplicated candles (FINAL).
+
+    Views count every inserted row, including candles inserted again
+    before ReplacingMergeTree removed duplicates. Rebuild puts views
+    back in line with the deduplicated table.
+
+    Args:
+        client : clickhouse connector. Client object of clickhouse_driver.client module
+        table_name (string) : candles table name. "minutes" by default.
+        months (list) : "YYYYMM" partitions of table_name to rebuild views for.
+            All data by default.
+
+    Returns:
+        nothing
+    """
+    logger = logging.getLogger(apiname + refresh_aggregate_views.__name__)
+
+    views = get_aggregate_views(client, table_name)
+    for data_freq, view in views.items():
+        _, period, expression = aggregate_views[data_freq]
+        group_by = f"GROUP BY {period}, figi"
+        insert = f"INSERT INTO {view} " + _state_select(
+            table_name, data_freq, is_final=True
+        )
+        if months is None:
+            client.execute(f"TRUNCATE TABLE {view}")
+            client.execute(insert + group_by)
+            continue
+
+        partitions = set()
+        for month in months:
+            month_start = datetime.strptime(str(month), "%Y%m")
+            partitions.add(month_start.strftime("%Y%m"))
+            if data_freq == "week":
+                # week of the first days of month starts in the previous month
+                monday = month_start - timedelta(days=month_start.weekday())
+                partitions.add(monday.strftime("%Y%m"))
+        for partition in sorted(partitions):
+            client.execute(f"ALTER TABLE {view} DROP PARTITION {partition}")
+            # time range limits the scan to a few partitions of table_name
+            month_start = f"toDate('{partition[:4]}-{partition[4:]}-01')"
+            client.execute(
+                insert
+                + f"WHERE toYYYYMM({expression}) = {partition} "
+                + f"AND time >= {month_start} "
+                + f"AND time < addDays(addMonths({month_start}, 1), 7) "
+                + group_by
+            )
+        logger.info(f"rebuilt {view} partitions {sorted(partitions)}")
 
 
 ##-----------------------------------------------------------------------------
@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 18:31:09 2026
+
+@author: SParkhonyuk
+"""
+# Resumable download of long histories. Requests are planned once and kept
+# in a local SQLite file with the requested range. Candles are written to
+# Clickhouse batch by batch, and every (figi, interval, window) request written
+# is recorded there. A restarted job downloads only the planned requests not
+# written yet.
+import os
+import sqlite3
+import threading
+import logging
+import logging.config
+from datetime import datetime
+import time
+
+import pandas as pd
+from dotenv import load_dotenv, find_dotenv
+
+# in-house
+import ClickhouseHelper as chh
+import instrument_cache
+import metrics
+import pipeline
+import tinkoffAPIHelper as tapi
+import utilities_timers
+
+apiname = "Backfill::"
+
+
+##-------------------------------------------------------------------------------------------------
+class Checkpoint:
+    """
+    Planned backfill requests and their completion state in a local SQLite file.
+
+    Requests of every instrument are planned once (see tinkoffAPIHelper.plan_requests,
+    windows depend on the daily probe) and stored with the requested range,
+    so a restarted backfill gets the same requests.
+    A request (figi, interval, window) is marked done only after its candles
+    are written to Clickhouse, so after a crash it is downloaded again.
+    Writes are idempotent (see ClickhouseHelper.upsert_df_to_SQL_table),
+    therefore a request written but not marked does no harm.
+
+    Parameters
+    ----------
+    path : string
+        SQLite file. The default is BACKFILL_CHECKPOINT environment variable
+        or data/interim/backfill.sqlite of this repository.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.environ.get(
+                "BACKFILL_CHECKPOINT",
+                os.path.join(
+                    os.path.dirname(os.path.abspath(__file__)),
+                    "..",
+                    "..",
+                    "data",
+                    "interim",
+                    "backfill.sqlite",
+                ),
+            )
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS windows ("
+                "figi TEXT, interval TEXT, window_from TEXT, window_to TEXT, "
+                "rows INTEGER, completed_at TEXT, "
+                "PRIMARY KEY (figi, interval, window_from, window_to))"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS ranges ("
+                "interval TEXT PRIMARY KEY, range_from TEXT, range_to TEXT, "
+                "created_at TEXT)"
+            )
+            # FIGIs with planned requests, including the ones without any
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS planned_figis ("
+                "figi TEXT, interval TEXT, planned_at TEXT, "
+                "PRIMARY KEY (figi, interval))"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS planned ("
+                "figi TEXT, interval TEXT, window_from TEXT, window_to TEXT, "
+                "PRIMARY KEY (figi, interval, window_from, window_to))"
+            )
+
+    def check_range(self, interval, _from, to):
+        """
+        Records the range of interval backfill on the first run.
+        Raises ValueError if the checkpoint holds another range: planned
+        and written requests of it do not match the new one.
+        """
+        range_from = _from.isoformat()
+        range_to = to.isoformat()
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT range_from, range_to FROM ranges WHERE interval = ?",
+                (interval,),
+            ).fetchone()
+            if row is None:
+                self._db.execute(
+                    "INSERT INTO ranges VALUES (?, ?, ?, ?)",
+                    (
+                        interval,
+                        range_from,
+                        range_to,
+                        datetime.now().isoformat(timespec="seconds"),
+                    ),
+                )
+            elif row != (range_from, range_to):
+                raise ValueError(
+                    f"checkpoint {self.path} holds {interval} backfill of "
+                    f"[{row[0]}, {row[1]}], not [{range_from}, {range_to}]. "
+                    "Use another checkpoint file or reset() it"
+                )
+
+    def planned_figis(self, interval):
+        """Set of FIGIs with planned requests of interval."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT figi FROM planned_figis WHERE interval = ?", (interval,)
+            ).fetchall()
+        return set(row[0] for row in rows)
+
+    def planned_tasks(self, interval):
+        """List of planned (figi, _from, to) requests of interval."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT figi, window_from, window_to FROM planned "
+                "WHERE interval = ? ORDER BY figi, window_from",
+                (interval,),
+            ).fetchall()
+        return rows
+
+    def add_planned(self, figis, tasks, interval):
+        """
+        Records planned requests.
+
+        Parameters
+        ----------
+        figis : iterable
+            FIGIs the requests are planned for.
+        tasks : list of tuples (figi, _from, to)
+        interval : str
+        """
+        planned_at = datetime.now().isoformat(timespec="seconds")
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO planned VALUES (?, ?, ?, ?)",
+                [(figi, interval, _from, to) for figi, _from, to in tasks],
+            )
+            self._db.executemany(
+                "INSERT OR REPLACE INTO planned_figis VALUES (?, ?, ?)",
+                [(figi, interval, planned_at) for figi in figis],
+            )
+
+    def reset(self, interval):
+        """Forgets range, planned and written requests of interval."""
+        with self._lock, self._db:
+            for table in ["windows", "ranges", "planned_figis", "planned"]:
+                self._db.execute(f"DELETE FROM {table} WHERE interval = ?", (interval,))
+
+    def done_tasks(self, interval):
+        """Set of (figi, _from, to) requests of interval already written."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT figi, window_from, window_to FROM windows WHERE interval = ?",
+                (interval,),
+            ).fetchall()
+        return set(rows)
+
+    def mark_done(self, tasks, interval):
+        """
+        Records requests as written.
+
+        Parameters
+        ----------
+        tasks : list of tuples (figi, _from, to, rows)
+        interval : str
+        """
+        completed_at = datetime.now().isoformat(timespec="seconds")
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO windows VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (figi, interval, _from, to, rows, completed_at)
+                    for figi, _from, to, rows in tasks
+                ],
+            )
+
+    def summary(self):
+        """Dataframe with number of written requests and rows per interval."""
+        with self._lock:
+            return pd.read_sql_query(
+                "SELECT interval, count(*) AS requests, sum(rows) AS rows "
+                "FROM windows GROUP BY interval",
+                self._db,
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+##-------------------------------------------------------------------------------------------------
+def run_backfill(
+    con,
+    instruments,
+    _from,
+    to,
+    interval="1min",
+    server_ip="localhost",
+    table_name=None,
+    checkpoint=None,
+    max_workers=8,
+    limiter=None,
+    is_probe_days=True,
+):
+    """
+    Downloads candles of instruments in [_from, to] and writes them to Clickhouse
+    in batches while the download goes on (see pipeline.download_to_clickhouse).
+    Memory use does not depend on the length of history.
+
+    Requests are planned once and kept in checkpoint. Requests written by
+    previous runs are skipped, so a failed or interrupted backfill is continued
+    by running it again with the same _from and to (ValueError for another
+    range, see Checkpoint.check_range). Instruments listed since
+    the previous run are planned and added.
+    Failed requests are not marked and are retried by the next run.
+
+    Parameters
+    ----------
+    con(connector) : TinkoffAPI connector. Create one using tinkoffAPIHelper.connect()
+    instruments : Pandas dataframe
+        Versioned instruments from instrument_cache.InstrumentCache.load().
+        Written to instruments table, see ClickhouseHelper.upsert_instruments().
+    _from, to : datetime
+        Time range of the backfill.
+    interval : str
+        Candles interval. The default is "1min".
+    server_ip : string
+        ip adress of Clickhouse instance. localhost by default.
+    table_name : string, optional
+        Target table. The default is the table of interval, see ClickhouseHelper.interval_table().
+    checkpoint : Checkpoint, optional
+        The default is Checkpoint() with default file.
+    max_workers : int
+        Number of download threads. The default is 8.
+    limiter : rate_limiter.TokenBucket, optional
+        The default is shared limiter of the process.
+    is_probe_days : bool
+        Skip days without trades, see tinkoffAPIHelper.plan_requests(). The default is True.
+
+    Returns
+    -------
+    n_failed : int
+        Number of failed requests. 0 if the backfill is complete.
+    """
+    start = time.time()
+    logger = logging.getLogger(apiname + run_backfill.__name__)
+
+    if table_name is None:
+        table_name = chh.interval_table(interval)
+    if checkpoint is None:
+        checkpoint = Checkpoint()
+
+    checkpoint.check_range(interval, _from, to)
+    with chh.get_pool(server_ip).connection() as ch_con:
+        chh.upsert_instruments(ch_con, instruments)
+    ranges = {figi: (_from, to) for figi in instruments.figi.unique()}
+
+    planned_figis = checkpoint.planned_figis(interval)
+    new_ranges = {
+        figi: figi_range
+        for figi, figi_range in ranges.items()
+        if figi not in planned_figis
+    }
+    if new_ranges:
+        new_tasks = tapi.plan_requests(
+            con,
+            new_ranges,
+            interval=interval,
+            max_workers=max_workers,
+            limiter=limiter,
+            is_probe_days=is_probe_days,
+        )
+        checkpoint.add_planned(new_ranges, new_tasks, interval)
+    # requests of instruments not in the list any more are not downloaded
+    tasks = [task for task in checkpoint.planned_tasks(interval) if task[0] in ranges]
+    done = checkpoint.done_tasks(interval)
+    logger.info(
+        f"{len(tasks)} requests planned, {len(planned_figis)} FIGIs planned "
+        f"and {len(done)} requests done by previous runs"
+    )
+
+    def on_written(written):
+        checkpoint.mark_done(
+            [(figi, w_from, w_to, rows) for (figi, w_from, w_to), rows in written],
+            interval,
+        )
+
+    failed = pipeline.download_to_clickhouse(
+        con,
+        ranges,
+        interval=interval,
+        server_ip=server_ip,
+        table_name=table_name,
+        max_workers=max_workers,
+        limiter=limiter,
+        is_probe_days=is_probe_days,
+        skip=done,
+        on_written=on_written,
+        tasks=tasks,
+    )
+    n_failed = len(failed)
+    if n_failed > 0:
+        logger.error(f"{n_failed} requests failed, run backfill again to retry them")
+    timer_string = utilities_timers.format_timer_string(time.time() - start)
+    logger.info(timer_string)
+    return n_failed
+
+
+##-------------------------------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    logging.config.fileConfig(fname="logger.conf", disable_existing_loggers=False)
+    logger = logging.getLogger(__name__)
+
+    logger.info("Backfill main")
+    load_dotenv(find_dotenv())
+    token = os.environ.get("APIKEY_SANDBOX")
+    server_adress = os.environ.get("CLICKHOUSE_SERVER_ADRESS", "192.168.1.128")
+    # range must stay the same between restarts of one backfill
+    backfill_from = datetime.strptime(
+        os.environ.get("BACKFILL_FROM", "2018-01-01"), "%Y-%m-%d"
+    )
+    backfill_to = datetime.strptime(
+        os.environ.get("BACKFILL_TO", "2020-01-01"), "%Y-%m-%d"
+    )
+    intervals = os.environ.get("TINKOFF_INTERVALS", "1min").split(",")
+
+    con, _ = tapi.connect(token)
+    instruments = instrument_cache.InstrumentCache().load(con)
+    if instruments is None:
+        logger.error("no instrument list, nothing to backfill")
+        raise SystemExit(1)
+    checkpoint = Checkpoint()
+    # metrics are written to METRICS_PROMETHEUS_FILE / METRICS_JSONL_FILE,
+    # PROFILE_RUN=cprofile or pyinstrument profiles the whole run
+    with utilities_timers.RunProfiler(), metrics.Exporter():
+        for interval in intervals:
+            run_backfill(
+                con,
+                instruments,
+                backfill_from,
+                backfill_to,
+                interval=interval,
+                server_ip=server_adress,
+                checkpoint=checkpoint,
+                max_workers=int(os.environ.get("TINKOFF_MAX_WORKERS", 8)),
+            )
+    logger.info(f"\n{checkpoint.summary().to_string()}")
+    checkpoint.close()
+    chh.get_pool(server_adress).close()
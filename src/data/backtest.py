@@ -0,0 +1,427 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 22:31:57 2026
+
+@author: SParkhonyuk
+"""
+# Vectorized backtests over Clickhouse history. Strategies turn prices into
+# positions in whole lots with array operations, run_backtest() turns positions
+# into PnL with commission and slippage in price increments. sweep() evaluates
+# a grid of strategy parameters in a process pool.
+import itertools
+import logging
+import logging.config
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# in-house
+import ClickhouseHelper as chh
+import panel as panel_builder
+import rolling_stats
+import utilities_timers
+
+apiname = "Backtest::"
+# broker commission, share of traded value
+default_commission = 0.0005
+# price increments lost on every trade (half of bid-ask spread and impact)
+default_slippage_ticks = 1
+# money per position of a strategy, in currency of instruments
+default_notional = 100000.0
+# rolling statistics kept by Market.cached(), per market
+max_cached = 16
+# market shared by pool workers, see _init_worker()
+_worker_market = None
+
+
+##-------------------------------------------------------------------------------------------------
+class Market:
+    """
+    Prices of instruments on one time grid with their trading parameters.
+
+    Parameters
+    ----------
+    prices : numpy array, bars x instruments. nan before the first price.
+    lot : array of int
+        Shares in one lot of every instrument.
+    min_price_increment : array of float
+        Price tick of every instrument.
+    index : pd.Index, optional
+        Times of bars.
+    columns : pd.Index, optional
+        Tickers.
+    """
+
+    def __init__(self, prices, lot, min_price_increment, index=None, columns=None):
+        self.prices = np.asarray(prices, dtype=np.float64)
+        self.lot = np.asarray(lot, dtype=np.float64)
+        self.min_price_increment = np.asarray(min_price_increment, dtype=np.float64)
+        self.index = pd.RangeIndex(len(self.prices)) if index is None else index
+        self.columns = (
+            pd.RangeIndex(self.prices.shape[1]) if columns is None else columns
+        )
+        self._cache = {}
+
+    @classmethod
+    def from_panel(cls, panel, instruments, field="c"):
+        """
+        Market of panel.Panel with ticker columns.
+
+        instruments is dataframe with ticker, lot and min_price_increment,
+        e.g. of ClickhouseHelper.get_instruments().
+        """
+        specs = instruments.drop_duplicates("ticker").set_index("ticker")
+        specs = specs.reindex(panel.columns)
+        return cls(
+            panel[field],
+            specs.lot.to_numpy(),
+            specs.min_price_increment.to_numpy(),
+            index=panel.index,
+            columns=panel.columns,
+        )
+
+    def select(self, tickers):
+        """Market of some instruments, e.g. of a pair (y, x)."""
+        cols = self.columns.get_indexer(tickers)
+        return Market(
+            self.prices[:, cols],
+            self.lot[cols],
+            self.min_price_increment[cols],
+            index=self.index,
+            columns=self.columns[cols],
+        )
+
+    def cached(self, key, func):
+        """Result of func() computed once per key, e.g. rolling statistics of a window."""
+        if key not in self._cache:
+            if len(self._cache) >= max_cached:
+                del self._cache[next(iter(self._cache))]
+            self._cache[key] = func()
+        return self._cache[key]
+
+
+##-------------------------------------------------------------------------------------------------
+def load_market(
+    tickers,
+    startTime=None,
+    endTime=None,
+    days_span=365,
+    data_freq="min",
+    server_ip="localhost",
+    instrument_type="Stock",
+):
+    """
+    Loads close prices of tickers by ClickhouseHelper.query_data_by_time (streamed)
+    and their lot and min_price_increment.
+
+    Returns
+    -------
+    market : Market. None if there is no data.
+    """
+    start = time.time()
+    logger = logging.getLogger(apiname + load_market.__name__)
+
+    period = "time" if data_freq == "min" else chh.aggregate_views[data_freq][1]
+    chunks = chh.query_data_by_time(
+        channels_list=[period, "ticker", "c"],
+        startTime=startTime,
+        endTime=endTime,
+        days_span=days_span,
+        server_ip=server_ip,
+        instrument_type=instrument_type,
+        data_freq=data_freq,
+        chunk_size=chh.query_chunk_size,
+        tickers=tickers,
+    )
+    prices = panel_builder.build_panel(chunks, fields=["c"])
+    if prices is None:
+        logger.error(f"no {data_freq} bars of {tickers}")
+        return None
+    with chh.get_pool(server_ip).connection() as con:
+        instruments = chh.get_instruments(con, tickers=list(prices.columns))
+    market = Market.from_panel(prices, instruments)
+
+    timer_string = utilities_timers.format_timer_string(time.time() - start)
+    logger.info(timer_string)
+    logger.info(f"{len(market.index)} bars of {len(market.columns)} instruments")
+    return market
+
+
+##-------------------------------------------------------------------------------------------------
+def _forward_fill(values):
+    """Forward fill of nan along bars of 2D array, vectorized; leading nan become 0."""
+    rows = np.arange(values.shape[0])[:, None]
+    last = np.where(np.isnan(values), 0, rows)
+    np.maximum.accumulate(last, axis=0, out=last)
+    filled = np.take_along_axis(values, last, axis=0)
+    return np.nan_to_num(filled)
+
+
+def hysteresis(zscore, entry=2.0, exit=0.5):
+    """
+    Side of mean reversion position by z-score: -1 after z-score rises above entry,
+    +1 after it falls below -entry, 0 after it comes back inside +-exit.
+    The side is kept in between. 0 where z-score is nan.
+    """
+    signal = np.full(zscore.shape, np.nan)
+    with np.errstate(invalid="ignore"):
+        signal[np.abs(zscore) <= exit] = 0.0
+        signal[zscore >= entry] = -1.0
+        signal[zscore <= -entry] = 1.0
+    signal[np.isnan(zscore)] = 0.0
+    return _forward_fill(signal)
+
+
+def _hold_from_entry(side, units):
+    """Units of position fixed at the bar where side has changed, kept until next change."""
+    rows = np.arange(side.shape[0])[:, None]
+    is_change = np.diff(side, axis=0, prepend=0.0) != 0
+    entry_row = np.where(is_change, rows, 0)
+    np.maximum.accumulate(entry_row, axis=0, out=entry_row)
+    return np.take_along_axis(units, entry_row, axis=0)
+
+
+def to_lots(units, lot):
+    """Shares to whole lots, rounded towards zero."""
+    return np.trunc(np.nan_to_num(units) / lot)
+
+
+##-------------------------------------------------------------------------------------------------
+def pair_strategy(
+    market,
+    window=rolling_stats.default_window,
+    entry=2.0,
+    exit=0.5,
+    notional=default_notional,
+):
+    """
+    Mean reversion of spread y - beta * x of the pair of market columns (y, x),
+    with rolling hedge ratio and z-score (see rolling_stats.rolling_regression).
+    At entry notional is split to 1 share of y per beta shares of x.
+
+    Returns
+    -------
+    positions : numpy array of lots, bars x 2.
+    """
+    prices = market.prices
+    beta, _, zscore = market.cached(
+        ("pair", window),
+        lambda: rolling_stats.rolling_regression(
+            prices[:, :1], prices[:, 1:], window=window
+        ),
+    )
+    side = hysteresis(zscore, entry, exit)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        shares = notional / (prices[:, :1] + np.abs(beta) * prices[:, 1:])
+    units = np.hstack([shares, -beta * shares])
+    side = np.hstack([side, side])
+    units = _hold_from_entry(side, np.nan_to_num(units))
+    return to_lots(units * side, market.lot)
+
+
+def mean_reversion_strategy(
+    market,
+    window=rolling_stats.default_window,
+    entry=2.0,
+    exit=0.5,
+    notional=default_notional,
+):
+    """
+    Mean reversion of every instrument of market by z-score of its price
+    (see rolling_stats.rolling_moments), notional per instrument.
+
+    Returns
+    -------
+    positions : numpy array of lots, bars x instruments.
+    """
+    prices = market.prices
+    _, _, zscore = market.cached(
+        ("moments", window),
+        lambda: rolling_stats.rolling_moments(prices, window=window),
+    )
+    side = hysteresis(zscore, entry, exit)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        units = _hold_from_entry(side, np.nan_to_num(notional / prices))
+    return to_lots(units * side, market.lot)
+
+
+##-------------------------------------------------------------------------------------------------
+def run_backtest(
+    market,
+    positions,
+    commission=default_commission,
+    slippage_ticks=default_slippage_ticks,
+    delay=1,
+):
+    """
+    PnL of positions, vectorized over bars and instruments.
+
+    Position of bar t is decided on close of bar t and traded on close of bar
+    t + delay. Every trade pays commission of its value and slippage_ticks price
+    increments per share. PnL is in currency of instruments, summed over them.
+
+    Parameters
+    ----------
+    market : Market
+    positions : numpy array of lots, bars x instruments.
+    commission : float
+        Share of traded value. The default is default_commission.
+    slippage_ticks : float
+        Price increments per traded share. The default is default_slippage_ticks.
+    delay : int
+        Bars between decision and trade. The default is 1, 0 trades on the close
+        the decision is based on.
+
+    Returns
+    -------
+    result : Pandas dataframe indexed by bars: pnl (net), costs, trades (number
+        of instruments traded), equity (cumulative pnl).
+    """
+    lots = np.nan_to_num(np.asarray(positions, dtype=np.float64))
+    if delay > 0:
+        lots = np.vstack([np.zeros((delay, lots.shape[1])), lots[:-delay]])
+    prices = market.prices
+    # no trades without price
+    lots[np.isnan(prices)] = 0.0
+    units = lots * market.lot
+
+    price_change = np.nan_to_num(np.diff(prices, axis=0))
+    gross = np.zeros(units.shape)
+    gross[1:] = units[:-1] * price_change
+    traded = np.abs(np.diff(units, axis=0, prepend=0.0))
+    costs = traded * (
+        np.nan_to_num(prices) * commission + slippage_ticks * market.min_price_increment
+    )
+    pnl = (gross - costs).sum(axis=1)
+    return pd.DataFrame(
+        {
+            "pnl": pnl,
+            "costs": costs.sum(axis=1),
+            "trades": (traded > 0).sum(axis=1),
+            "equity": np.cumsum(pnl),
+        },
+        index=market.index,
+    )
+
+
+def summary(result, periods_per_year=252):
+    """
+    Performance of run_backtest() result: pnl, costs, n_trades, sharpe
+    (of daily pnl if bars have times, otherwise of bar pnl) and max_drawdown.
+    """
+    pnl = result.pnl
+    if isinstance(result.index, pd.DatetimeIndex):
+        pnl = pnl.groupby(result.index.normalize()).sum()
+    std = pnl.std()
+    equity = result.equity
+    return {
+        "pnl": equity.iloc[-1] if len(equity) else 0.0,
+        "costs": result.costs.sum(),
+        "n_trades": int(result.trades.sum()),
+        "sharpe": pnl.mean() / std * np.sqrt(periods_per_year) if std > 0 else np.nan,
+        "max_drawdown": (equity.cummax() - equity).max() if len(equity) else 0.0,
+    }
+
+
+##-------------------------------------------------------------------------------------------------
+def parameter_grid(grid):
+    """List of parameter sets of {name: list of values}, all combinations."""
+    names = list(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*grid.values())]
+
+
+def _init_worker(market):
+    global _worker_market
+    _worker_market = market
+
+
+def _run_chunk(strategy, params_list, costs):
+    """Backtests of parameter sets on the market of the worker."""
+    results = []
+    for params in params_list:
+        positions = strategy(_worker_market, **params)
+        result = run_backtest(_worker_market, positions, **costs)
+        results.append({**params, **summary(result)})
+    return results
+
+
+def sweep(market, strategy, grid, max_workers=None, chunk_size=20, **costs):
+    """
+    Backtests of strategy with every parameter set of grid, in a process pool.
+
+    Parameters
+    ----------
+    market : Market
+        Sent to every worker once.
+    strategy : function (market, **params) -> positions
+        Module level function (it is pickled), e.g. pair_strategy.
+    grid : dict or list
+        {name: list of values} for all combinations or list of parameter dicts.
+    max_workers : int, optional
+        Number of processes. The default is number of CPUs. 1 to run in this process.
+    chunk_size : int
+        Parameter sets per task. Sets of a task share cached rolling statistics.
+        The default is 20.
+    **costs :
+        commission, slippage_ticks, delay of run_backtest().
+
+    Returns
+    -------
+    df : Pandas dataframe with parameters and summary() of every set,
+        sorted by sharpe, the best first.
+    """
+    start = time.time()
+    logger = logging.getLogger(apiname + sweep.__name__)
+
+    params_list = parameter_grid(grid) if isinstance(grid, dict) else list(grid)
+    chunks = [
+        params_list[chunk_start : chunk_start + chunk_size]
+        for chunk_start in range(0, len(params_list), chunk_size)
+    ]
+    logger.info(
+        f"{len(params_list)} parameter sets of {strategy.__name__} on "
+        f"{len(market.index)} bars x {len(market.columns)} instruments"
+    )
+    if max_workers == 1 or len(chunks) <= 1:
+        _init_worker(market)
+        results = [_run_chunk(strategy, chunk, costs) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=max_workers, initializer=_init_worker, initargs=(market,)
+        ) as executor:
+            results = list(
+                executor.map(
+                    _run_chunk,
+                    [strategy] * len(chunks),
+                    chunks,
+                    [costs] * len(chunks),
+                )
+            )
+    df = pd.DataFrame([row for chunk in results for row in chunk])
+    if len(df) > 0:
+        df = df.sort_values("sharpe", ascending=False, kind="stable")
+        df = df.reset_index(drop=True)
+
+    timer_string = utilities_timers.format_timer_string(time.time() - start)
+    logger.info(timer_string)
+    return df
+
+
+##-------------------------------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    logging.config.fileConfig(fname="logger.conf", disable_existing_loggers=False)
+    logger = logging.getLogger(__name__)
+
+    logger.info("Backtest main")
+
+    market = load_market(["SBER", "SBERP"], days_span=365, server_ip="192.168.1.128")
+    grid = {
+        "window": [120, 390, 780, 1560],
+        "entry": [1.5, 2.0, 2.5, 3.0],
+        "exit": [0.0, 0.5, 1.0],
+    }
+    df = sweep(market, pair_strategy, grid)
+    logger.info(f"\n{df.head(20).to_string()}")
@@ -0,0 +1,789 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 09:41:27 2026
+
+@author: SParkhonyuk
+"""
+# Benchmarks of ClickhouseHelper against a Clickhouse instance and of the
+# download pipeline against fake_tinkoff_api. Every case runs in a separate
+# process, so peak memory of one case does not affect the others.
+# Use a local server, e.g. docker run -p 9000:9000 clickhouse/clickhouse-server:
+# benchmarks create and drop their own tables, synthetic instruments of
+# benchmark_aggregates go to bench_instruments table, not to the real one.
+# Results of every run are appended to results_file, load_results() shows
+# them over time.
+import os
+import json
+import platform
+import logging
+import logging.config
+import multiprocessing
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+# in-house
+import ClickhouseHelper as chh
+import fake_tinkoff_api
+import metrics
+import pipeline
+import rate_limiter
+import tinkoffAPIHelper as tapi
+import utilities_timers
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+apiname = "Benchmark::"
+# schema of candles tables before compact types and codecs, baseline of benchmark_schema()
+plain_candles_columns = (
+    "day Date DEFAULT toDate(time), figi String, interval String, "
+    "o Float64, c Float64, h Float64, l Float64, v Int64, time DateTime"
+)
+# typical reads of candles tables, timed by benchmark_schema()
+scan_queries = {
+    "daily_bars": (
+        "SELECT figi, toDate(time) AS period, argMin(o, time), max(h), min(l), "
+        "argMax(c, time), sum(v) FROM {table} GROUP BY figi, period"
+    ),
+    "one_figi_month": (
+        "SELECT time, o, c, h, l, v FROM {table} "
+        "WHERE figi = %(figi)s AND time BETWEEN %(start)s AND %(end)s"
+    ),
+    "full_scan": "SELECT count(), sum(v), avg(c), max(h), min(l) FROM {table}",
+}
+# one JSON line per benchmark run
+results_file = "benchmark_results.jsonl"
+# instruments table and dictionary of synthetic instruments, see benchmark_aggregates()
+bench_instruments = ("bench_instruments", "bench_instruments_dict")
+# end of downloaded range, fixed so that runs request the same candles
+download_end = datetime(2020, 3, 2, 19, 0)
+
+
+##-------------------------------------------------------------------------------------------------
+def make_synthetic_candles(n_rows=1000000, n_figi=2000, start=datetime(2020, 1, 1)):
+    """
+    Generates dataframe shaped as output of tinkoffAPIHelper.get_detailed_data().
+
+    Parameters
+    ----------
+    n_rows : int
+        Number of rows. The default is 1 000 000.
+    n_figi : int
+        Number of instruments. Rows are split evenly between them. The default is 2000.
+    start : datetime
+        Time of the first candle.
+
+    Returns
+    -------
+    df : Pandas dataframe with minute candles.
+    """
+    rng = np.random.default_rng(0)
+    per_figi = int(np.ceil(n_rows / n_figi))
+    figi_idx = np.arange(n_rows) // per_figi
+    minute_idx = np.arange(n_rows) % per_figi
+    figis = np.array([f"BBG{i:09d}" for i in range(n_figi)], dtype=object)
+    tickers = np.array([f"TCK{i}" for i in range(n_figi)], dtype=object)
+    types = np.array(["Etf", "Bond", "Stock"], dtype=object)
+
+    # prices are on a grid of min_price_increment
+    c = np.round(100 + rng.standard_normal(n_rows).cumsum() * 0.01, 2)
+    df = pd.DataFrame(
+        {
+            "figi": figis[figi_idx],
+            "interval": "1min",
+            "o": np.round(c + rng.standard_normal(n_rows) * 0.01, 2),
+            "c": c,
+            "h": c + 0.05,
+            "l": c - 0.05,
+            "v": rng.integers(1, 1000, n_rows),
+            "time": pd.Timestamp(start) + pd.to_timedelta(minute_idx, unit="min"),
+            "ticker": tickers[figi_idx],
+            "isin": figis[figi_idx],
+            "min_price_increment": 0.01,
+            "lot": 1,
+            "currency": "USD",
+            "name": tickers[figi_idx],
+            "type": types[figi_idx % 3],
+        }
+    )
+    return df
+
+
+##-------------------------------------------------------------------------------------------------
+def _peak_rss_mb():
+    """Peak resident memory of current process, MB. None if not available."""
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+##-------------------------------------------------------------------------------------------------
+def _run_insert_case(server_ip, table_name, n_rows, is_columnar, chunk_size, queue):
+    """Single insert measurement. Executed in a child process."""
+    df = make_synthetic_candles(n_rows)
+    rss_before = _peak_rss_mb()
+    con, _ = chh.connect(server_ip)
+
+    tracemalloc.start()
+    start = time.time()
+    chh.insert_df(
+        con,
+        table_name,
+        df,
+        columns=[col for col in df.columns if col not in chh.instrument_columns],
+        is_columnar=is_columnar,
+        chunk_size=chunk_size,
+    )
+    elapsed = time.time() - start
+    _, peak_traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    chh.close_connection(con)
+    queue.put(
+        {
+            "mode": "columnar" if is_columnar else "tuples",
+            "rows": n_rows,
+            "seconds": elapsed,
+            "rows_per_second": n_rows / elapsed,
+            "peak_insert_mb": peak_traced / 2**20,
+            "peak_rss_mb": _peak_rss_mb(),
+            "rss_before_insert_mb": rss_before,
+        }
+    )
+
+
+##-------------------------------------------------------------------------------------------------
+def benchmark_insert(
+    server_ip="localhost",
+    n_rows=1000000,
+    chunk_size=chh.insert_chunk_size,
+    table_name="bench_minutes",
+):
+    """
+    Compares row (list of tuples) and columnar (NumPy) inserts.
+
+    Parameters
+    ----------
+    server_ip : string
+        ip adress of Clickhouse instance. localhost by default.
+    n_rows : int
+        Number of rows to insert. The default is 1 000 000.
+    chunk_size : int
+        Max rows per insert query.
+    table_name : string
+        Table for the benchmark. It is dropped at the end.
+
+    Returns
+    -------
+    df : Pandas dataframe with one row per mode: rows per second,
+        peak memory allocated during insert (tracemalloc) and peak RSS of the process.
+    """
+    logger = logging.getLogger(apiname + benchmark_insert.__name__)
+
+    con, _ = chh.connect(server_ip)
+    con.execute(f"DROP TABLE IF EXISTS {table_name}")
+    chh.create_candles_table(con, table_name)
+
+    results = []
+    ctx = multiprocessing.get_context("spawn")
+    for is_columnar in [False, True]:
+        con.execute(f"TRUNCATE TABLE {table_name}")
+        queue = ctx.Queue()
+        process = ctx.Process(
+            target=_run_insert_case,
+            args=(server_ip, table_name, n_rows, is_columnar, chunk_size, queue),
+        )
+        process.start()
+        result = queue.get()
+        process.join()
+        logger.info(f"insert benchmark: {result}")
+        results.append(result)
+
+    con.execute(f"DROP TABLE IF EXISTS {table_name}")
+    chh.close_connection(con)
+    return pd.DataFrame(results)
+
+
+##-------------------------------------------------------------------------------------------------
+def fill_bench_table(
+    con,
+    table_name,
+    n_rows,
+    chunk_rows=1000000,
+    n_figi=2000,
+    columns=chh.candles_columns,
+):
+    """
+    Creates candles table and fills it with n_rows synthetic candles, chunk by chunk.
+    Every chunk continues time series of the previous one.
+    columns is the schema of the table, see ClickhouseHelper.create_candles_table().
+    """
+    con.execute(f"DROP TABLE IF EXISTS {table_name}")
+    chh.create_candles_table(con, table_name, columns=columns)
+    chunk_start = datetime(2020, 1, 1)
+    for offset in range(0, n_rows, chunk_rows):
+        n_chunk = min(chunk_rows, n_rows - offset)
+        df = make_synthetic_candles(n_chunk, n_figi=n_figi, start=chunk_start)
+        columns = [col for col in df.columns if col not in chh.instrument_columns]
+        chh.insert_df(con, table_name, df, columns=columns)
+        chunk_start = df.time.max() + timedelta(minutes=1)
+
+
+##-------------------------------------------------------------------------------------------------
+def benchmark_query_decoding(
+    server_ip="localhost", n_rows=10000000, table_name="bench_minutes"
+):
+    """
+    Compares decoding of query result from rows of Python tuples and from NumPy columns
+    (get_SQL_table with is_numpy=False and True).
+
+    Parameters
+    ----------
+    server_ip : string
+        ip adress of Clickhouse instance. localhost by default.
+    n_rows : int
+        Number of rows in synthetic table. The default is 10 000 000.
+    table_name : string
+        Table for the benchmark. It is dropped at the end.
+
+    Returns
+    -------
+    df : Pandas dataframe with one row per mode: rows per second and
+        memory taken by resulting dataframe.
+    """
+    logger = logging.getLogger(apiname + benchmark_query_decoding.__name__)
+
+    con, _ = chh.connect(server_ip)
+    fill_bench_table(con, table_name, n_rows)
+    numpy_con, _ = chh.connect(server_ip, use_numpy=True)
+
+    results = []
+    for is_numpy, client in [(False, con), (True, numpy_con)]:
+        start = time.time()
+        df = chh.get_SQL_table(client, table_name, is_numpy=is_numpy)
+        elapsed = time.time() - start
+        result = {
+            "mode": "numpy" if is_numpy else "tuples",
+            "rows": len(df),
+            "seconds": elapsed,
+            "rows_per_second": len(df) / elapsed,
+            "df_memory_mb": df.memory_usage(deep=True).sum() / 2**20,
+        }
+        logger.info(f"query benchmark: {result}")
+        results.append(result)
+        del df
+
+    con.execute(f"DROP TABLE IF EXISTS {table_name}")
+    chh.close_connection(numpy_con)
+    chh.close_connection(con)
+    return pd.DataFrame(results)
+
+
+##-------------------------------------------------------------------------------------------------
+def _table_size(con, table_name):
+    """Rows, compressed and uncompressed bytes of active parts of table."""
+    return con.execute(
+        "SELECT sum(rows), sum(data_compressed_bytes), sum(data_uncompressed_bytes) "
+        "FROM system.parts "
+        "WHERE active AND database = currentDatabase() AND table = %(table)s",
+        {"table": table_name},
+    )[0]
+
+
+##-------------------------------------------------------------------------------------------------
+def benchmark_schema(
+    server_ip="localhost", n_figi=20, days=365, repeats=3, table_name="bench_schema"
+):
+    """
+    Compares size on disk and scan speed of candles tables with plain column types
+    (plain_candles_columns) and with compact types and codecs (candles_columns).
+
+    Both tables get the same synthetic minute candles and are merged (OPTIMIZE FINAL)
+    before measurements. Every query of scan_queries is run repeats times,
+    the best time is reported.
+
+    Parameters
+    ----------
+    server_ip : string
+        ip adress of Clickhouse instance. localhost by default.
+    n_figi : int
+        Number of instruments. The default is 20.
+    days : int
+        Days of minute candles of every instrument. The default is 365.
+    repeats : int
+        Runs of every query. The default is 3.
+    table_name : string
+        Prefix of tables for the benchmark. They are dropped at the end.
+
+    Returns
+    -------
+    df : Pandas dataframe with one row per schema: rows, compressed (on disk) and
+        uncompressed size in MB and seconds of every query of scan_queries.
+    """
+    logger = logging.getLogger(apiname + benchmark_schema.__name__)
+
+    n_rows = n_figi * days * 24 * 60
+    start = datetime(2020, 1, 1)
+    params = {
+        "figi": "BBG000000000",
+        "start": start + timedelta(days=days // 2),
+        "end": start + timedelta(days=days // 2 + 30),
+    }
+    con, _ = chh.connect(server_ip)
+
+    results = []
+    for schema, columns in [
+        ("plain", plain_candles_columns),
+        ("compact", chh.candles_columns),
+    ]:
+        table = f"{table_name}_{schema}"
+        fill_bench_table(con, table, n_rows, n_figi=n_figi, columns=columns)
+        con.execute(f"OPTIMIZE TABLE {table} FINAL")
+        rows, compressed, uncompressed = _table_size(con, table)
+        result = {
+            "schema": schema,
+            "rows": rows,
+            "disk_mb": compressed / 2**20,
+            "uncompressed_mb": uncompressed / 2**20,
+        }
+        for name, query in scan_queries.items():
+            timings = []
+            for _ in range(repeats):
+                query_start = time.time()
+                con.execute(query.format(table=table), params)
+                timings.append(time.time() - query_start)
+            result[f"{name}_seconds"] = min(timings)
+        logger.info(f"schema benchmark: {result}")
+        results.append(result)
+        con.execute(f"DROP TABLE IF EXISTS {table}")
+
+    chh.close_connection(con)
+    df = pd.DataFrame(results)
+    df["disk_ratio"] = df.disk_mb / df.disk_mb.iloc[0]
+    return df
+
+
+##-------------------------------------------------------------------------------------------------
+def save_results(scenario, df, params=None, path=results_file):
+    """
+    Appends results of benchmark to JSON lines file.
+
+    Parameters
+    ----------
+    scenario : string
+        Benchmark name, e.g. "download".
+    df : Pandas dataframe
+        Results returned by benchmark function.
+    params : dict, optional
+        Arguments of the run, kept to compare only comparable runs.
+    path : string
+        The default is results_file.
+    """
+    record = {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "scenario": scenario,
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "params": params or {},
+        "results": json.loads(df.to_json(orient="records")),
+    }
+    with open(path, "a", encoding="utf-8") as file:
+        file.write(json.dumps(record, default=str) + "\n")
+
+
+def load_results(path=results_file, scenario=None):
+    """
+    Results saved by save_results(), one row per result row of every run,
+    with time, scenario and host of the run. Empty if there is no file.
+    """
+    rows = []
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as file:
+            for line in file:
+                record = json.loads(line)
+                if scenario is not None and record["scenario"] != scenario:
+                    continue
+                for result in record["results"]:
+                    rows.append(
+                        {
+                            "time": record["time"],
+                            "scenario": record["scenario"],
+                            "host": record["host"],
+                            **result,
+                        }
+                    )
+    df = pd.DataFrame(rows)
+    if len(df) > 0:
+        df["time"] = pd.to_datetime(df["time"])
+    return df
+
+
+##-------------------------------------------------------------------------------------------------
+def _run_download_case(
+    server_ip,
+    mode,
+    n_figi,
+    days,
+    latency,
+    requests_per_minute,
+    max_workers,
+    table_name,
+    queue,
+):
+    """Single download measurement. Executed in a child process."""
+    con = fake_tinkoff_api.FakeOpenApiClient(
+        n_figi=n_figi, latency=latency, requests_per_minute=requests_per_minute
+    )
+    limiter = rate_limiter.TokenBucket(requests_per_minute)
+    registry = metrics.get_registry()
+    _from = download_end - timedelta(days=days)
+
+    start = time.time()
+    if mode == "pipeline":
+        ranges = tapi.request_ranges(
+            [instrument["figi"] for instrument in con.instruments], _from, download_end
+        )
+        pipeline.download_to_clickhouse(
+            con,
+            ranges,
+            server_ip=server_ip,
+            table_name=table_name,
+            max_workers=max_workers,
+            limiter=limiter,
+        )
+        n_rows = registry.total("downloaded_rows_total")
+    else:
+        df = tapi.get_detailed_data(
+            con,
+            pd.DataFrame(con.instruments),
+            _from,
+            download_end,
+            max_workers=max_workers,
+            limiter=limiter,
+        )
+        n_rows = len(df)
+    elapsed = time.time() - start
+
+    latencies = registry.histogram(
+        "api_request_seconds", method="market_candles_get_with_http_info"
+    )
+    queue.put(
+        {
+            "mode": mode,
+            "figis": n_figi,
+            "requests": con.n_requests,
+            "rejected_429": con.n_rejected,
+            "retries": registry.total("api_retries_total"),
+            "failed_requests": registry.total("failed_requests_total"),
+            "rate_limit_wait_seconds": registry.total("rate_limit_wait_seconds_total"),
+            "request_p50_seconds": latencies.quantile(0.5),
+            "request_p95_seconds": latencies.quantile(0.95),
+            "rows": n_rows,
+            "seconds": elapsed,
+            "rows_per_second": n_rows / elapsed,
+            "requests_per_second": con.n_requests / elapsed,
+            "peak_rss_mb": _peak_rss_mb(),
+        }
+    )
+
+
+##-------------------------------------------------------------------------------------------------
+def benchmark_download(
+    server_ip="localhost",
+    n_figi=2000,
+    days=10,
+    latency=0.05,
+    requests_per_minute=12000,
+    max_workers=16,
+    modes=("pipeline", "get_detailed_data"),
+    table_name="bench_download",
+):
+    """
+    Downloads minute candles of n_figi instruments for days from fake_tinkoff_api,
+    with concurrent pipeline into Clickhouse (pipeline.download_to_clickhouse)
+    and into memory (tinkoffAPIHelper.get_detailed_data).
+
+    Parameters
+    ----------
+    server_ip : string
+        ip adress of Clickhouse instance. localhost by default.
+    n_figi : int
+        Number of instruments. The default is 2000.
+    days : int
+        Days of candles. The default is 10.
+    latency : float
+        Mean seconds of fake API response. The default is 0.05.
+    requests_per_minute : int
+        Quota of fake API and rate of client limiter. Bursts of the limiter
+        go over the quota, so some requests get 429 and are retried.
+        The default is 12000.
+    max_workers : int
+        Download threads. The default is 16.
+    modes : tuple
+        "pipeline" and/or "get_detailed_data".
+    table_name : string
+        Table for the benchmark. It is dropped at the end.
+
+    Returns
+    -------
+    df : Pandas dataframe with one row per mode: requests, 429 responses, retries,
+        wait for the limiter, request latency, rows per second and peak RSS.
+    """
+    logger = logging.getLogger(apiname + benchmark_download.__name__)
+
+    con, _ = chh.connect(server_ip)
+    con.execute(f"DROP TABLE IF EXISTS {table_name}")
+
+    results = []
+    ctx = multiprocessing.get_context("spawn")
+    for mode in modes:
+        queue = ctx.Queue()
+        process = ctx.Process(
+            target=_run_download_case,
+            args=(
+                server_ip,
+                mode,
+                n_figi,
+                days,
+                latency,
+                requests_per_minute,
+                max_workers,
+                table_name,
+                queue,
+            ),
+        )
+        process.start()
+        result = queue.get()
+        process.join()
+        logger.info(f"download benchmark: {result}")
+        results.append(result)
+
+    con.execute(f"DROP TABLE IF EXISTS {table_name}")
+    chh.close_connection(con)
+    return pd.DataFrame(results)
+
+
+##-------------------------------------------------------------------------------------------------
+def _run_write_case(server_ip, method, table_name, n_rows, chunk_rows, queue):
+    """Single write measurement. Executed in a child process."""
+    write = {
+        "append": chh.append_df_to_SQL_table,
+        "upsert": chh.upsert_df_to_SQL_table,
+    }[method]
+    chunk_start = datetime(2020, 1, 1)
+    chunk_seconds = []
+    for offset in range(0, n_rows, chunk_rows):
+        df = make_synthetic_candles(min(chunk_rows, n_rows - offset), start=chunk_start)
+        start = time.time()
+        write(df=df, table_name=table_name, server_ip=server_ip)
+        chunk_seconds.append(time.time() - start)
+        chunk_start = df.time.max() + timedelta(minutes=1)
+        del df
+
+    elapsed = sum(chunk_seconds)
+    queue.put(
+        {
+            "method": method,
+            "rows": n_rows,
+            "chunks": len(chunk_seconds),
+            "seconds": elapsed,
+            "rows_per_second": n_rows / elapsed,
+            "first_chunk_seconds": chunk_seconds[0],
+            "last_chunk_seconds": chunk_seconds[-1],
+            "peak_rss_mb": _peak_rss_mb(),
+        }
+    )
+
+
+##-------------------------------------------------------------------------------------------------
+def benchmark_write(
+    server_ip="localhost",
+    n_rows=10000000,
+    chunk_rows=1000000,
+    methods=("upsert", "append"),
+    table_name="bench_write",
+):
+    """
+    Writes n_rows synthetic candles into empty table by chunks of chunk_rows
+    with ClickhouseHelper.upsert_df_to_SQL_table and append_df_to_SQL_table.
+    Append deduplicates every chunk against the table, so its chunks slow down
+    as the table grows: compare first and last chunk.
+
+    Parameters
+    ----------
+    server_ip : string
+        ip adress of Clickhouse instance. localhost by default.
+    n_rows : int
+        Rows to write. The default is 10 000 000.
+    chunk_rows : int
+        Rows per call. The default is 1 000 000.
+    methods : tuple
+        "upsert" and/or "append".
+    table_name : string
+        Table for the benchmark. It is dropped at the end.
+
+    Returns
+    -------
+    df : Pandas dataframe with one row per method: rows per second of write calls
+        (synthetic data generation is not counted), first and last chunk seconds
+        and peak RSS.
+    """
+    logger = logging.getLogger(apiname + benchmark_write.__name__)
+
+    con, _ = chh.connect(server_ip)
+    results = []
+    ctx = multiprocessing.get_context("spawn")
+    for method in methods:
+        con.execute(f"DROP TABLE IF EXISTS {table_name}")
+        queue = ctx.Queue()
+        process = ctx.Process(
+            target=_run_write_case,
+            args=(server_ip, method, table_name, n_rows, chunk_rows, queue),
+        )
+        process.start()
+        result = queue.get()
+        process.join()
+        logger.info(f"write benchmark: {result}")
+        results.append(result)
+
+    con.execute(f"DROP TABLE IF EXISTS {table_name}")
+    chh.close_connection(con)
+    return pd.DataFrame(results)
+
+
+##-------------------------------------------------------------------------------------------------
+def benchmark_aggregates(
+    server_ip="localhost",
+    n_rows=10000000,
+    n_figi=100,
+    freqs=("day", "week"),
+    instrument_type="Stock",
+    repeats=3,
+    table_name="bench_aggregates",
+):
+    """
+    Times ClickhouseHelper.query_data_by_time bars of freqs aggregated from
+    minute candles, and read from aggregate views (create_aggregate_views).
+
+    Synthetic instruments (same FIGIs as make_synthetic_candles) are written
+    to bench_instruments table and dictionary, queries need their types.
+    ClickhouseHelper reads instruments from them while the benchmark runs.
+
+    Parameters
+    ----------
+    server_ip : string
+        ip adress of Clickhouse instance. localhost by default.
+    n_rows : int
+        Minute candles in the table. The default is 10 000 000.
+    n_figi : int
+        Number of instruments. The default is 100 (about 70 days of candles each).
+    freqs : tuple
+        Bars to query. The default is daily and weekly.
+    instrument_type : string
+        Type of queried instruments, a third of n_figi. The default is "Stock".
+    repeats : int
+        Runs of every query, the best time is reported. The default is 3.
+    table_name : string
+        Table for the benchmark. It is dropped at the end with its views.
+
+    Returns
+    -------
+    df : Pandas dataframe with one row per source ("minutes", "views") and freq:
+        bars returned and seconds.
+    """
+    con, _ = chh.connect(server_ip)
+    real_instruments = (chh.instruments_table, chh.instruments_dict)
+    chh.instruments_table, chh.instruments_dict = bench_instruments
+    try:
+        results = _run_aggregates(
+            con, server_ip, n_rows, n_figi, freqs, instrument_type, repeats, table_name
+        )
+    finally:
+        con.execute(f"DROP DICTIONARY IF EXISTS {chh.instruments_dict}")
+        con.execute(f"DROP TABLE IF EXISTS {chh.instruments_table}")
+        chh.instruments_table, chh.instruments_dict = real_instruments
+        chh.close_connection(con)
+    return pd.DataFrame(results)
+
+
+def _run_aggregates(
+    con, server_ip, n_rows, n_figi, freqs, instrument_type, repeats, table_name
+):
+    """Queries of benchmark_aggregates, list of results."""
+    logger = logging.getLogger(apiname + benchmark_aggregates.__name__)
+
+    chh.drop_aggregate_views(con, table_name)
+    fill_bench_table(con, table_name, n_rows, n_figi=n_figi)
+    instruments = pd.DataFrame(fake_tinkoff_api.FakeOpenApiClient(n_figi).instruments)
+    instruments["version"] = int(time.time())
+    chh.upsert_instruments(con, instruments)
+    startTime = datetime(2020, 1, 1)
+    endTime = startTime + timedelta(minutes=int(np.ceil(n_rows / n_figi)))
+
+    results = []
+    for source in ["minutes", "views"]:
+        if source == "views":
+            chh.create_aggregate_views(con, table_name, freqs=freqs)
+        for data_freq in freqs:
+            timings = []
+            for _ in range(repeats):
+                query_start = time.time()
+                df = chh.query_data_by_time(
+                    None,
+                    startTime,
+                    endTime,
+                    server_ip=server_ip,
+                    table_name=table_name,
+                    instrument_type=instrument_type,
+                    data_freq=data_freq,
+                )
+                timings.append(time.time() - query_start)
+            result = {
+                "source": source,
+                "freq": data_freq,
+                "bars": len(df),
+                "seconds": min(timings),
+            }
+            logger.info(f"aggregates benchmark: {result}")
+            results.append(result)
+
+    chh.drop_aggregate_views(con, table_name)
+    con.execute(f"DROP TABLE IF EXISTS {table_name}")
+    return results
+
+
+##-------------------------------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    logging.config.fileConfig(fname="logger.conf", disable_existing_loggers=False)
+    logger = logging.getLogger(__name__)
+
+    logger.info("benchmarks main")
+    start = time.time()
+    # local server by default: benchmarks write synthetic data
+    server_ip = os.environ.get("BENCH_CLICKHOUSE_SERVER", "localhost")
+    path = os.environ.get("BENCH_RESULTS_FILE", results_file)
+
+    scenarios = [
+        ("insert", benchmark_insert, {"n_rows": 1000000}),
+        ("query_decoding", benchmark_query_decoding, {"n_rows": 10000000}),
+        ("schema", benchmark_schema, {}),
+        ("download", benchmark_download, {"n_figi": 2000, "days": 10}),
+        ("write", benchmark_write, {"n_rows": 10000000}),
+        ("aggregates", benchmark_aggregates, {"n_rows": 10000000}),
+    ]
+    for scenario, benchmark, params in scenarios:
+        df = benchmark(server_ip=server_ip, **params)
+        logger.info(f"{scenario}:\n{df.to_string()}")
+        save_results(scenario, df, params, path=path)
+    logger.info(f"results saved to {path}")
+
+    timer_string = utilities_timers.format_timer_string(time.time() - start)
+    logger.info(timer_string)
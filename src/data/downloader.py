@@ -6,8 +6,11 @@ Created on Wed Apr  1 14:49:17 2020
 """
 
 import tinkoffAPIHelper as tapi
-import pandas as pd
 import ClickhouseHelper as chh
+import instrument_cache
+import metrics
+import missing_ranges
+import pipeline
 from dotenv import load_dotenv, find_dotenv
 import os
 from datetime import datetime, timedelta
@@ -20,6 +23,8 @@ logging.config.fileConfig(fname="logger.conf", disable_existing_loggers=False)
 logger = logging.getLogger(__name__)
 logger.info("Data downloader main")
 start = time.time()
+# PROFILE_RUN=cprofile or pyinstrument profiles the whole run
+profiler = utilities_timers.RunProfiler().start()
 dotenv_path = find_dotenv()
 
 load_dotenv(dotenv_path)
@@ -30,62 +35,87 @@ pwd = os.environ.get("CLICKHOUSE_PWD")
 server_adress = os.environ.get("CLICKHOUSE_SERVER_ADRESS")
 db_name = os.environ.get("CLICKHOUSE_DB_NAME")
 table_name = os.environ.get("CLICKHOUSE_TABLE_NAME")
+# number of concurrent download threads. Request rate is limited by TINKOFF_REQUESTS_PER_MINUTE
+max_workers = int(os.environ.get("TINKOFF_MAX_WORKERS", 8))
+# incremental mode: only candles after the last stored one are downloaded.
+# FIGIs without history (new listings) get BACKFILL_DAYS of history.
+is_incremental = os.environ.get("INCREMENTAL_DOWNLOAD", "1") == "1"
+backfill_days = int(os.environ.get("BACKFILL_DAYS", 10))
+# comma separated candle intervals to download, e.g. "1min,hour,day"
+intervals = os.environ.get("TINKOFF_INTERVALS", "1min").split(",")
 
 con, _ = tapi.connect(token)
-df_etf = tapi.get_instruments(con=con, instrument="Etf")
-df_stock = tapi.get_instruments(con=con, instrument="Stock")
-df_bond = tapi.get_instruments(con=con, instrument="Bond")
+# instrument list is requested once a day, Clickhouse gets it only when it changes
+instruments = instrument_cache.InstrumentCache().load(con)
+if instruments is None:
+    logger.error("no instrument list, nothing to download")
+    raise SystemExit(1)
+with chh.get_pool(server_adress).connection() as ch_con:
+    chh.upsert_instruments(ch_con, instruments)
 
 
 # 3. Testing etf querrying
 endTime = datetime.now()
 startTime = endTime - timedelta(days=10)
-list_of_securities = []
 
-try:
-    df_data_etf = tapi.get_detailed_data(
-        con=con, data=df_etf, _from=startTime, to=endTime, days_span=90
-    )
-    list_of_securities.append(df_data_etf)
-except Exception as error:
-    logger.error("scrip failed during downloading ETF data")
-    logger.error(f"exception catched: {error}")
+# API latency, rate limit waits, rows/s and queue depth are exported to
+# METRICS_PROMETHEUS_FILE / METRICS_JSONL_FILE every METRICS_INTERVAL seconds
+exporter = metrics.Exporter().start()
+# candles of failed requests and dropped stream batches, retried by next runs
+missing = missing_ranges.MissingRanges()
+for interval in intervals:
+    # 1min candles go to CLICKHOUSE_TABLE_NAME, others to their own tables
+    if interval == "1min":
+        interval_table_name = table_name
+    else:
+        interval_table_name = chh.interval_table(interval)
+    logger.info(f"downloading {interval} candles to {interval_table_name}")
 
-try:
-    df_data_bonds = tapi.get_detailed_data(
-        con=con, data=df_bond, _from=startTime, to=endTime, days_span=10
-    )
-    list_of_securities.append(df_data_bonds)
-except Exception as error:
-    logger.error("scrip failed during downloading Bonds data")
-    logger.error(f"exception catched: {error}")
+    watermarks = None
+    if is_incremental:
+        try:
+            with chh.get_pool(server_adress).connection() as ch_con:
+                chh.create_candles_table(ch_con, interval_table_name)
+                watermarks = chh.get_last_timestamps(
+                    ch_con, table_name=interval_table_name
+                )
+        except Exception as error:
+            logger.error("failed to get watermarks, downloading last 10 days instead")
+            logger.error(f"exception catched: {error}")
 
-try:
-    df_data_stock = tapi.get_detailed_data(
-        con=con, data=df_stock, _from=startTime, to=endTime, days_span=10
-    )
-    list_of_securities.append(df_data_stock)
-except Exception as error:
-    logger.error("scrip failed during downloading Stocks data")
-    logger.error(f"exception catched: {error}")
+    # candles are written to clickhouse while the download goes on,
+    # see pipeline.CandleWriter
+    try:
+        run_started = datetime.now()
+        ranges = tapi.request_ranges(
+            instruments.figi.unique(),
+            startTime,
+            endTime,
+            since=watermarks,
+            backfill_days=backfill_days,
+            missing=missing.earliest(interval),
+        )
+        failed = pipeline.download_to_clickhouse(
+            con,
+            ranges,
+            interval=interval,
+            server_ip=server_adress,
+            table_name=interval_table_name,
+            max_workers=max_workers,
+        )
+        for figi, w_from, w_to in failed:
+            logger.error(f"missing {interval} candles of {figi} in [{w_from}, {w_to})")
+        # ranges recorded before the run are covered by it
+        missing.clear(interval, before=run_started)
+        missing.add(failed, interval, source="download")
+    except Exception as error:
+        logger.error(f"scrip failed during downloading {interval} data")
+        logger.error(f"exception catched: {error}")
 
-df = pd.concat(list_of_securities)
-logger.info("Creating connection to clickhouse")
-con, ping = chh.connect(server_adress)
-
-logger.info("Uploading data to clickhouse")
-try:
-    chh.append_df_to_SQL_table(
-        df=df,
-        table_name=table_name,
-        server_ip=server_adress,
-        is_tmp_table_to_delete=True,
-    )
-except Exception as error:
-    logger.error("scrip failed during pushing data to clickhouse")
-    logger.error(f"exception catched: {error}")
-
-chh.close_connection(con)
+missing.close()
+exporter.stop()
+profiler.stop()
+chh.get_pool(server_adress).close()
 
 timer_string = utilities_timers.format_timer_string(time.time() - start)
 logger.info(f"Script runs for {timer_string}")
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 23:41:08 2026
+
+@author: SParkhonyuk
+"""
+# Local stand-in of Tinkoff streaming API for testing stream_ingestor without
+# the broker: accepts the same subscribe requests and sends synthetic candle
+# and order book events of subscribed FIGIs at a fixed rate.
+import json
+import threading
+import logging
+import logging.config
+from datetime import datetime, timedelta
+import time
+
+import numpy as np
+
+try:
+    from websockets.sync.server import serve
+except ImportError:  # optional, needed only for streaming
+    serve = None
+
+apiname = "FakeStreamServer::"
+
+
+##-------------------------------------------------------------------------------------------------
+class FakeStreamServer:
+    """
+    Websocket server speaking the streaming API protocol.
+
+    Every round it sends one candle event per candle subscription and
+    one order book event per order book subscription. Candle time moves
+    one interval every updates_per_candle rounds, so a forming candle is
+    updated several times as by the real API.
+
+    Usage:
+        with FakeStreamServer(rounds_per_second=100) as server:
+            StreamIngestor(figis, token="test", url=server.url)...
+
+    Parameters
+    ----------
+    host : string
+        The default is "localhost".
+    port : int
+        The default is 0, any free port (see url).
+    rounds_per_second : float
+        The default is 10.
+    updates_per_candle : int
+        The default is 3.
+    start_time : datetime
+        Time of the first candle, UTC. The default is 2020-01-06 10:00.
+    token : string, optional
+        Expected API key. Connections with another one are rejected. Any key by default.
+    disconnect_after : int, optional
+        Close every connection after this number of rounds, to test reconnects.
+    """
+
+    def __init__(
+        self,
+        host="localhost",
+        port=0,
+        rounds_per_second=10,
+        updates_per_candle=3,
+        start_time=datetime(2020, 1, 6, 10, 0),
+        token=None,
+        disconnect_after=None,
+    ):
+        if serve is None:
+            raise RuntimeError("websockets package is required for streaming")
+        self.rounds_per_second = rounds_per_second
+        self.updates_per_candle = updates_per_candle
+        self.start_time = start_time
+        self.token = token
+        self.disconnect_after = disconnect_after
+        self.n_connections = 0
+        self.n_events = 0
+        self._lock = threading.Lock()
+        self._server = serve(self._handler, host, port)
+        self.port = self._server.socket.getsockname()[1]
+        self.url = f"ws://{host}:{self.port}"
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _handler(self, websocket):
+        logger = logging.getLogger(apiname + "handler")
+        if self.token is not None:
+            if websocket.request.headers.get("Authorization") != f"Bearer {self.token}":
+                websocket.close(code=4001, reason="unauthorized")
+                return
+        with self._lock:
+            self.n_connections += 1
+        candles = {}
+        orderbooks = {}
+        rng = np.random.default_rng(self.n_connections)
+        next_round = time.monotonic()
+        n_rounds = 0
+        while self.disconnect_after is None or n_rounds < self.disconnect_after:
+            try:
+                message = websocket.recv(
+                    timeout=max(0.0, next_round - time.monotonic())
+                )
+                request = json.loads(message)
+                if request["event"] == "candle:subscribe":
+                    candles[request["figi"]] = request["interval"]
+                elif request["event"] == "orderbook:subscribe":
+                    orderbooks[request["figi"]] = request["depth"]
+                continue
+            except TimeoutError:
+                pass
+            except Exception:
+                # connection closed by client
+                return
+            events = self._round(n_rounds, candles, orderbooks, rng)
+            try:
+                for event in events:
+                    websocket.send(json.dumps(event))
+            except Exception:
+                return
+            with self._lock:
+                self.n_events += len(events)
+            n_rounds += 1
+            next_round += 1.0 / self.rounds_per_second
+        logger.debug(f"disconnect after {n_rounds} rounds")
+
+    def _round(self, n_round, candles, orderbooks, rng):
+        """Events of one round."""
+        candle_time = self.start_time + timedelta(
+            minutes=n_round // self.updates_per_candle
+        )
+        now = (self.start_time + timedelta(seconds=n_round)).isoformat(
+            timespec="milliseconds"
+        ) + "Z"
+        events = []
+        for figi, interval in candles.items():
+            o, c, h, l = 100 + rng.normal(size=4).round(2)
+            events.append(
+                {
+                    "event": "candle",
+                    "time": now,
+                    "payload": {
+                        "o": o,
+                        "c": c,
+                        "h": max(o, c, h),
+                        "l": min(o, c, l),
+                        "v": int(rng.integers(1, 1000)),
+                        "time": candle_time.isoformat() + "Z",
+                        "interval": interval,
+                        "figi": figi,
+                    },
+                }
+            )
+        for figi, depth in orderbooks.items():
+            levels = np.arange(1, depth + 1) * 0.01
+            events.append(
+                {
+                    "event": "orderbook",
+                    "time": now,
+                    "payload": {
+                        "figi": figi,
+                        "depth": depth,
+                        "bids": [
+                            [round(100 - d, 2), int(q)]
+                            for d, q in zip(levels, rng.integers(1, 100, depth))
+                        ],
+                        "asks": [
+                            [round(100 + d, 2), int(q)]
+                            for d, q in zip(levels, rng.integers(1, 100, depth))
+                        ],
+                    },
+                }
+            )
+        return events
+
+
+##-------------------------------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    logging.config.fileConfig(fname="logger.conf", disable_existing_loggers=False)
+    logger = logging.getLogger(__name__)
+
+    logger.info("FakeStreamServer main")
+    with FakeStreamServer(port=8765) as server:
+        logger.info(f"serving at {server.url}, Ctrl+C to stop")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            logger.info(f"{server.n_events} events sent")
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 00:41:37 2026
+
+@author: SParkhonyuk
+"""
+# Local stand-in of Tinkoff OpenAPI client for benchmarks and runs without
+# the broker. Serves synthetic instruments and candles through the same methods
+# and response shapes as openapi_client, with configurable latency, per-minute
+# request quota (429 responses above it) and random server errors.
+import collections
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+apiname = "FakeTinkoffAPI::"
+# trading session of synthetic candles, UTC (10:00 - 18:45 Moscow time)
+session_start = timedelta(hours=7)
+session_end = timedelta(hours=15, minutes=45)
+interval_steps = {
+    "1min": timedelta(minutes=1),
+    "2min": timedelta(minutes=2),
+    "3min": timedelta(minutes=3),
+    "5min": timedelta(minutes=5),
+    "10min": timedelta(minutes=10),
+    "15min": timedelta(minutes=15),
+    "30min": timedelta(minutes=30),
+    "hour": timedelta(hours=1),
+    "day": timedelta(days=1),
+    "week": timedelta(weeks=1),
+    "month": timedelta(days=31),
+}
+# first day of the period of weekly and monthly candles
+period_starts = {
+    "week": lambda day: day - timedelta(days=day.weekday()),
+    "month": lambda day: day.replace(day=1),
+}
+instrument_types = ["Etf", "Bond", "Stock"]
+
+
+##-------------------------------------------------------------------------------------------------
+class FakeApiException(Exception):
+    """Error response, status as in openapi_client.rest.ApiException."""
+
+    def __init__(self, status, reason=""):
+        super().__init__(f"({status}) {reason}")
+        self.status = status
+        self.reason = reason
+
+
+class _Model:
+    """Response object with to_dict() as generated openapi_client models."""
+
+    __slots__ = ["_values"]
+
+    def __init__(self, values):
+        self._values = values
+
+    def to_dict(self):
+        return dict(self._values)
+
+
+class _Payload:
+    def __init__(self, **items):
+        self.__dict__.update(items)
+
+
+class _Response:
+    def __init__(self, **payload):
+        self.payload = _Payload(**payload)
+        self.status = "Ok"
+
+
+##-------------------------------------------------------------------------------------------------
+class FakeMarketApi:
+    """
+    market part of the client: instruments and candles.
+
+    Candles are generated from figi and time only, so the same request
+    always returns the same candles. Weekends have no candles, weekly
+    and monthly candles start on the first weekday of their period.
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    def _instruments(self, instrument_type):
+        self._client._request()
+        instruments = [
+            _Model(values)
+            for values in self._client.instruments
+            if values["type"] == instrument_type
+        ]
+        return _Response(instruments=instruments, total=len(instruments)), 200, {}
+
+    def market_stocks_get_with_http_info(self):
+        return self._instruments("Stock")
+
+    def market_bonds_get_with_http_info(self):
+        return self._instruments("Bond")
+
+    def market_etfs_get_with_http_info(self):
+        return self._instruments("Etf")
+
+    def market_candles_get_with_http_info(self, figi, _from, to, interval):
+        self._client._request()
+        candles = [
+            _Model(values)
+            for values in self._client.candles(
+                figi,
+                datetime.fromisoformat(_from),
+                datetime.fromisoformat(to),
+                interval,
+            )
+        ]
+        return _Response(figi=figi, interval=interval, candles=candles), 200, {}
+
+
+##-------------------------------------------------------------------------------------------------
+class FakeOpenApiClient:
+    """
+    Fake of openapi.sandbox_api_client(token), usable as connector of
+    tinkoffAPIHelper functions and pipeline.download_to_clickhouse.
+
+    Usage:
+        con = FakeOpenApiClient(n_figi=2000, latency=0.05, requests_per_minute=240)
+        instruments = tinkoffAPIHelper.get_instruments(con, "Stock")
+
+    Parameters
+    ----------
+    n_figi : int
+        Number of instruments, types alternate Etf, Bond, Stock. The default is 2000.
+    latency : float
+        Mean seconds of every response (uniform from 0.5 to 1.5 of it). The default is 0.05.
+    requests_per_minute : int, optional
+        Quota: requests above it within last 60 seconds get 429 response.
+        Not limited by default.
+    error_rate : float
+        Share of requests failing with 500 response. The default is 0.
+    seed : int
+        Seed of errors and latencies. The default is 0.
+    """
+
+    def __init__(
+        self,
+        n_figi=2000,
+        latency=0.05,
+        requests_per_minute=None,
+        error_rate=0.0,
+        seed=0,
+    ):
+        self.latency = latency
+        self.requests_per_minute = requests_per_minute
+        self.error_rate = error_rate
+        self.instruments = [
+            {
+                "figi": f"BBG{i:09d}",
+                "ticker": f"TCK{i}",
+                "isin": f"BBG{i:09d}",
+                "min_price_increment": 0.01,
+                "lot": 1,
+                "currency": "USD",
+                "name": f"TCK{i}",
+                "type": instrument_types[i % 3],
+            }
+            for i in range(n_figi)
+        ]
+        self.market = FakeMarketApi(self)
+        self.n_requests = 0
+        self.n_rejected = 0
+        self._recent = collections.deque()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _request(self):
+        """Counts request against the quota, sleeps latency, raises error responses."""
+        with self._lock:
+            self.n_requests += 1
+            now = time.monotonic()
+            while self._recent and now - self._recent[0] > 60:
+                self._recent.popleft()
+            is_rejected = (
+                self.requests_per_minute is not None
+                and len(self._recent) >= self.requests_per_minute
+            )
+            if is_rejected:
+                self.n_rejected += 1
+            else:
+                self._recent.append(now)
+            is_error = self._random.random() < self.error_rate
+            delay = self.latency * (0.5 + self._random.random())
+        time.sleep(delay)
+        if is_rejected:
+            raise FakeApiException(429, "Too Many Requests")
+        if is_error:
+            raise FakeApiException(500, "Internal Server Error")
+
+    def candles(self, figi, _from, to, interval):
+        """Dicts of candles of figi in [_from, to), as to_dict() of openapi Candle."""
+        step = interval_steps[interval]
+        _from = _from.astimezone(timezone.utc)
+        to = to.astimezone(timezone.utc)
+        times = []
+        day = datetime.combine(_from.date(), datetime.min.time(), tzinfo=timezone.utc)
+        if interval in period_starts:
+            day = period_starts[interval](day)
+        while day < to:
+            if day.weekday() < 5:
+                if interval in period_starts:
+                    # the first trading day of the period only
+                    first = period_starts[interval](day)
+                    while first.weekday() >= 5:
+                        first += timedelta(days=1)
+                    day_times = [day + session_start] if day == first else []
+                elif step >= timedelta(days=1):
+                    day_times = [day + session_start]
+                else:
+                    n_steps = int((session_end - session_start) / step)
+                    day_times = [day + session_start + k * step for k in range(n_steps)]
+                times.extend(t for t in day_times if _from <= t < to)
+            day += timedelta(days=1)
+        if not times:
+            return []
+
+        # price path of figi is fixed by figi and candle times
+        rng = np.random.default_rng(
+            [int(figi[3:]) if figi[3:].isdigit() else 0, int(times[0].timestamp())]
+        )
+        n = len(times)
+        c = np.round(100 + rng.standard_normal(n).cumsum() * 0.05, 2)
+        o = np.round(c + rng.standard_normal(n) * 0.02, 2)
+        h = np.maximum(o, c) + 0.01
+        l = np.minimum(o, c) - 0.01
+        v = rng.integers(1, 1000, n)
+        return [
+            {
+                "o": float(o[k]),
+                "c": float(c[k]),
+                "h": float(h[k]),
+                "l": float(l[k]),
+                "v": int(v[k]),
+                "time": times[k],
+                "interval": interval,
+                "figi": figi,
+            }
+            for k in range(n)
+        ]
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 19:44:03 2026
+
+@author: SParkhonyuk
+"""
+# Local copy of the instrument list of Tinkoff API. The list changes rarely,
+# so it is requested at most once per max_age and gets a new version only
+# when its content changes (see ClickhouseHelper.upsert_instruments).
+import os
+import hashlib
+import logging
+import logging.config
+from datetime import datetime, timedelta
+import time
+
+import pandas as pd
+from dotenv import load_dotenv, find_dotenv
+
+# in-house
+import ClickhouseHelper as chh
+import tinkoffAPIHelper as tapi
+import utilities_timers
+
+apiname = "InstrumentCache::"
+instrument_types = ["Etf", "Bond", "Stock"]
+
+
+##-------------------------------------------------------------------------------------------------
+class InstrumentCache:
+    """
+    Versioned instrument list of all types, stored in a local Parquet file.
+
+    load() answers from the file while it is younger than max_age, otherwise
+    the list is requested from the API. A new version (unix time of the
+    refresh) is assigned only if the list differs from the stored one.
+
+    Parameters
+    ----------
+    path : string
+        Parquet file. The default is INSTRUMENT_CACHE environment variable
+        or data/interim/instruments.parquet of this repository.
+    max_age : timedelta
+        Age of the file after which the list is requested again. The default is 1 day.
+    """
+
+    def __init__(self, path=None, max_age=timedelta(days=1)):
+        if path is None:
+            path = os.environ.get(
+                "INSTRUMENT_CACHE",
+                os.path.join(
+                    os.path.dirname(os.path.abspath(__file__)),
+                    "..",
+                    "..",
+                    "data",
+                    "interim",
+                    "instruments.parquet",
+                ),
+            )
+        self.path = path
+        self.max_age = max_age
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return None
+        return pd.read_parquet(self.path)
+
+    @staticmethod
+    def _digest(df):
+        """Hash of instruments content, independent of row order and version."""
+        df = df[["figi"] + chh.instrument_columns].sort_values("figi")
+        hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+        return hashlib.sha1(hashes.tobytes()).hexdigest()
+
+    def load(self, con=None, is_refresh=False):
+        """
+        Returns instrument list, requested from the API if the file is missing or old.
+
+        Parameters
+        ----------
+        con(connector) : TinkoffAPI connector. Create one using tinkoffAPIHelper.connect()
+            Without connector the file is used whatever its age.
+        is_refresh : bool
+            Request the list even if the file is not old. The default is False.
+
+        Returns
+        -------
+        df : Pandas dataframe with figi, instrument columns and version.
+            None if there is no file and the list can not be requested.
+        """
+        logger = logging.getLogger(apiname + "load")
+
+        df = self._read()
+        if df is not None and not is_refresh:
+            age = datetime.now() - datetime.fromtimestamp(os.path.getmtime(self.path))
+            if age < self.max_age or con is None:
+                logger.info(f"{len(df)} instruments of version {df.version.max()}")
+                return df
+        if con is None:
+            logger.error(f"no instruments in {self.path} and no connector to get them")
+            return None
+        return self.refresh(con, cached=df)
+
+    def refresh(self, con, cached=None):
+        """Requests instrument list and saves it, with new version if it has changed."""
+        start = time.time()
+        logger = logging.getLogger(apiname + "refresh")
+
+        frames = []
+        for instrument_type in instrument_types:
+            df = tapi.get_instruments(con=con, instrument=instrument_type)
+            if df is None:
+                logger.error(
+                    f"failed to get {instrument_type} list, cached list is kept"
+                )
+                return cached
+            frames.append(df)
+        df = pd.concat(frames, ignore_index=True)
+        df = df[["figi"] + chh.instrument_columns].drop_duplicates("figi")
+
+        if cached is not None and self._digest(df) == self._digest(cached):
+            # same list: only the age of the file is reset
+            os.utime(self.path)
+            logger.info(f"instruments have not changed since {cached.version.max()}")
+            return cached
+
+        df["version"] = int(time.time())
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        df.to_parquet(self.path, index=False)
+
+        timer_string = utilities_timers.format_timer_string(time.time() - start)
+        logger.info(timer_string)
+        logger.info(f"saved {len(df)} instruments of version {df.version.max()}")
+        return df
+
+
+##-------------------------------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    logging.config.fileConfig(fname="logger.conf", disable_existing_loggers=False)
+    logger = logging.getLogger(__name__)
+
+    logger.info("InstrumentCache main")
+    load_dotenv(find_dotenv())
+    token = os.environ.get("APIKEY_SANDBOX")
+    server_adress = os.environ.get("CLICKHOUSE_SERVER_ADRESS", "192.168.1.128")
+
+    con, _ = tapi.connect(token)
+    instruments = InstrumentCache().load(con)
+    with chh.get_pool(server_adress).connection() as ch_con:
+        chh.upsert_instruments(ch_con, instruments)
+    chh.get_pool(server_adress).close()
@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 23:58:12 2026
+
+@author: SParkhonyuk
+"""
+# Process-wide metrics of the download pipeline: counters, gauges and latency
+# histograms, updated from download and writer threads and written to sinks
+# (Prometheus text file for node_exporter textfile collector, JSON lines file).
+# Sinks are chosen by METRICS_PROMETHEUS_FILE / METRICS_JSONL_FILE environment
+# variables, without them metrics are only kept in memory and logged at the end.
+import os
+import json
+import threading
+import logging
+import logging.config
+import time
+from datetime import datetime, timezone
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:  # optional, peak memory on Windows
+    psutil = None
+
+apiname = "Metrics::"
+# upper bounds of latency histogram buckets, seconds
+latency_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+# seconds between exports of Exporter
+export_interval = 15.0
+# metric name prefix in Prometheus file
+prometheus_prefix = "finance_"
+# help lines of Prometheus file
+descriptions = {
+    "api_request_seconds": "Latency of single API request attempt",
+    "api_requests_total": "API request attempts by result",
+    "api_retries_total": "API requests repeated after 429/5xx response",
+    "rate_limit_waits_total": "Requests delayed by rate limiter",
+    "rate_limit_wait_seconds_total": "Time spent waiting for rate limiter",
+    "failed_requests_total": "Requests failed after all retries, their data is missing",
+    "downloaded_rows_total": "Candles downloaded",
+    "download_rows_per_second": "Candles downloaded per second by last run",
+    "inserted_rows_total": "Rows inserted into Clickhouse",
+    "insert_seconds": "Latency of single insert into Clickhouse",
+    "insert_rows_per_second": "Rows inserted per second of insert time",
+    "stream_batch_seconds": "Time to write one micro batch of stream",
+    "queue_depth": "Items waiting in queue",
+    "queue_depth_max": "Max items waiting in queue",
+    "peak_memory_bytes": "Peak resident memory of the process",
+}
+
+_registry = None
+
+
+##-------------------------------------------------------------------------------------------------
+def _labels_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _peak_memory_bytes():
+    """Peak resident memory of current process, bytes. None if not available."""
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss)
+    return None
+
+
+##-------------------------------------------------------------------------------------------------
+class Histogram:
+    """Counts of observations in latency_buckets, plus their sum and max."""
+
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding q-th quantile. None if empty."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return self.max
+
+    def to_dict(self):
+        cumulative = []
+        total = 0
+        for bound, count in zip(self.buckets + ["+Inf"], self.counts):
+            total += count
+            cumulative.append([bound, total])
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "buckets": cumulative,
+        }
+
+
+##-------------------------------------------------------------------------------------------------
+class Registry:
+    """
+    Thread-safe store of metrics. A metric is created by its first update,
+    its type is set by the update method: inc() - counter, set() - gauge,
+    observe() - histogram. Labels are keyword arguments.
+
+    Usage:
+        registry = get_registry()
+        registry.inc("api_retries_total", status=429)
+        with registry.timer("insert_seconds", table="minutes"):
+            ...
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._gauges[key] = value
+
+    def set_max(self, name, value, **labels):
+        """Gauge keeping the max of set values, e.g. peak queue depth."""
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._gauges[key] = max(self._gauges.get(key, value), value)
+
+    def observe(self, name, value, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def timer(self, name, **labels):
+        """Context manager observing its duration in histogram name."""
+        return _Timer(self, name, labels)
+
+    def value(self, name, **labels):
+        """Value of counter or gauge, None if it was not updated."""
+        key = (name, _labels_key(labels))
+        with self._lock:
+            return self._counters.get(key, self._gauges.get(key))
+
+    def histogram(self, name, **labels):
+        """Histogram object or None. Not a copy, read only."""
+        with self._lock:
+            return self._histograms.get((name, _labels_key(labels)))
+
+    def total(self, name):
+        """Sum of counter over all labels."""
+        with self._lock:
+            return sum(
+                value for (key, _), value in self._counters.items() if key == name
+            )
+
+    def snapshot(self):
+        """
+        Current values as dict of lists, ready for sinks:
+        {"time", "uptime", "counters", "gauges", "histograms"},
+        every metric is {"name", "labels", "value"} (histograms: see Histogram.to_dict).
+        Peak memory of the process is taken on every snapshot.
+        """
+        peak_memory = _peak_memory_bytes()
+        if peak_memory is not None:
+            self.set("peak_memory_bytes", peak_memory)
+        with self._lock:
+            return {
+                "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                "uptime": time.time() - self.started,
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self._counters.items())
+                ],
+                "gauges": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self._gauges.items())
+                ],
+                "histograms": [
+                    {"name": name, "labels": dict(labels), **histogram.to_dict()}
+                    for (name, labels), histogram in sorted(self._histograms.items())
+                ],
+            }
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+            self.started = time.time()
+
+
+class _Timer:
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed = time.perf_counter() - self.start
+        self.registry.observe(self.name, self.elapsed, **self.labels)
+
+
+##-------------------------------------------------------------------------------------------------
+def get_registry():
+    """Returns metrics registry shared by the process."""
+    global _registry
+    if _registry is None:
+        _registry = Registry()
+    return _registry
+
+
+##-------------------------------------------------------------------------------------------------
+def _format_labels(labels, extra=None):
+    items = list(labels.items()) + ([extra] if extra else [])
+    if not items:
+        return ""
+    escaped = [
+        (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in items
+    ]
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def _write_atomic(path, text):
+    """Write through a temporary file, so readers never see half of it."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        file.write(text)
+    os.replace(tmp_path, path)
+
+
+class PrometheusFileSink:
+    """
+    Writes snapshot in Prometheus text exposition format, replacing the file.
+    Point node_exporter --collector.textfile.directory to its folder.
+    """
+
+    def __init__(self, path, prefix=prometheus_prefix):
+        self.path = path
+        self.prefix = prefix
+
+    def write(self, snapshot):
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in descriptions:
+                    lines.append(f"# HELP {self.prefix}{name} {descriptions[name]}")
+                lines.append(f"# TYPE {self.prefix}{name} {kind}")
+
+        for kind, metrics in [("counter", "counters"), ("gauge", "gauges")]:
+            for metric in snapshot[metrics]:
+                header(metric["name"], kind)
+                lines.append(
+                    f"{self.prefix}{metric['name']}{_format_labels(metric['labels'])} "
+                    f"{metric['value']}"
+                )
+        for metric in snapshot["histograms"]:
+            name = self.prefix + metric["name"]
+            header(metric["name"], "histogram")
+            for bound, count in metric["buckets"]:
+                labels = _format_labels(metric["labels"], ("le", bound))
+                lines.append(f"{name}_bucket{labels} {count}")
+            labels = _format_labels(metric["labels"])
+            lines.append(f"{name}_sum{labels} {metric['sum']}")
+            lines.append(f"{name}_count{labels} {metric['count']}")
+        _write_atomic(self.path, "\n".join(lines) + "\n")
+
+
+class JsonLinesSink:
+    """Appends snapshot as one JSON line, keeping history of the runs."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, snapshot):
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(json.dumps(snapshot) + "\n")
+
+
+def sinks_from_env():
+    """Sinks set by METRICS_PROMETHEUS_FILE and METRICS_JSONL_FILE environment variables."""
+    sinks = []
+    path = os.environ.get("METRICS_PROMETHEUS_FILE")
+    if path:
+        sinks.append(PrometheusFileSink(path))
+    path = os.environ.get("METRICS_JSONL_FILE")
+    if path:
+        sinks.append(JsonLinesSink(path))
+    return sinks
+
+
+##-------------------------------------------------------------------------------------------------
+def summary(snapshot):
+    """Short human readable lines of snapshot, for the log."""
+    lines = []
+    for metric in snapshot["counters"] + snapshot["gauges"]:
+        value = metric["value"]
+        if isinstance(value, float):
+            value = f"{value:.2f}"
+        lines.append(f"{metric['name']}{_format_labels(metric['labels'])} = {value}")
+    for metric in snapshot["histograms"]:
+        mean = metric["sum"] / metric["count"]
+        lines.append(
+            f"{metric['name']}{_format_labels(metric['labels'])}: "
+            f"{metric['count']} calls, mean {mean:.3f} s, p95 <= {metric['p95']} s, "
+            f"max {metric['max']:.3f} s"
+        )
+    return lines
+
+
+##-------------------------------------------------------------------------------------------------
+class Exporter:
+    """
+    Background thread writing snapshots of registry to sinks every interval seconds
+    and once more on stop, when summary is logged. Errors of sinks are logged,
+    they never stop the pipeline.
+
+    Usage:
+        with metrics.Exporter():
+            pipeline.download_to_clickhouse(...)
+
+    Parameters
+    ----------
+    registry : Registry, optional
+        The default is shared registry, see get_registry().
+    sinks : list, optional
+        Objects with write(snapshot) method. The default is sinks_from_env().
+    interval : float
+        Seconds between exports. The default is METRICS_INTERVAL environment
+        variable or export_interval.
+    """
+
+    def __init__(self, registry=None, sinks=None, interval=None):
+        self.registry = get_registry() if registry is None else registry
+        self.sinks = sinks_from_env() if sinks is None else list(sinks)
+        if interval is None:
+            interval = float(os.environ.get("METRICS_INTERVAL", export_interval))
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        if self.sinks:
+            self._thread.start()
+        return self
+
+    def stop(self):
+        logger = logging.getLogger(apiname + "stop")
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        snapshot = self.export()
+        for line in summary(snapshot):
+            logger.info(line)
+
+    def export(self):
+        """Writes snapshot to all sinks, returns it."""
+        logger = logging.getLogger(apiname + "export")
+        snapshot = self.registry.snapshot()
+        for sink in self.sinks:
+            try:
+                sink.write(snapshot)
+            except Exception as exc:
+                logger.error(f"{type(sink).__name__} failed: {exc}")
+        return snapshot
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.export()
+
+
+##-------------------------------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    logging.config.fileConfig(fname="logger.conf", disable_existing_loggers=False)
+    logger = logging.getLogger(__name__)
+
+    logger.info("Metrics main")
+    registry = get_registry()
+    for latency in [0.02, 0.03, 0.2, 1.5]:
+        registry.observe("api_request_seconds", latency, method="market_candles_get")
+    registry.inc("downloaded_rows_total", 1500)
+    registry.set_max("queue_depth_max", 12, queue="writer")
+    PrometheusFileSink("metrics.prom").write(registry.snapshot())
+    for line in summary(registry.snapshot()):
+        logger.info(line)
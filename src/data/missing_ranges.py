@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 21:37:52 2026
+
+@author: SParkhonyuk
+"""
+# Candles lost by failed download requests and by stream batches that could
+# not be written. Incremental download starts from the last stored candle,
+# so candles before it are never requested again. Lost ranges are recorded
+# in a local SQLite file, and the next run of the downloader starts FIGIs
+# with lost ranges early enough to cover them (see tinkoffAPIHelper.request_ranges).
+import os
+import sqlite3
+import threading
+import logging
+import logging.config
+from datetime import datetime
+
+apiname = "MissingRanges::"
+
+
+##-------------------------------------------------------------------------------------------------
+class MissingRanges:
+    """
+    Ranges of candles missing in Clickhouse, in a local SQLite file.
+
+    Usage:
+        missing = MissingRanges()
+        missing.add(failed, "1min", source="download")
+        earliest = missing.earliest("1min")  # {figi: start of the first range}
+
+    Parameters
+    ----------
+    path : string
+        SQLite file. The default is MISSING_RANGES_FILE environment variable
+        or data/interim/missing_ranges.sqlite of this repository.
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            path = os.environ.get(
+                "MISSING_RANGES_FILE",
+                os.path.join(
+                    os.path.dirname(os.path.abspath(__file__)),
+                    "..",
+                    "..",
+                    "data",
+                    "interim",
+                    "missing_ranges.sqlite",
+                ),
+            )
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS ranges ("
+                "figi TEXT, interval TEXT, range_from TEXT, range_to TEXT, "
+                "source TEXT, recorded_at TEXT, "
+                "PRIMARY KEY (figi, interval, range_from, range_to))"
+            )
+
+    def add(self, ranges, interval, source=""):
+        """
+        Records missing ranges.
+
+        Parameters
+        ----------
+        ranges : list of tuples (figi, _from, to)
+            Bounds are timezone-aware datetimes or strings of API time format
+            with offset, e.g. failed requests of pipeline.download_to_clickhouse().
+        interval : str
+        source : str
+            Where the candles were lost, e.g. "download" or "stream".
+        """
+        logger = logging.getLogger(apiname + "add")
+        if not ranges:
+            return
+        recorded_at = datetime.now().isoformat()
+        rows = [
+            (
+                figi,
+                interval,
+                _from if isinstance(_from, str) else _from.isoformat(),
+                to if isinstance(to, str) else to.isoformat(),
+                source,
+                recorded_at,
+            )
+            for figi, _from, to in ranges
+        ]
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO ranges VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+        logger.info(f"{len(rows)} missing {interval} ranges recorded ({source})")
+
+    def earliest(self, interval):
+        """{figi: start of its earliest missing range}, timezone-aware datetimes."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT figi, range_from FROM ranges WHERE interval = ?", (interval,)
+            ).fetchall()
+        starts = {}
+        for figi, range_from in rows:
+            # offsets differ between sources, strings are not comparable
+            start = datetime.fromisoformat(range_from)
+            if figi not in starts or start < starts[figi]:
+                starts[figi] = start
+        return starts
+
+    def clear(self, interval, before=None):
+        """
+        Forgets missing ranges of interval recorded before the time, e.g. the
+        start of the download run that covered them. All of them by default.
+        """
+        with self._lock, self._db:
+            if before is None:
+                self._db.execute("DELETE FROM ranges WHERE interval = ?", (interval,))
+            else:
+                self._db.execute(
+                    "DELETE FROM ranges WHERE interval = ? AND recorded_at < ?",
+                    (interval, before.isoformat()),
+                )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
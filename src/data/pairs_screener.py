@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 20:36:15 2026
+
+@author: SParkhonyuk
+"""
+# Screening of all pairs of instruments for pairs trading: correlation of returns
+# and Engle-Granger cointegration test. Tests of many pairs are done at once with
+# NumPy array operations (OLS in closed form, ADF regression by batched normal
+# equations), batches of pairs are spread over a process pool.
+import logging
+import logging.config
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# in-house
+import panel as panel_builder
+import utilities_timers
+
+try:
+    from statsmodels.tsa.stattools import coint
+except ImportError:  # optional, used only by verify_pairs()
+    coint = None
+
+apiname = "PairsScreener::"
+# MacKinnon (2010) response surface of Engle-Granger critical values,
+# 2 variables, cointegrating regression with constant:
+# critical value = tau_inf + b1 / n_obs + b2 / n_obs**2
+eg_critical_values = {
+    "1%": (-3.89644, -10.9519, -22.527),
+    "5%": (-3.33613, -6.1101, -6.823),
+    "10%": (-3.04445, -4.2412, -2.720),
+}
+# max number of floats in one array of a batch, bounds memory of a worker
+max_batch_elements = 2**23
+# price matrix shared by pool workers, see _init_worker()
+_worker_prices = None
+
+
+##-------------------------------------------------------------------------------------------------
+def price_matrix(df, column="c", period_column=None, min_coverage=0.9):
+    """
+    Turns output of ClickhouseHelper.query_data_by_time into aligned price matrix.
+
+    Parameters
+    ----------
+    df : Pandas dataframe
+        Candles or bars with ticker column.
+    column : str
+        Price column. The default is "c" (close).
+    period_column : str, optional
+        Time column. The default is the first of time, hour, day, monday found in df.
+    min_coverage : float
+        Tickers with prices in less than this share of periods are dropped.
+        The default is 0.9.
+
+    Returns
+    -------
+    prices : Pandas dataframe, periods x tickers, sorted by time. Gaps of kept
+        tickers are forward filled, periods before the first price of any ticker
+        are dropped. See panel.build_panel() for other options of alignment.
+    """
+    panel = panel_builder.build_panel(
+        df, fields=[column], time_column=period_column, min_coverage=min_coverage
+    )
+    return panel.frame(column).dropna()
+
+
+##-------------------------------------------------------------------------------------------------
+def correlation_matrix(prices, is_returns=True):
+    """
+    Correlation of all pairs of columns, one matrix product.
+
+    Parameters
+    ----------
+    prices : Pandas dataframe, periods x tickers without gaps, see price_matrix().
+    is_returns : bool
+        Correlate log returns (True, default) or price levels.
+
+    Returns
+    -------
+    corr : Pandas dataframe, tickers x tickers.
+    """
+    values = prices.to_numpy(dtype=np.float64)
+    if is_returns:
+        values = np.diff(np.log(values), axis=0)
+    centered = values - values.mean(axis=0)
+    norm = np.sqrt((centered**2).sum(axis=0))
+    # constant series have no correlation with anything
+    norm[norm == 0] = np.nan
+    standardized = centered / norm
+    corr = standardized.T @ standardized
+    return pd.DataFrame(corr, index=prices.columns, columns=prices.columns)
+
+
+##-------------------------------------------------------------------------------------------------
+def critical_values(n_obs):
+    """Engle-Granger critical values for n_obs observations: {"1%": ..., "5%": ..., "10%": ...}."""
+    return {
+        level: tau_inf + b1 / n_obs + b2 / n_obs**2
+        for level, (tau_inf, b1, b2) in eg_critical_values.items()
+    }
+
+
+##-------------------------------------------------------------------------------------------------
+def engle_granger(values, pairs, n_lags=1):
+    """
+    Engle-Granger test of many pairs at once.
+
+    Every y = values[:, i] is regressed on x = values[:, j] with constant (OLS),
+    then ADF regression without constant is fitted to the residuals:
+    d(e)[t] = gamma * e[t-1] + sum of phi[k] * d(e)[t-k], k = 1..n_lags.
+    Same as statsmodels coint(y, x) with fixed lags (autolag=None).
+
+    Parameters
+    ----------
+    values : numpy array, periods x instruments, no gaps.
+    pairs : numpy array of int, pairs x 2
+        Columns (i, j) of y and x of every pair.
+    n_lags : int
+        Lagged differences in ADF regression. The default is 1.
+
+    Returns
+    -------
+    beta : numpy array, hedge ratio of every pair.
+    adf_stat : numpy array, t-statistic of gamma. Compare with critical_values().
+    gamma : numpy array, speed of mean reversion of the spread.
+    """
+    y = values[:, pairs[:, 0]]
+    x = values[:, pairs[:, 1]]
+    y = y - y.mean(axis=0)
+    x = x - x.mean(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        beta = (x * y).sum(axis=0) / (x * x).sum(axis=0)
+    resid = y - beta * x
+
+    diff = np.diff(resid, axis=0)
+    n_obs = diff.shape[0] - n_lags
+    # regressors: lagged level, then lagged differences, each obs x pairs
+    regressors = [resid[n_lags:-1]]
+    for lag in range(1, n_lags + 1):
+        regressors.append(diff[n_lags - lag : diff.shape[0] - lag])
+    target = diff[n_lags:]
+
+    # normal equations of all pairs, pairs x regressors x regressors
+    n_reg = n_lags + 1
+    ztz = np.empty((len(pairs), n_reg, n_reg))
+    zty = np.empty((len(pairs), n_reg))
+    for i in range(n_reg):
+        zty[:, i] = (regressors[i] * target).sum(axis=0)
+        for j in range(i, n_reg):
+            ztz[:, i, j] = ztz[:, j, i] = (regressors[i] * regressors[j]).sum(axis=0)
+    # degenerate pairs (constant spread) get nan instead of LinAlgError
+    singular = np.linalg.det(ztz) == 0
+    ztz[singular] = np.eye(n_reg)
+    ztz_inv = np.linalg.inv(ztz)
+    coef = np.einsum("bij,bj->bi", ztz_inv, zty)
+    fitted = sum(regressor * coef[:, i] for i, regressor in enumerate(regressors))
+    sigma2 = ((target - fitted) ** 2).sum(axis=0) / (n_obs - n_reg)
+    gamma = coef[:, 0]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        adf_stat = gamma / np.sqrt(sigma2 * ztz_inv[:, 0, 0])
+    adf_stat[singular] = np.nan
+    return beta, adf_stat, gamma
+
+
+##-------------------------------------------------------------------------------------------------
+def _batch_size(n_periods, n_lags):
+    return max(1, max_batch_elements // (n_periods * (n_lags + 1)))
+
+
+def _init_worker(values):
+    global _worker_prices
+    _worker_prices = values
+
+
+def _screen_chunk(pairs, n_lags):
+    """Tests chunk of pairs in batches. Executed in a pool worker."""
+    batch = _batch_size(_worker_prices.shape[0], n_lags)
+    results = [
+        engle_granger(_worker_prices, pairs[start : start + batch], n_lags=n_lags)
+        for start in range(0, len(pairs), batch)
+    ]
+    return [np.concatenate(arrays) for arrays in zip(*results)]
+
+
+##-------------------------------------------------------------------------------------------------
+def screen_pairs(
+    prices,
+    min_corr=None,
+    n_lags=1,
+    significance="5%",
+    max_workers=None,
+    chunk_pairs=50000,
+):
+    """
+    Tests all pairs of instruments for cointegration.
+
+    Parameters
+    ----------
+    prices : Pandas dataframe, periods x tickers without gaps, see price_matrix().
+    min_corr : float, optional
+        Test only pairs with correlation of returns not less than min_corr.
+        All pairs are tested by default.
+    n_lags : int
+        Lagged differences in ADF regression, see engle_granger(). The default is 1.
+    significance : str
+        "1%", "5%" or "10%", level of is_cointegrated. The default is "5%".
+    max_workers : int, optional
+        Number of processes. The default is number of CPUs. 1 to test in this process.
+    chunk_pairs : int
+        Pairs per task of the pool. The default is 50000.
+
+    Returns
+    -------
+    df : Pandas dataframe with one row per tested pair: y, x (tickers), corr,
+        beta (hedge ratio, spread = y - beta * x), adf_stat, half_life (periods),
+        is_cointegrated. Sorted by adf_stat, the most cointegrated first.
+    """
+    start = time.time()
+    logger = logging.getLogger(apiname + screen_pairs.__name__)
+
+    tickers = np.asarray(prices.columns)
+    values = np.ascontiguousarray(prices.to_numpy(dtype=np.float64))
+    corr = correlation_matrix(prices).to_numpy()
+    first, second = np.triu_indices(len(tickers), k=1)
+    if min_corr is not None:
+        is_candidate = corr[first, second] >= min_corr
+        first, second = first[is_candidate], second[is_candidate]
+    pairs = np.column_stack([first, second])
+    logger.info(
+        f"testing {len(pairs)} pairs of {len(tickers)} instruments, "
+        f"{values.shape[0]} periods"
+    )
+
+    chunks = [
+        pairs[chunk_start : chunk_start + chunk_pairs]
+        for chunk_start in range(0, len(pairs), chunk_pairs)
+    ]
+    if max_workers == 1 or len(chunks) <= 1:
+        _init_worker(values)
+        results = [_screen_chunk(chunk, n_lags) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=max_workers, initializer=_init_worker, initargs=(values,)
+        ) as executor:
+            results = list(executor.map(_screen_chunk, chunks, [n_lags] * len(chunks)))
+    if results:
+        beta, adf_stat, gamma = [np.concatenate(arrays) for arrays in zip(*results)]
+    else:
+        beta = adf_stat = gamma = np.array([], dtype=np.float64)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        half_life = np.where(
+            (gamma < 0) & (gamma > -1), -np.log(2) / np.log1p(gamma), np.inf
+        )
+    n_obs = values.shape[0] - n_lags - 1
+    df = pd.DataFrame(
+        {
+            "y": tickers[pairs[:, 0]],
+            "x": tickers[pairs[:, 1]],
+            "corr": corr[pairs[:, 0], pairs[:, 1]],
+            "beta": beta,
+            "adf_stat": adf_stat,
+            "half_life": half_life,
+            "is_cointegrated": adf_stat < critical_values(n_obs)[significance],
+        }
+    )
+    df = df.sort_values("adf_stat", kind="stable").reset_index(drop=True)
+
+    timer_string = utilities_timers.format_timer_string(time.time() - start)
+    logger.info(timer_string)
+    logger.info(
+        f"{df.is_cointegrated.sum()} of {len(df)} pairs are cointegrated "
+        f"at {significance} level"
+    )
+    return df
+
+
+##-------------------------------------------------------------------------------------------------
+def verify_pairs(prices, pairs, n_best=20):
+    """
+    p-values of the best screened pairs by statsmodels coint (optional dependency).
+
+    Parameters
+    ----------
+    prices : Pandas dataframe, periods x tickers, see price_matrix().
+    pairs : Pandas dataframe, output of screen_pairs().
+    n_best : int
+        Number of pairs from the top of pairs to verify. The default is 20.
+
+    Returns
+    -------
+    df : n_best rows of pairs with pvalue column. None if statsmodels is not installed.
+    """
+    logger = logging.getLogger(apiname + verify_pairs.__name__)
+    if coint is None:
+        logger.error("statsmodels is not installed, pairs are not verified")
+        return None
+    df = pairs.head(n_best).copy()
+    df["pvalue"] = [
+        coint(prices[y].to_numpy(), prices[x].to_numpy())[1] for y, x in zip(df.y, df.x)
+    ]
+    return df
+
+
+##-------------------------------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    import ClickhouseHelper as chh
+
+    logging.config.fileConfig(fname="logger.conf", disable_existing_loggers=False)
+    logger = logging.getLogger(__name__)
+
+    logger.info("PairsScreener main")
+
+    frames = [
+        chh.query_data_by_time(
+            channels_list=["day", "ticker", "c"],
+            days_span=360,
+            server_ip="192.168.1.128",
+            instrument_type=instrument_type,
+            data_freq="day",
+        )
+        for instrument_type in ["Etf", "Stock"]
+    ]
+    prices = price_matrix(pd.concat(frames))
+    df = screen_pairs(prices, min_corr=0.5)
+    logger.info(f"\n{df[df.is_cointegrated].head(20).to_string()}")
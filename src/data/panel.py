@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 21:05:40 2026
+
+@author: SParkhonyuk
+"""
+# Aligned wide panel of candles: long (time, ticker, OHLCV) rows of
+# ClickhouseHelper.query_data_by_time become time x ticker NumPy arrays on one
+# time grid, with masks of observed and filled values. Streamed chunks are
+# added one by one, so the panel is built without a full long dataframe.
+import logging
+import logging.config
+import time
+
+import numpy as np
+import pandas as pd
+
+# in-house
+import trading_calendar
+import utilities_timers
+
+apiname = "Panel::"
+# candle columns taken by default, the ones present in the data
+panel_fields = ["o", "c", "h", "l", "v"]
+# fields filled by a constant instead of last value: no trades means no volume
+panel_fill_values = {"v": 0}
+
+
+##-------------------------------------------------------------------------------------------------
+def _time_column(df):
+    """First of time, hour, day, monday columns of df."""
+    for col in ["time", "hour", "day", "monday"]:
+        if col in df.columns:
+            return col
+    raise KeyError("no time column (time, hour, day or monday) in data")
+
+
+def _forward_fill_source(observed, limit=None):
+    """
+    Forward fill of T x N panel, at most limit periods after an observation
+    (without limit if None). Returns mask of filled cells and row of the value
+    of every cell, for np.take_along_axis; gaps left after the fill point to row 0.
+    """
+    rows = np.arange(observed.shape[0], dtype=np.int32)[:, None]
+    last = np.where(observed, rows, -1)
+    np.maximum.accumulate(last, axis=0, out=last)
+    is_filled = (last >= 0) & ~observed
+    if limit is not None:
+        is_filled &= rows - last <= limit
+    last[~(observed | is_filled)] = 0
+    return is_filled, last
+
+
+##-------------------------------------------------------------------------------------------------
+class Panel:
+    """
+    Candles of many instruments on one time grid.
+
+    Attributes
+    ----------
+    index : pd.Index
+        Time grid, sorted.
+    columns : pd.Index
+        Tickers (or FIGIs).
+    values : dict
+        {field: numpy array len(index) x len(columns), float64}. nan in gaps.
+    observed : numpy array of bool
+        True where the instrument has a candle at the period.
+    filled : numpy array of bool
+        True where the value is forward filled (fields without fill value).
+    """
+
+    def __init__(self, index, columns, values, observed, filled):
+        self.index = index
+        self.columns = columns
+        self.values = values
+        self.observed = observed
+        self.filled = filled
+
+    def __getitem__(self, field):
+        return self.values[field]
+
+    @property
+    def fields(self):
+        return list(self.values)
+
+    @property
+    def gaps(self):
+        """True where the value is still missing after filling."""
+        return ~(self.observed | self.filled)
+
+    def frame(self, field="c"):
+        """Field as dataframe, periods x tickers."""
+        return pd.DataFrame(self.values[field], index=self.index, columns=self.columns)
+
+    def dropna(self):
+        """Panel of periods where every instrument has a value of every field."""
+        is_complete = ~self.gaps.any(axis=1)
+        return Panel(
+            self.index[is_complete],
+            self.columns,
+            {field: values[is_complete] for field, values in self.values.items()},
+            self.observed[is_complete],
+            self.filled[is_complete],
+        )
+
+
+##-------------------------------------------------------------------------------------------------
+class PanelBuilder:
+    """
+    Collects long candles chunk by chunk and builds Panel of them.
+
+    Only time, key and fields are kept from every chunk, as NumPy arrays,
+    so a streamed query (query_data_by_time with chunk_size) is built
+    into a panel without keeping the dataframes.
+
+    Usage:
+        builder = PanelBuilder(fields=["c", "v"])
+        for df in ClickhouseHelper.query_data_by_time(..., chunk_size=100000):
+            builder.add(df)
+        panel = builder.build(min_coverage=0.9)
+
+    Parameters
+    ----------
+    fields : list, optional
+        Columns to put into the panel. The default is panel_fields present in the first chunk.
+    key : string
+        Column of instrument id. The default is "ticker".
+    time_column : string, optional
+        The default is the first of time, hour, day, monday found in the first chunk.
+    """
+
+    def __init__(self, fields=None, key="ticker", time_column=None):
+        self.fields = fields
+        self.key = key
+        self.time_column = time_column
+        self.n_rows = 0
+        self._ids = {}
+        self._times = []
+        self._cols = []
+        self._values = []
+
+    def add(self, df):
+        """Adds a chunk of long candles."""
+        if len(df) == 0:
+            return
+        if self.time_column is None:
+            self.time_column = _time_column(df)
+        if self.fields is None:
+            self.fields = [field for field in panel_fields if field in df.columns]
+        codes, uniques = pd.factorize(df[self.key])
+        ids = np.array([self._ids.setdefault(key, len(self._ids)) for key in uniques])
+        self._cols.append(ids[codes])
+        self._times.append(pd.to_datetime(df[self.time_column]).to_numpy())
+        self._values.append(
+            np.column_stack(
+                [df[field].to_numpy(dtype=np.float64) for field in self.fields]
+            )
+        )
+        self.n_rows += len(df)
+
+    def build(
+        self,
+        grid=None,
+        freq=None,
+        ffill_limit=None,
+        fill_values=panel_fill_values,
+        min_coverage=0.0,
+        calendar=None,
+    ):
+        """
+        Builds the panel of all added chunks.
+
+        Parameters
+        ----------
+        grid : array of datetimes, optional
+            Time grid. Candles out of the grid are dropped.
+            The default is all times of the data, or regular grid if freq is set.
+        freq : string, optional
+            Regular grid from the first to the last candle, e.g. "1min", "1h", "1D".
+            Days without trading (see trading_calendar) are not in the grid.
+        ffill_limit : int, optional
+            Max number of periods a value is carried forward. The default is
+            no limit, 0 disables forward fill.
+        fill_values : dict
+            {field: value} used in the gaps instead of forward fill.
+            The default is panel_fill_values (zero volume).
+        min_coverage : float
+            Instruments observed in less than this share of periods are dropped.
+            The default is 0, all instruments are kept.
+        calendar : trading_calendar.TradingCalendar, optional
+            Calendar of the regular grid. The default is the shared calendar.
+
+        Returns
+        -------
+        panel : Panel. None if nothing was added.
+        """
+        start = time.time()
+        logger = logging.getLogger(apiname + "build")
+        if self.n_rows == 0:
+            logger.error("no data to build panel of")
+            return None
+
+        times = np.concatenate(self._times)
+        cols = np.concatenate(self._cols)
+        data = np.concatenate(self._values)
+        if grid is not None:
+            index = pd.DatetimeIndex(grid).sort_values()
+        elif freq is not None:
+            index = pd.date_range(times.min(), times.max(), freq=freq)
+            if calendar is None:
+                calendar = trading_calendar.get_calendar()
+            days = calendar.trading_days(index[0].date(), index[-1].date())
+            index = index[index.normalize().isin(pd.DatetimeIndex(days))]
+        else:
+            index = pd.DatetimeIndex(np.unique(times))
+
+        rows = index.get_indexer(times)
+        is_on_grid = rows >= 0
+        if not is_on_grid.all():
+            logger.info(f"{(~is_on_grid).sum()} candles out of the grid are dropped")
+            rows, cols, data = rows[is_on_grid], cols[is_on_grid], data[is_on_grid]
+
+        shape = (len(index), len(self._ids))
+        observed = np.zeros(shape, dtype=bool)
+        observed[rows, cols] = True
+        keep = observed.mean(axis=0) >= min_coverage
+        columns = pd.Index(list(self._ids))[keep]
+        observed = observed[:, keep]
+        # columns of kept instruments in the panel, -1 for dropped ones
+        new_cols = np.cumsum(keep) - 1
+        is_kept = keep[cols]
+        rows, cols, data = rows[is_kept], new_cols[cols[is_kept]], data[is_kept]
+
+        filled, source = _forward_fill_source(observed, limit=ffill_limit)
+        gaps = ~(observed | filled)
+        values = {}
+        for i, field in enumerate(self.fields):
+            array = np.full(observed.shape, np.nan)
+            # duplicated candles: the last added one wins
+            array[rows, cols] = data[:, i]
+            if field in fill_values:
+                array[~observed] = fill_values[field]
+            else:
+                array = np.take_along_axis(array, source, axis=0)
+                array[gaps] = np.nan
+            values[field] = array
+        panel = Panel(index, columns, values, observed, filled)
+
+        timer_string = utilities_timers.format_timer_string(time.time() - start)
+        logger.info(timer_string)
+        logger.info(
+            f"panel of {len(index)} periods x {len(columns)} instruments "
+            f"({(~keep).sum()} dropped by coverage), {panel.gaps.mean():.1%} gaps"
+        )
+        return panel
+
+
+##-------------------------------------------------------------------------------------------------
+def build_panel(data, fields=None, key="ticker", time_column=None, **kwargs):
+    """
+    Builds aligned panel of long candles.
+
+    Parameters
+    ----------
+    data : Pandas dataframe or iterable of dataframes
+        Output of ClickhouseHelper.query_data_by_time, streamed (chunk_size) or not.
+    fields, key, time_column :
+        See PanelBuilder.
+    **kwargs :
+        See PanelBuilder.build (grid, freq, ffill_limit, fill_values, min_coverage, calendar).
+
+    Returns
+    -------
+    panel : Panel
+    """
+    builder = PanelBuilder(fields=fields, key=key, time_column=time_column)
+    if isinstance(data, pd.DataFrame):
+        data = [data]
+    for df in data:
+        builder.add(df)
+    return builder.build(**kwargs)
+
+
+##-------------------------------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    import ClickhouseHelper as chh
+
+    logging.config.fileConfig(fname="logger.conf", disable_existing_loggers=False)
+    logger = logging.getLogger(__name__)
+
+    logger.info("Panel main")
+
+    chunks = chh.query_data_by_time(
+        channels_list=["time", "ticker", "c", "v"],
+        days_span=30,
+        server_ip="192.168.1.128",
+        instrument_type="Etf",
+        chunk_size=chh.query_chunk_size,
+    )
+    panel = build_panel(chunks, ffill_limit=60, min_coverage=0.5)
+    logger.info(f"\n{panel.frame('c').tail().to_string()}")
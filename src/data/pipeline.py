@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 18:52:44 2026
+
+@author: SParkhonyuk
+"""
+# Download-to-insert pipeline. Download threads of tinkoffAPIHelper.iter_candles
+# produce candles of one request at a time, a writer thread inserts them into
+# Clickhouse in batches. Queue between them is bounded, so memory stays flat
+# whatever the number of requests, and downloads go on while a batch is written.
+import queue
+import threading
+import logging
+import logging.config
+import time
+
+import pandas as pd
+from tqdm import tqdm
+
+# in-house
+import ClickhouseHelper as chh
+import tinkoffAPIHelper as tapi
+import utilities_timers
+import metrics
+
+apiname = "Pipeline::"
+# rows per insert of the writer
+batch_rows = 200000
+# downloaded requests waiting for the writer
+max_queue = 256
+# seconds to wait for the writer to stop after an error
+stop_timeout = 30
+
+
+##-------------------------------------------------------------------------------------------------
+class CandleWriter:
+    """
+    Writer thread that inserts downloaded candles into Clickhouse in batches.
+
+    Candles of every request are put to a bounded queue; put() blocks while
+    the queue is full, so downloads slow down to the insert rate instead of
+    piling up in memory. Only candles are written, instruments are kept
+    in their own table (see ClickhouseHelper.upsert_instruments).
+    Monthly partitions touched by the inserts are collected in months.
+
+    Usage:
+        with CandleWriter("minutes", "192.168.1.128") as writer:
+            for task, df in tinkoffAPIHelper.iter_candles(con, tasks):
+                writer.put(task, df)
+
+    Parameters
+    ----------
+    table_name : string
+        Target table, written with ClickhouseHelper.upsert_df_to_SQL_table().
+    server_ip : string
+        ip adress of Clickhouse instance. localhost by default.
+    batch_rows : int
+        Rows per insert.
+    max_queue : int
+        Max number of requests waiting for the writer.
+    on_written : callable, optional
+        Called from the writer thread with list of (task, rows) after every insert,
+        e.g. to record progress (see backfill.Checkpoint).
+    """
+
+    def __init__(
+        self,
+        table_name,
+        server_ip="localhost",
+        batch_rows=batch_rows,
+        max_queue=max_queue,
+        on_written=None,
+    ):
+        self.table_name = table_name
+        self.server_ip = server_ip
+        self.batch_rows = batch_rows
+        self.on_written = on_written
+        self.n_rows = 0
+        self.n_batches = 0
+        self.months = set()
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._registry = metrics.get_registry()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, task, df):
+        """Queue candles of one request. Raises if the writer has failed."""
+        while True:
+            if self._error is not None:
+                raise RuntimeError("candle writer failed") from self._error
+            try:
+                self._queue.put((task, df), timeout=1)
+                depth = self._queue.qsize()
+                self._registry.set("queue_depth", depth, queue="writer")
+                self._registry.set_max("queue_depth_max", depth, queue="writer")
+                return
+            except queue.Full:
+                continue
+
+    def close(self):
+        """Write the rest of candles and stop the writer. Raises if it has failed."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise RuntimeError("candle writer failed") from self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # stop without writing the rest, the error is raised anyway
+            self._error = self._error or exc_value
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                # the writer is not waiting for items and will see the error
+                pass
+            # an insert in progress is finished, so no connection is left in use
+            self._thread.join(timeout=stop_timeout)
+            if self._thread.is_alive():
+                logging.getLogger(apiname + "writer").error(
+                    f"writer did not stop in {stop_timeout} s"
+                )
+
+    def _run(self):
+        logger = logging.getLogger(apiname + "writer")
+        batch = []
+        n_batch_rows = 0
+        while True:
+            item = self._queue.get()
+            if item is None or self._error is not None:
+                break
+            batch.append(item)
+            n_batch_rows += len(item[1])
+            if n_batch_rows >= self.batch_rows:
+                if not self._write(batch, logger):
+                    return
+                batch = []
+                n_batch_rows = 0
+        if batch and self._error is None:
+            self._write(batch, logger)
+
+    def _write(self, batch, logger):
+        start = time.time()
+        try:
+            frames = [df for _, df in batch if len(df) > 0]
+            if frames:
+                df = pd.concat(frames)
+                chh.upsert_df_to_SQL_table(
+                    df=df, table_name=self.table_name, server_ip=self.server_ip
+                )
+                self.n_rows += len(df)
+                # a day more on both sides: partitions follow time zone of the server
+                times = pd.to_datetime(df.time, utc=True)
+                self.months.update(
+                    pd.period_range(
+                        times.min() - pd.Timedelta(days=1),
+                        times.max() + pd.Timedelta(days=1),
+                        freq="M",
+                    ).strftime("%Y%m")
+                )
+            self.n_batches += 1
+            if self.on_written is not None:
+                self.on_written([(task, len(candles)) for task, candles in batch])
+        except Exception as exc:
+            logger.error(f"generated an exception: {exc}")
+            self._error = exc
+            # unblock producer waiting on the full queue
+            while not self._queue.empty():
+                self._queue.get_nowait()
+            return False
+        timer_string = utilities_timers.format_timer_string(time.time() - start)
+        logger.debug(
+            f"batch {self.n_batches} of {len(batch)} requests written. {timer_string}"
+        )
+        return True
+
+
+##-------------------------------------------------------------------------------------------------
+def download_to_clickhouse(
+    con,
+    ranges,
+    interval="1min",
+    server_ip="localhost",
+    table_name=None,
+    max_workers=8,
+    limiter=None,
+    is_probe_days=True,
+    skip=None,
+    on_written=None,
+    tasks=None,
+):
+    """
+    Downloads candles and writes them to Clickhouse while download goes on.
+    Instruments of ranges must be written to instruments table
+    (see ClickhouseHelper.upsert_instruments), queries read ticker and type there.
+
+    Parameters
+    ----------
+    con(connector) : TinkoffAPI connector. Create one using tinkoffAPIHelper.connect()
+    ranges : dict
+        {figi: (_from, to)}, see tinkoffAPIHelper.request_ranges().
+    interval : str
+        Candles interval. The default is "1min".
+    server_ip : string
+        ip adress of Clickhouse instance. localhost by default.
+    table_name : string, optional
+        Target table. The default is the table of interval,
+        see ClickhouseHelper.interval_table().
+    max_workers : int
+        Number of download threads. The default is 8.
+    limiter : rate_limiter.TokenBucket, optional
+        The default is shared limiter of the process.
+    is_probe_days : bool
+        Skip days without trades, see tinkoffAPIHelper.plan_requests().
+        The default is True.
+    skip : set, optional
+        Requests (figi, _from, to) not to download, e.g. done by previous run.
+    on_written : callable, optional
+        See CandleWriter.
+    tasks : list, optional
+        Requests (figi, _from, to) planned before, e.g. by previous run.
+        The default is tinkoffAPIHelper.plan_requests() of ranges.
+
+    Returns
+    -------
+    failed : list
+        Failed requests (figi, _from, to), their candles are missing.
+        Watermarks of the next incremental run are beyond them, so the caller
+        has to retry or record them.
+    """
+    start = time.time()
+    logger = logging.getLogger(apiname + download_to_clickhouse.__name__)
+
+    if table_name is None:
+        table_name = chh.interval_table(interval)
+    if tasks is None:
+        tasks = tapi.plan_requests(
+            con,
+            ranges,
+            interval=interval,
+            max_workers=max_workers,
+            limiter=limiter,
+            is_probe_days=is_probe_days,
+        )
+    if skip:
+        n_planned = len(tasks)
+        tasks = [task for task in tasks if task not in skip]
+        logger.info(f"{n_planned - len(tasks)} of {n_planned} requests skipped")
+    logger.info(
+        f"{len(tasks)} requests for {len(ranges)} FIGIs using {max_workers} workers"
+    )
+
+    registry = metrics.get_registry()
+    failed = []
+    n_downloaded = 0
+    with CandleWriter(table_name, server_ip, on_written=on_written) as writer:
+        for task, df in tqdm(
+            tapi.iter_candles(
+                con, tasks, interval=interval, max_workers=max_workers, limiter=limiter
+            ),
+            total=len(tasks),
+        ):
+            if df is None:
+                failed.append(task)
+                registry.inc("failed_requests_total")
+            else:
+                registry.inc("downloaded_rows_total", len(df))
+                n_downloaded += len(df)
+                writer.put(task, df)
+    if failed:
+        logger.error(
+            f"{len(failed)} of {len(tasks)} requests failed, their data is missing"
+        )
+    if writer.months:
+        # views counted candles inserted again (e.g. retried requests) twice
+        with chh.get_pool(server_ip).connection() as ch_con:
+            chh.refresh_aggregate_views(
+                ch_con, table_name, months=sorted(writer.months)
+            )
+
+    elapsed = time.time() - start
+    registry.set("download_rows_per_second", n_downloaded / elapsed, table=table_name)
+    insert_rate = chh.insert_rate(table_name)
+    if insert_rate is not None:
+        registry.set("insert_rows_per_second", insert_rate, table=table_name)
+    timer_string = utilities_timers.format_timer_string(elapsed)
+    logger.info(timer_string)
+    logger.info(
+        f"{writer.n_rows} rows written to {table_name} in {writer.n_batches} batches, "
+        f"{writer.n_rows / elapsed:.0f} rows/s"
+    )
+    return failed
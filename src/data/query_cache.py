@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 14:05:12 2026
+
+@author: SParkhonyuk
+"""
+# this file will require the following package installation:
+# conda install -c conda-forge pyarrow
+import os
+import logging
+import logging.config
+from datetime import datetime, timedelta
+import time
+
+import pandas as pd
+
+# in-house
+import ClickhouseHelper as chh
+import utilities_timers
+
+apiname = "QueryCache::"
+# column that defines the period (file) every row belongs to
+period_columns = {"min": "time", "hour": "hour", "day": "day", "week": "monday"}
+# data/interim/query_cache of this repository
+default_cache_dir = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "..",
+    "data",
+    "interim",
+    "query_cache",
+)
+
+
+##-------------------------------------------------------------------------------------------------
+class QueryCache:
+    """
+    Local on-disk cache of ClickhouseHelper.query_data_by_time results.
+
+    Results are stored as one Parquet file per day (per week for "week" data) in
+    <cache_dir>/<table_name>/<instrument_type>/<data_freq>/YYYY-MM-DD.<version>.parquet.
+    Only periods fully inside the requested range and older than settle_days are
+    cached. Version is the last change of Clickhouse partitions of the period
+    (see ClickhouseHelper.get_partition_versions), so files of periods changed
+    later, e.g. by backfill of new instruments, are not used and get replaced.
+    Request is answered from cached files, the missing periods are fetched
+    from Clickhouse (one query per run of consecutive missing periods) and saved.
+    When size of the cache exceeds max_bytes, the least recently used files are removed.
+
+    Parameters
+    ----------
+    cache_dir : string
+        Root directory of the cache. The default is QUERY_CACHE_DIR environment
+        variable or data/interim/query_cache of this repository (default_cache_dir).
+    max_bytes : int
+        Size limit of the cache. The default is 10 GB.
+    settle_days : int
+        Periods that ended less than settle_days ago are not cached, because
+        the downloader may still add data to them. The default is 1 day.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=10 * 2**30, settle_days=1):
+        if cache_dir is None:
+            cache_dir = os.environ.get("QUERY_CACHE_DIR", default_cache_dir)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.settle_days = settle_days
+
+    def _key_dir(self, table_name, instrument_type, data_freq):
+        return os.path.join(self.cache_dir, table_name, instrument_type, data_freq)
+
+    @staticmethod
+    def _periods(startTime, endTime, data_freq):
+        """List of (period start, period end) covering [startTime, endTime]."""
+        first = datetime.combine(startTime.date(), datetime.min.time())
+        step = timedelta(days=1)
+        if data_freq == "week":
+            first = first - timedelta(days=first.weekday())
+            step = timedelta(days=7)
+        periods = []
+        while first <= endTime:
+            periods.append((first, first + step))
+            first = first + step
+        return periods
+
+    @staticmethod
+    def _period_of_rows(df, data_freq):
+        """Start of the period of every row of df."""
+        column = pd.to_datetime(df[period_columns[data_freq]])
+        if data_freq in ["min", "hour"]:
+            column = column.dt.floor("D")
+        return column
+
+    @staticmethod
+    def _version(versions, period_start, period_end):
+        """Version of the period: the latest change of its partitions."""
+        # daily candles of the 1st day are stamped the evening before (UTC),
+        # so they are in the partition of the previous month
+        months = set(
+            (period_start + timedelta(days=k)).strftime("%Y%m")
+            for k in range(-1, (period_end - period_start).days)
+        )
+        return max(versions.get(month, 0) for month in months)
+
+    @staticmethod
+    def _write(df, path):
+        """Writes file at once, so readers never see a partly written one."""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+        # files of older versions of the period
+        prefix = os.path.basename(path).split(".")[0] + "."
+        key_dir = os.path.dirname(path)
+        for name in os.listdir(key_dir):
+            if name.startswith(prefix) and name.endswith(".parquet"):
+                if name != os.path.basename(path):
+                    os.remove(os.path.join(key_dir, name))
+
+    def _fetch(self, startTime, endTime, **query_kwargs):
+        return chh.query_data_by_time(
+            channels_list=None, startTime=startTime, endTime=endTime, **query_kwargs
+        )
+
+    def query(
+        self,
+        startTime=None,
+        endTime=None,
+        days_span=90,
+        server_ip="localhost",
+        table_name="minutes",
+        instrument_type="Etf",
+        data_freq="min",
+        is_numpy=False,
+        pool=None,
+    ):
+        """
+        Same as ClickhouseHelper.query_data_by_time, answered from the cache where possible.
+
+        Returns
+        -------
+        df : Pandas dataframe. All columns of the table in a given time range.
+            None if Clickhouse query is not possible (see query_data_by_time).
+        """
+        start = time.time()
+        logger = logging.getLogger(apiname + "query")
+
+        if endTime is None:
+            endTime = datetime.now()
+        if startTime is None:
+            startTime = endTime - timedelta(days=days_span)
+        query_kwargs = dict(
+            server_ip=server_ip,
+            table_name=table_name,
+            instrument_type=instrument_type,
+            data_freq=data_freq,
+            is_numpy=is_numpy,
+            pool=pool,
+        )
+        key_dir = self._key_dir(table_name, instrument_type, data_freq)
+        os.makedirs(key_dir, exist_ok=True)
+        settled = datetime.now() - timedelta(days=self.settle_days)
+        # BETWEEN in queries includes endTime
+        end_exclusive = endTime + timedelta(seconds=1)
+        if startTime < settled:
+            with (pool or chh.get_pool(server_ip)).connection() as con:
+                versions = chh.get_partition_versions(con, table_name)
+        else:
+            # nothing settled to be cached
+            versions = {}
+
+        # action for every period: "read" from cache, "store" to cache after fetch,
+        # or "fetch" only (partial or recent periods)
+        plan = []
+        for period_start, period_end in self._periods(startTime, endTime, data_freq):
+            version = self._version(versions, period_start, period_end)
+            path = os.path.join(
+                key_dir, f"{period_start.strftime('%Y-%m-%d')}.{version}.parquet"
+            )
+            is_full = startTime <= period_start and period_end <= end_exclusive
+            if is_full and period_end <= settled:
+                action = "read" if os.path.exists(path) else "store"
+            else:
+                action = "fetch"
+            plan.append((action, period_start, period_end, path))
+
+        frames = []
+        n_read = 0
+        n_queries = 0
+        i = 0
+        while i < len(plan):
+            action = plan[i][0]
+            j = i
+            while j + 1 < len(plan) and plan[j + 1][0] == action:
+                j += 1
+            run = plan[i : j + 1]
+            i = j + 1
+
+            if action == "read":
+                for _, _, _, path in run:
+                    frames.append(pd.read_parquet(path))
+                    # modification time is used as last access time for eviction
+                    os.utime(path)
+                n_read += len(run)
+                continue
+
+            fetch_start = max(run[0][1], startTime)
+            fetch_end = min(run[-1][2] - timedelta(seconds=1), endTime)
+            df = self._fetch(fetch_start, fetch_end, **query_kwargs)
+            n_queries += 1
+            if df is None:
+                logger.error("Clickhouse query failed, nothing is cached")
+                return None
+            frames.append(df)
+            if action == "store":
+                row_periods = self._period_of_rows(df, data_freq)
+                for _, period_start, _, path in run:
+                    self._write(df[(row_periods == period_start).to_numpy()], path)
+
+        self._evict()
+
+        df = pd.concat(frames, ignore_index=True)
+        if data_freq != "min":
+            df = df.sort_values(
+                period_columns[data_freq], ascending=False, kind="stable"
+            ).reset_index(drop=True)
+
+        timer_string = utilities_timers.format_timer_string(time.time() - start)
+        logger.info(timer_string)
+        logger.info(
+            f"{n_read} periods read from cache, {n_queries} queries to Clickhouse. "
+            f"Dataframe has shape : {df.shape}."
+        )
+        return df
+
+    def _evict(self):
+        """Removes least recently used files while cache is bigger than max_bytes."""
+        logger = logging.getLogger(apiname + "evict")
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith(".parquet"):
+                    stat = os.stat(os.path.join(root, name))
+                    files.append(
+                        (stat.st_mtime, stat.st_size, os.path.join(root, name))
+                    )
+        total = sum(size for _, size, _ in files)
+        if total <= self.max_bytes:
+            return
+        files.sort()
+        n_removed = 0
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+            n_removed += 1
+        logger.info(f"removed {n_removed} files, cache size is {total / 2**20:.0f} MB")
+
+    def clear(self):
+        """Removes all cached files."""
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith(".parquet"):
+                    os.remove(os.path.join(root, name))
+
+
+##-------------------------------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    logging.config.fileConfig(fname="logger.conf", disable_existing_loggers=False)
+    logger = logging.getLogger(__name__)
+
+    logger.info("QueryCache main")
+
+    cache = QueryCache()
+    # the first call fills the cache, the second one is answered from disk
+    for i in range(2):
+        df = chh.query_data_by_time(
+            channels_list=[],
+            days_span=360,
+            server_ip="192.168.1.128",
+            instrument_type="Stock",
+            cache=cache,
+        )
+        logger.info(f"query returns table (rows, columns)={df.shape}")
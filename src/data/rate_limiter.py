@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 10:12:41 2026
+
+@author: SParkhonyuk
+"""
+import threading
+import time
+
+
+##-------------------------------------------------------------------------------------------------
+class TokenBucket:
+    """
+    Thread-safe token bucket limiter.
+
+    Tokens are refilled continuously at rate requests_per_minute / 60 per second,
+    up to capacity. Every request takes one token; if the bucket is empty, the
+    caller sleeps until a token becomes available. One bucket shared by all
+    download threads keeps the whole process within the broker's quota.
+
+    Parameters
+    ----------
+    requests_per_minute : int
+        Broker quota for the endpoint.
+    capacity : int, optional
+        Maximum burst size. The default is requests_per_minute / 6,
+        i.e. a burst is never bigger than 10 seconds worth of quota.
+    """
+
+    def __init__(self, requests_per_minute=120, capacity=None):
+        self.rate = requests_per_minute / 60.0
+        if capacity is None:
+            capacity = max(1, int(requests_per_minute / 6))
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def acquire(self, tokens=1):
+        """
+        Block until tokens are available and take them.
+
+        Returns
+        -------
+        waited : float
+            Seconds spent waiting for the bucket.
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return waited
+                delay = (tokens - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 21:48:12 2026
+
+@author: SParkhonyuk
+"""
+# Rolling statistics of prices and pair spreads: mean, variance, z-score and
+# hedge ratio over the last window bars. Live mode keeps running sums over
+# ring buffers, so a new bar costs O(1) per series whatever the window.
+# Batch mode computes the same statistics over stored history with cumulative sums.
+import logging
+import logging.config
+import time
+
+import numpy as np
+import pandas as pd
+
+# in-house
+import utilities_timers
+
+apiname = "RollingStats::"
+# minute bars of one trading session of Moscow Exchange
+default_window = 390
+
+
+##-------------------------------------------------------------------------------------------------
+def _first_valid(values):
+    """First not nan value of every column, 0 for empty columns."""
+    is_valid = ~np.isnan(values)
+    first = is_valid.argmax(axis=0)
+    shift = values[first, np.arange(values.shape[1])]
+    return np.where(is_valid.any(axis=0), shift, 0.0)
+
+
+def _rolling_sum(values, window):
+    """Sum of the last window rows, for every row of T x N array."""
+    total = np.cumsum(values, axis=0)
+    total[window:] = total[window:] - total[:-window]
+    return total
+
+
+def _moments(n, sx, sxx):
+    """Mean and variance (ddof=1) from count, sum and sum of squares."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = sx / n
+        var = (sxx - sx * mean) / (n - 1)
+    return mean, np.maximum(var, 0.0)
+
+
+def _regression(n, sx, sy, sxx, sxy, syy):
+    """Beta, alpha and spread variance of y = alpha + beta * x + spread from sums."""
+    mean_x, var_x = _moments(n, sx, sxx)
+    mean_y, var_y = _moments(n, sy, syy)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cov = (sxy - sx * mean_y) / (n - 1)
+        beta = cov / var_x
+    alpha = mean_y - beta * mean_x
+    return beta, alpha, np.maximum(var_y - beta * cov, 0.0)
+
+
+def _zscore(value, mean, var):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (value - mean) / np.sqrt(var)
+
+
+##-------------------------------------------------------------------------------------------------
+def rolling_moments(values, window=default_window, min_periods=None):
+    """
+    Rolling mean, variance (ddof=1) and z-score of the last value, batch mode.
+
+    Parameters
+    ----------
+    values : numpy array, bars x series (e.g. panel.Panel["c"]). nan are skipped.
+    window : int
+        Bars in the window. The default is default_window.
+    min_periods : int, optional
+        Valid bars needed for a value. The default is window.
+
+    Returns
+    -------
+    mean, var, zscore : numpy arrays of values shape, nan before min_periods bars.
+    """
+    if min_periods is None:
+        min_periods = window
+    values = np.asarray(values, dtype=np.float64)
+    is_valid = ~np.isnan(values)
+    # statistics of shifted values are the same, sums of squares are smaller
+    shifted = np.where(is_valid, values - _first_valid(values), 0.0)
+    n = _rolling_sum(is_valid.astype(np.float64), window)
+    mean, var = _moments(
+        n, _rolling_sum(shifted, window), _rolling_sum(shifted**2, window)
+    )
+    mean[n < min_periods] = np.nan
+    var[n < min_periods] = np.nan
+    zscore = _zscore(np.where(is_valid, shifted, np.nan), mean, var)
+    return mean + _first_valid(values), var, zscore
+
+
+def rolling_regression(y, x, window=default_window, min_periods=None):
+    """
+    Rolling hedge ratio and z-score of spread of pairs, batch mode.
+
+    y[:, k] is regressed on x[:, k] (with constant) over the last window bars.
+    Spread is y - beta * x with the current beta, z-score is the one of the last bar
+    against the spread over the window.
+
+    Parameters
+    ----------
+    y, x : numpy arrays, bars x pairs. Bars where y or x is nan are skipped.
+    window : int
+        Bars in the window. The default is default_window.
+    min_periods : int, optional
+        Valid bars needed for a value. The default is window.
+
+    Returns
+    -------
+    beta, alpha, zscore : numpy arrays of y shape, nan before min_periods bars.
+    """
+    if min_periods is None:
+        min_periods = window
+    y = np.asarray(y, dtype=np.float64)
+    x = np.asarray(x, dtype=np.float64)
+    is_valid = ~(np.isnan(y) | np.isnan(x))
+    shift_y = _first_valid(np.where(is_valid, y, np.nan))
+    shift_x = _first_valid(np.where(is_valid, x, np.nan))
+    ys = np.where(is_valid, y - shift_y, 0.0)
+    xs = np.where(is_valid, x - shift_x, 0.0)
+    n = _rolling_sum(is_valid.astype(np.float64), window)
+    beta, alpha, var = _regression(
+        n,
+        _rolling_sum(xs, window),
+        _rolling_sum(ys, window),
+        _rolling_sum(xs * xs, window),
+        _rolling_sum(xs * ys, window),
+        _rolling_sum(ys * ys, window),
+    )
+    beta[n < min_periods] = np.nan
+    zscore = _zscore(np.where(is_valid, ys - beta * xs, np.nan), alpha, var)
+    return beta, alpha + shift_y - beta * shift_x, zscore
+
+
+##-------------------------------------------------------------------------------------------------
+class RollingWindow:
+    """
+    Rolling sums of several channels of many series over a ring buffer.
+
+    update() replaces the oldest bar of the window by the new one and
+    corrects the sums: O(1) per series. Every window updates the sums are
+    recomputed from the buffer, so rounding errors do not accumulate.
+    Values are shifted by the first valid value of their series.
+
+    Parameters
+    ----------
+    n_series : int
+    n_channels : int
+        Values per series and bar, e.g. 2 for y and x of a pair.
+    window : int
+    """
+
+    def __init__(self, n_series, n_channels, window):
+        self.window = window
+        self.n_updates = 0
+        self._buffer = np.zeros((window, n_channels, n_series))
+        self._is_valid = np.zeros((window, n_series), dtype=bool)
+        self._shift = np.full((n_channels, n_series), np.nan)
+        self._pos = 0
+        self.n = np.zeros(n_series)
+        self.sums = np.zeros((n_channels, n_series))
+        # pairwise products of channels, (i, j) for i <= j
+        self._products = [
+            (i, j) for i in range(n_channels) for j in range(i, n_channels)
+        ]
+        self.cross = np.zeros((len(self._products), n_series))
+
+    def update(self, values):
+        """
+        Adds bar of all series.
+
+        Parameters
+        ----------
+        values : numpy array, channels x series. Series with a nan channel
+            skip the bar (it counts as a missing bar in the window).
+
+        Returns
+        -------
+        shifted : numpy array of the bar after shift, nan where skipped.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        is_valid = ~np.isnan(values).any(axis=0)
+        self._shift = np.where(np.isnan(self._shift) & is_valid, values, self._shift)
+        shifted = np.where(is_valid, values - self._shift, 0.0)
+
+        old = self._buffer[self._pos]
+        self.n += is_valid.astype(np.float64) - self._is_valid[self._pos]
+        self.sums += shifted - old
+        for k, (i, j) in enumerate(self._products):
+            self.cross[k] += shifted[i] * shifted[j] - old[i] * old[j]
+        self._buffer[self._pos] = shifted
+        self._is_valid[self._pos] = is_valid
+        self._pos = (self._pos + 1) % self.window
+        self.n_updates += 1
+        if self._pos == 0:
+            self._resync()
+        return np.where(is_valid, shifted, np.nan)
+
+    def _resync(self):
+        self.n = self._is_valid.sum(axis=0).astype(np.float64)
+        self.sums = self._buffer.sum(axis=0)
+        for k, (i, j) in enumerate(self._products):
+            self.cross[k] = (self._buffer[:, i] * self._buffer[:, j]).sum(axis=0)
+
+    @property
+    def shift(self):
+        return np.nan_to_num(self._shift)
+
+
+##-------------------------------------------------------------------------------------------------
+class RollingMoments:
+    """
+    Live rolling mean, variance and z-score of many series, O(1) per bar.
+    Same statistics as rolling_moments().
+
+    Parameters
+    ----------
+    n_series : int
+    window : int
+        The default is default_window.
+    min_periods : int, optional
+        The default is window.
+    """
+
+    def __init__(self, n_series, window=default_window, min_periods=None):
+        self.min_periods = window if min_periods is None else min_periods
+        self._window = RollingWindow(n_series, 1, window)
+        self.mean = np.full(n_series, np.nan)
+        self.var = np.full(n_series, np.nan)
+        self.zscore = np.full(n_series, np.nan)
+
+    def update(self, values):
+        """Adds bar (array of series, nan if no value) and returns z-score of it."""
+        shifted = self._window.update(np.asarray(values).reshape(1, -1))[0]
+        state = self._window
+        mean, var = _moments(state.n, state.sums[0], state.cross[0])
+        is_ready = state.n >= self.min_periods
+        self.mean = np.where(is_ready, mean + state.shift[0], np.nan)
+        self.var = np.where(is_ready, var, np.nan)
+        self.zscore = np.where(is_ready, _zscore(shifted, mean, var), np.nan)
+        return self.zscore
+
+
+class RollingRegression:
+    """
+    Live rolling hedge ratio and spread z-score of many pairs, O(1) per bar.
+    Same statistics as rolling_regression().
+
+    Parameters
+    ----------
+    n_pairs : int
+    window : int
+        The default is default_window.
+    min_periods : int, optional
+        The default is window.
+    """
+
+    def __init__(self, n_pairs, window=default_window, min_periods=None):
+        self.min_periods = window if min_periods is None else min_periods
+        self._window = RollingWindow(n_pairs, 2, window)
+        self.beta = np.full(n_pairs, np.nan)
+        self.alpha = np.full(n_pairs, np.nan)
+        self.zscore = np.full(n_pairs, np.nan)
+
+    def update(self, y, x):
+        """Adds bar of all pairs (arrays, nan if no value) and returns z-score of spread."""
+        ys, xs = self._window.update(np.vstack([y, x]))
+        state = self._window
+        # cross: yy, yx, xx
+        beta, alpha, var = _regression(
+            state.n,
+            state.sums[1],
+            state.sums[0],
+            state.cross[2],
+            state.cross[1],
+            state.cross[0],
+        )
+        is_ready = state.n >= self.min_periods
+        shift_y, shift_x = state.shift
+        self.beta = np.where(is_ready, beta, np.nan)
+        self.alpha = np.where(is_ready, alpha + shift_y - beta * shift_x, np.nan)
+        self.zscore = np.where(is_ready, _zscore(ys - beta * xs, alpha, var), np.nan)
+        return self.zscore
+
+
+##-------------------------------------------------------------------------------------------------
+class LiveSpreads:
+    """
+    Rolling hedge ratios and spread z-scores of pairs fed by new candles.
+
+    Candles (e.g. of tinkoffAPIHelper.iter_candles or a stream) update the
+    last price of their instruments; every new bar time updates all pairs
+    with the last prices. Candles must come in time order, candles older
+    than the last processed bar are ignored.
+
+    Usage:
+        spreads = LiveSpreads([("BBG1", "BBG2")], window=390)
+        spreads.warm_up(panel.build_panel(history, key="figi"))
+        for task, df in tinkoffAPIHelper.iter_candles(con, tasks):
+            state = spreads.update_candles(df)
+
+    Parameters
+    ----------
+    pairs : list of tuples (y, x)
+        Instrument ids of pairs, values of key column.
+    window : int
+        The default is default_window.
+    key : string
+        Column of instrument id in candles. The default is "figi".
+    field : string
+        Price column. The default is "c".
+    """
+
+    def __init__(self, pairs, window=default_window, key="figi", field="c"):
+        self.pairs = list(pairs)
+        self.key = key
+        self.field = field
+        self.instruments = pd.Index(
+            pd.unique(
+                np.array([key for pair in self.pairs for key in pair], dtype=object)
+            )
+        )
+        self._y = self.instruments.get_indexer([y for y, _ in self.pairs])
+        self._x = self.instruments.get_indexer([x for _, x in self.pairs])
+        self.last_price = np.full(len(self.instruments), np.nan)
+        self.last_time = None
+        self.regression = RollingRegression(len(self.pairs), window)
+
+    def update_bar(self, bar_time, prices):
+        """
+        Adds bar of instruments.
+
+        Parameters
+        ----------
+        bar_time : datetime
+        prices : numpy array of prices of instruments, nan if not traded
+            (the last price is used then).
+        """
+        self.last_price = np.where(np.isnan(prices), self.last_price, prices)
+        self.regression.update(self.last_price[self._y], self.last_price[self._x])
+        self.last_time = bar_time
+
+    def update_candles(self, df):
+        """
+        Adds candles of any instruments, bar by bar in time order.
+
+        Returns
+        -------
+        state : Pandas dataframe, see state().
+        """
+        logger = logging.getLogger(apiname + "update_candles")
+        df = df[df[self.key].isin(self.instruments)]
+        times = pd.to_datetime(df["time"])
+        if self.last_time is not None:
+            is_new = times > self.last_time
+            if not is_new.all():
+                logger.debug(
+                    f"{(~is_new).sum()} candles older than the last bar ignored"
+                )
+            df, times = df[is_new], times[is_new]
+        cols = self.instruments.get_indexer(df[self.key])
+        prices = df[self.field].to_numpy(dtype=np.float64)
+        times = times.to_numpy()
+        order = np.argsort(times, kind="stable")
+        bar_times, starts = np.unique(times[order], return_index=True)
+        for bar_time, rows in zip(bar_times, np.split(order, starts[1:])):
+            bar = np.full(len(self.instruments), np.nan)
+            bar[cols[rows]] = prices[rows]
+            self.update_bar(bar_time, bar)
+        return self.state()
+
+    def warm_up(self, panel, field=None):
+        """Feeds the last window bars of history (panel.Panel with the same key)."""
+        field = self.field if field is None else field
+        values = panel.frame(field).reindex(columns=self.instruments)
+        for bar_time, row in values.tail(self.regression._window.window).iterrows():
+            self.update_bar(bar_time, row.to_numpy(dtype=np.float64))
+
+    def state(self):
+        """Pandas dataframe of pairs: y, x, beta, alpha, zscore of the last bar."""
+        return pd.DataFrame(
+            {
+                "y": [y for y, _ in self.pairs],
+                "x": [x for _, x in self.pairs],
+                "beta": self.regression.beta,
+                "alpha": self.regression.alpha,
+                "zscore": self.regression.zscore,
+            }
+        )
+
+
+##-------------------------------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    import ClickhouseHelper as chh
+    import pairs_screener
+    import panel as panel_builder
+
+    logging.config.fileConfig(fname="logger.conf", disable_existing_loggers=False)
+    logger = logging.getLogger(__name__)
+
+    logger.info("RollingStats main")
+
+    chunks = chh.query_data_by_time(
+        channels_list=["time", "ticker", "c"],
+        days_span=30,
+        server_ip="192.168.1.128",
+        instrument_type="Etf",
+        chunk_size=chh.query_chunk_size,
+    )
+    prices = panel_builder.build_panel(chunks, fields=["c"], min_coverage=0.5)
+    pairs = pairs_screener.screen_pairs(prices.frame("c").dropna(), min_corr=0.5)
+    pairs = pairs[pairs.is_cointegrated].head(100)
+
+    start = time.time()
+    close = prices.frame("c")
+    beta, alpha, zscore = rolling_regression(
+        close[pairs.y].to_numpy(), close[pairs.x].to_numpy()
+    )
+    timer_string = utilities_timers.format_timer_string(time.time() - start)
+    logger.info(f"rolling spreads of {len(pairs)} pairs. {timer_string}")
+    pairs["beta"] = beta[-1]
+    pairs["zscore"] = zscore[-1]
+    logger.info(f"\n{pairs.to_string()}")
@@ -0,0 +1,441 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 23:14:26 2026
+
+@author: SParkhonyuk
+"""
+# Long running ingestion of live market data of Tinkoff streaming API.
+# A reader thread receives candle and order book events from the websocket,
+# a writer thread writes them to Clickhouse in micro batches: when batch_rows
+# rows are collected or the oldest event waits batch_latency seconds.
+# Buffer between them is bounded: while it is full the reader stops reading
+# the socket, so a slow Clickhouse slows down the stream instead of filling memory.
+import os
+import json
+import queue
+import threading
+import logging
+import logging.config
+import time
+
+import pandas as pd
+from dotenv import load_dotenv, find_dotenv
+
+# in-house
+import ClickhouseHelper as chh
+import metrics
+import missing_ranges
+import utilities_timers
+
+try:
+    from websockets.sync.client import connect as ws_connect
+except ImportError:  # optional, needed only for streaming
+    ws_connect = None
+
+apiname = "StreamIngestor::"
+streaming_url = "wss://api-invest.tinkoff.ru/openapi/md/v1/md-openapi/ws"
+# rows per write and max seconds an event waits for its batch
+batch_rows = 10000
+batch_latency = 1.0
+# events received and not yet written
+max_buffer = 50000
+# seconds after the end of its interval a forming candle without updates is
+# taken as closed (the next candle of the FIGI closes it at once)
+close_delay = 5.0
+# attempts to write a batch before it is dropped. Ranges of dropped candles
+# are recorded (see missing_ranges), the next downloader run requests them
+max_write_retries = 3
+# seconds between reconnects, doubled after every failure up to max_reconnect_delay
+reconnect_delay = 1.0
+max_reconnect_delay = 60.0
+
+
+##-------------------------------------------------------------------------------------------------
+def subscribe_messages(figis, interval="1min", orderbook_depth=0):
+    """Subscribe requests of streaming API for candles (and order books if depth > 0)."""
+    messages = []
+    for figi in figis:
+        messages.append(
+            {"event": "candle:subscribe", "figi": figi, "interval": interval}
+        )
+        if orderbook_depth > 0:
+            messages.append(
+                {"event": "orderbook:subscribe", "figi": figi, "depth": orderbook_depth}
+            )
+    return messages
+
+
+def parse_event(message):
+    """
+    Rows of streaming API message.
+
+    Returns
+    -------
+    (kind, rows) : kind is "candle" or "orderbook", rows are dicts of table
+        columns (see ClickhouseHelper.candles_columns and orderbook_columns).
+        (None, []) for other events.
+    """
+    event = json.loads(message)
+    kind = event.get("event")
+    payload = event.get("payload", {})
+    if kind == "candle":
+        row = {
+            col: payload[col]
+            for col in ["figi", "interval", "o", "c", "h", "l", "v", "time"]
+        }
+        return kind, [row]
+    if kind == "orderbook":
+        rows = []
+        for side, levels in [("bid", payload["bids"]), ("ask", payload["asks"])]:
+            for level, (price, quantity) in enumerate(levels):
+                rows.append(
+                    {
+                        "time": event["time"],
+                        "figi": payload["figi"],
+                        "side": side,
+                        "level": level,
+                        "price": price,
+                        "quantity": quantity,
+                    }
+                )
+        return kind, rows
+    if kind == "error":
+        logger = logging.getLogger(apiname + parse_event.__name__)
+        logger.error(f"streaming API error: {payload}")
+    return None, []
+
+
+##-------------------------------------------------------------------------------------------------
+class StreamIngestor:
+    """
+    Streams candles and order books of figis into Clickhouse.
+
+    A candle is sent many times while it is forming. The last version of every
+    FIGI is kept in memory and written (ClickhouseHelper.upsert_df_to_SQL_table)
+    once, when the candle is closed: the next candle of the FIGI arrives
+    or close_delay seconds after its interval ended. So aggregate views of the
+    candles table count every candle once. Forming candles are not written
+    on stop, the next downloader run gets them after the last stored candle.
+    Order book snapshots are appended to orderbooks table.
+    The connection is restored after errors, with growing delay.
+
+    Usage:
+        with StreamIngestor(figis, token, server_ip="192.168.1.128") as ingestor:
+            ingestor.wait()
+
+    Parameters
+    ----------
+    figis : list
+    token : string
+        API key. The default is APIKEY_SANDBOX environment variable.
+    url : string
+        Websocket address. The default is TINKOFF_STREAMING_URL environment
+        variable or streaming_url.
+    server_ip : string
+        ip adress of Clickhouse instance. localhost by default.
+    interval : str
+        Candles interval. The default is "1min".
+    orderbook_depth : int
+        Levels of order books, 0 not to subscribe to them. The default is 0.
+    batch_rows, batch_latency, max_buffer :
+        See module constants.
+    missing : missing_ranges.MissingRanges, optional
+        Where ranges of dropped candles are recorded. The default is
+        MissingRanges() with default file, read by downloader.
+    """
+
+    def __init__(
+        self,
+        figis,
+        token=None,
+        url=None,
+        server_ip="localhost",
+        interval="1min",
+        orderbook_depth=0,
+        batch_rows=batch_rows,
+        batch_latency=batch_latency,
+        max_buffer=max_buffer,
+        missing=None,
+    ):
+        self.figis = list(figis)
+        self.token = os.environ.get("APIKEY_SANDBOX") if token is None else token
+        self.url = (
+            os.environ.get("TINKOFF_STREAMING_URL", streaming_url)
+            if url is None
+            else url
+        )
+        self.server_ip = server_ip
+        self.interval = interval
+        self.table_name = chh.interval_table(interval)
+        self.candle_length = chh.candle_intervals[interval]
+        self.missing = missing_ranges.MissingRanges() if missing is None else missing
+        self.orderbook_depth = orderbook_depth
+        self.batch_rows = batch_rows
+        self.batch_latency = batch_latency
+        self.n_events = 0
+        self.n_rows = {"candle": 0, "orderbook": 0}
+        self.n_batches = 0
+        self.n_dropped = 0
+        self.n_full_waits = 0
+        self.n_connects = 0
+        self.n_late = 0
+        # {figi: (time, row)} of forming candles and {figi: time} of the last
+        # written ones, used by the writer thread only
+        self._forming = {}
+        self._closed = {}
+        self._next_close_check = 0.0
+        self._queue = queue.Queue(maxsize=max_buffer)
+        self._stop = threading.Event()
+        self._websocket = None
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+
+    def start(self):
+        """Connects and starts reader and writer threads."""
+        logger = logging.getLogger(apiname + "start")
+        if ws_connect is None:
+            raise RuntimeError("websockets package is required for streaming")
+        logger.info(
+            f"streaming {len(self.figis)} FIGIs from {self.url}, "
+            f"order book depth {self.orderbook_depth}"
+        )
+        self._writer.start()
+        self._reader.start()
+        return self
+
+    def stop(self, timeout=30):
+        """Stops reading, writes the buffered events and stops the writer."""
+        logger = logging.getLogger(apiname + "stop")
+        self._stop.set()
+        websocket = self._websocket
+        if websocket is not None:
+            websocket.close()
+        for thread in [self._reader, self._writer]:
+            if thread.is_alive():
+                thread.join(timeout)
+        logger.info(
+            f"{self.n_events} events, {self.n_rows} rows written in "
+            f"{self.n_batches} batches, {self.n_dropped} rows dropped, "
+            f"{len(self._forming)} forming candles not written"
+        )
+
+    def wait(self):
+        """Blocks until stop() is called from another thread or the process is interrupted."""
+        while not self._stop.wait(1.0):
+            pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _read_loop(self):
+        logger = logging.getLogger(apiname + "reader")
+        delay = reconnect_delay
+        while not self._stop.is_set():
+            try:
+                with ws_connect(
+                    self.url,
+                    additional_headers={"Authorization": f"Bearer {self.token}"},
+                    open_timeout=10,
+                ) as websocket:
+                    self._websocket = websocket
+                    self.n_connects += 1
+                    for message in subscribe_messages(
+                        self.figis, self.interval, self.orderbook_depth
+                    ):
+                        websocket.send(json.dumps(message))
+                    logger.info("subscribed")
+                    delay = reconnect_delay
+                    for message in websocket:
+                        kind, rows = parse_event(message)
+                        if kind is not None:
+                            self._put((time.monotonic(), kind, rows))
+            except Exception as exc:
+                if self._stop.is_set():
+                    break
+                logger.error(f"stream failed: {exc}. Reconnect in {delay:.0f} s")
+            finally:
+                self._websocket = None
+            if not self._stop.is_set():
+                # connection closed by server or failed
+                self._stop.wait(delay)
+                delay = min(2 * delay, max_reconnect_delay)
+
+    def _put(self, item):
+        """Blocks while the buffer is full (back-pressure on the socket)."""
+        self.n_events += 1
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                self.n_full_waits += 1
+
+    def _update_forming(self, rows):
+        """Keeps the last version of forming candles, returns closed ones."""
+        closed = []
+        for row in rows:
+            figi = row["figi"]
+            candle_time = pd.Timestamp(row["time"])
+            if figi in self._closed and candle_time <= self._closed[figi]:
+                # update of a candle already written
+                self.n_late += 1
+                continue
+            forming = self._forming.get(figi)
+            if forming is not None and candle_time < forming[0]:
+                self.n_late += 1
+                continue
+            if forming is not None and candle_time > forming[0]:
+                closed.append(forming[1])
+                self._closed[figi] = forming[0]
+            self._forming[figi] = (candle_time, row)
+        return closed
+
+    def _close_expired(self):
+        """Closed candles of FIGIs without new ones, checked once a second."""
+        if time.monotonic() < self._next_close_check:
+            return []
+        self._next_close_check = time.monotonic() + 1.0
+        expired = pd.Timestamp.now(tz="UTC") - self.candle_length
+        expired -= pd.Timedelta(seconds=close_delay)
+        closed = []
+        for figi, (candle_time, row) in list(self._forming.items()):
+            if candle_time <= expired:
+                closed.append(row)
+                self._closed[figi] = candle_time
+                del self._forming[figi]
+        return closed
+
+    def _write_loop(self):
+        batch = {"candle": [], "orderbook": []}
+        n_batch_rows = 0
+        deadline = None
+        while True:
+            timeout = 0.5 if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                received, kind, rows = self._queue.get(timeout=timeout)
+                if kind == "candle":
+                    rows = self._update_forming(rows)
+                batch[kind].extend(rows)
+                n_batch_rows += len(rows)
+                if deadline is None and rows:
+                    deadline = received + self.batch_latency
+            except queue.Empty:
+                if self._stop.is_set() and not self._reader.is_alive():
+                    break
+            closed = self._close_expired()
+            if closed:
+                batch["candle"].extend(closed)
+                n_batch_rows += len(closed)
+                if deadline is None:
+                    deadline = time.monotonic() + self.batch_latency
+            if n_batch_rows > 0 and (
+                n_batch_rows >= self.batch_rows or time.monotonic() >= deadline
+            ):
+                self._write(batch)
+                batch = {"candle": [], "orderbook": []}
+                n_batch_rows = 0
+                deadline = None
+        if n_batch_rows > 0:
+            self._write(batch)
+
+    def _record_missing(self, candles):
+        """Records ranges of dropped candles, watermarks may be beyond them."""
+        if len(candles) == 0:
+            return
+        logger = logging.getLogger(apiname + "writer")
+        bounds = candles.groupby("figi", observed=True).time.agg(["min", "max"])
+        ranges = [
+            (
+                figi,
+                first.to_pydatetime(),
+                (last + self.candle_length).to_pydatetime(),
+            )
+            for figi, first, last in bounds.itertuples()
+        ]
+        try:
+            self.missing.add(ranges, self.interval, source="stream")
+        except Exception as exc:
+            logger.error(f"failed to record missing candles: {exc}")
+            for figi, first, last in ranges:
+                logger.error(f"missing candles of {figi} in [{first}, {last})")
+
+    def _write(self, batch):
+        start = time.time()
+        logger = logging.getLogger(apiname + "writer")
+        candles = pd.DataFrame(batch["candle"])
+        if len(candles) > 0:
+            candles["time"] = pd.to_datetime(candles["time"], utc=True)
+        orderbooks = pd.DataFrame(batch["orderbook"])
+        if len(orderbooks) > 0:
+            orderbooks["time"] = pd.to_datetime(orderbooks["time"], utc=True)
+
+        for attempt in range(1, max_write_retries + 1):
+            try:
+                if len(candles) > 0:
+                    chh.upsert_df_to_SQL_table(
+                        df=candles, table_name=self.table_name, server_ip=self.server_ip
+                    )
+                    self.n_rows["candle"] += len(candles)
+                    candles = candles.iloc[:0]
+                if len(orderbooks) > 0:
+                    chh.append_orderbooks_to_SQL_table(
+                        orderbooks, server_ip=self.server_ip
+                    )
+                    self.n_rows["orderbook"] += len(orderbooks)
+                break
+            except Exception as exc:
+                logger.error(f"write attempt {attempt} failed: {exc}")
+                if attempt == max_write_retries:
+                    n_rows = len(candles) + len(orderbooks)
+                    self.n_dropped += n_rows
+                    logger.error(f"{n_rows} rows dropped")
+                    self._record_missing(candles)
+                else:
+                    time.sleep(attempt)
+        self.n_batches += 1
+        registry = metrics.get_registry()
+        registry.set("queue_depth", self._queue.qsize(), queue="stream")
+        registry.set_max("queue_depth_max", self._queue.qsize(), queue="stream")
+        registry.observe("stream_batch_seconds", time.time() - start)
+
+        timer_string = utilities_timers.format_timer_string(time.time() - start)
+        logger.debug(
+            f"batch {self.n_batches}: {len(batch['candle'])} candle and "
+            f"{len(batch['orderbook'])} order book rows, "
+            f"buffer {self._queue.qsize()}. {timer_string}"
+        )
+
+
+##-------------------------------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    import instrument_cache
+
+    logging.config.fileConfig(fname="logger.conf", disable_existing_loggers=False)
+    logger = logging.getLogger(__name__)
+
+    logger.info("StreamIngestor main")
+    load_dotenv(find_dotenv())
+    server_adress = os.environ.get("CLICKHOUSE_SERVER_ADRESS", "192.168.1.128")
+    figis = os.environ.get("STREAM_FIGIS")
+    if figis:
+        figis = figis.split(",")
+    else:
+        instruments = instrument_cache.InstrumentCache().load()
+        figis = list(instruments[instruments.type == "Etf"].figi)
+
+    ingestor = StreamIngestor(
+        figis,
+        server_ip=server_adress,
+        interval=os.environ.get("STREAM_INTERVAL", "1min"),
+        orderbook_depth=int(os.environ.get("STREAM_ORDERBOOK_DEPTH", 10)),
+    )
+    with ingestor:
+        try:
+            ingestor.wait()
+        except KeyboardInterrupt:
+            logger.info("interrupted")
+    chh.get_pool(server_adress).close()
@@ -5,13 +5,13 @@ Created on Wed Apr  1 12:47:00 2020
 @author: SParkhonyuk
 """
 # Tinkoff's API implementation in python pip install -i https://test.pypi.org/simple/ --extra-index-url=https://pypi.org/simple/ tinkoff-invest-openapi-client
-from openapi_client import openapi
-from datetime import datetime, timedelta
-from pytz import timezone
+# openapi_client is imported by connect(): import of this module makes no requests
+from datetime import datetime, timedelta, timezone
 import pandas as pd
 import time
-from dotenv import load_dotenv, find_dotenv
 import os
+import random
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import logging
 import logging.config
@@ -20,23 +20,51 @@ from tqdm import tqdm
 
 # in-house
 import utilities_timers
+import rate_limiter
+import trading_calendar
+import metrics
 
-# find .env automagically by walking up directories until it's found
-dotenv_path = find_dotenv()
-# load up the entries as environment variables
-load_dotenv(dotenv_path)
-token = os.environ.get("APIKEY_SANDBOX")
-
-client = openapi.sandbox_api_client(token)
-client.sandbox.sandbox_register_post()
-client.sandbox.sandbox_clear_post()
-client.sandbox.sandbox_currencies_balance_post(
-    sandbox_set_currency_balance_request={"currency": "USD", "balance": 1000}
-)
 #Creating local variable for API name
 apiname="TinkoffAPI::"
 timeformat="%Y-%m-%dT%H:%M:%S"
 gmt_time="+07:00"
+# broker quota for market requests. Shared by every download thread.
+# TINKOFF_REQUESTS_PER_MINUTE environment variable overrides it.
+requests_per_minute = 120
+# HTTP statuses worth retrying: rate limit hit and server side errors
+retry_statuses = (429, 500, 502, 503, 504)
+# longest time span of one candles request per interval, API rejects longer ones
+max_windows = {
+    "1min": timedelta(days=1),
+    "2min": timedelta(days=1),
+    "3min": timedelta(days=1),
+    "5min": timedelta(days=1),
+    "10min": timedelta(days=1),
+    "15min": timedelta(days=1),
+    "30min": timedelta(days=1),
+    "hour": timedelta(days=7),
+    "day": timedelta(days=365),
+    "week": timedelta(days=2 * 365),
+    "month": timedelta(days=10 * 365),
+}
+# instruments with more windows than this are probed with daily candles first
+probe_min_windows = 3
+_rate_limiter = None
+# sandbox client shared by the process, see get_client()
+_client = None
+_is_env_loaded = False
+
+
+##-------------------------------------------------------------------------------------------------
+def _load_env():
+    """Loads .env file into environment variables on first call, not on import."""
+    global _is_env_loaded
+    if not _is_env_loaded:
+        from dotenv import load_dotenv, find_dotenv
+
+        # find .env automagically by walking up directories until it's found
+        load_dotenv(find_dotenv())
+        _is_env_loaded = True
 ##-------------------------------------------------------------------------------------------------
 def connect(token=None):
     """
@@ -44,8 +72,9 @@ def connect(token=None):
 
     Parameters
     ----------
-    token : string
-        API key for either sandbox or prod. Taken from .env file
+    token : string, optional
+        API key for either sandbox or prod. The default is APIKEY_SANDBOX
+        environment variable (or .env file).
         To get your key,
         log in to you account on tinkoff.ru
         Go to investment
@@ -64,7 +93,12 @@ def connect(token=None):
     """
     logger = logging.getLogger(apiname + connect.__name__)
 
+    from openapi_client import openapi
+
     logger.info(f"connection to TinkoffAPI is in progress ...")
+    if token is None:
+        _load_env()
+        token = os.environ.get("APIKEY_SANDBOX")
     client = openapi.sandbox_api_client(token)
 
     try:
@@ -87,12 +121,14 @@ def connect(token=None):
 
 
 ##-------------------------------------------------------------------------------------------------
+@utilities_timers.timed(apiname)
 def get_instruments(con=None, instrument=None):
     """
     Gets list of instruments (bonds, stocks, ETFs that traded on tinkoff-invest broker)
 
     Args:
-        con(connector) : TinkoffAPI connector. Create one using connect() function
+        con(connector) : TinkoffAPI connector. Create one using connect() function.
+            Shared client by default, see get_client().
         instrument(str) : can be either stock, bond, etf. 
    
     Returns:
@@ -101,8 +137,9 @@ def get_instruments(con=None, instrument=None):
     Raises:
         Error if not defined instrument or wrong instrument name is provided as input.
     """
-    start = time.time()
     logger = logging.getLogger(apiname + connect.__name__)
+    if con is None:
+        con = get_client()
 
     logger.info(f"retrieving available {instrument} is in progress ...")
     if instrument == "Stock":
@@ -120,22 +157,363 @@ def get_instruments(con=None, instrument=None):
     for item in tickers[0].payload.instruments:
         list_of_tickers.append(item.to_dict())
     df = pd.DataFrame.from_records(list_of_tickers)
-    timer_string = utilities_timers.format_timer_string(time.time() - start)
-    logger.info(timer_string)
     logger.info(f"retrieved dataframe with shape {df.shape} ")
     return df
 
 
 ##-------------------------------------------------------------------------------------------------
+def get_client():
+    """
+    Returns sandbox client shared by the process, connected on the first call
+    (see connect). Raises if connection failed, the next call tries again.
+    """
+    global _client
+    if _client is None:
+        client, ping = connect()
+        if client is None:
+            raise ConnectionError(f"failed to connect to TinkoffAPI: {ping}")
+        _client = client
+    return _client
+
+
+##-------------------------------------------------------------------------------------------------
+def get_rate_limiter():
+    """
+    Returns token bucket limiter shared by all requests of this process.
+    Quota is taken from TINKOFF_REQUESTS_PER_MINUTE (requests_per_minute by default).
+    """
+    global _rate_limiter
+    if _rate_limiter is None:
+        _load_env()
+        _rate_limiter = rate_limiter.TokenBucket(
+            int(os.environ.get("TINKOFF_REQUESTS_PER_MINUTE", requests_per_minute))
+        )
+    return _rate_limiter
+
+
+##-------------------------------------------------------------------------------------------------
+def call_with_retry(func, limiter=None, max_retries=5, backoff=1.0, **kwargs):
+    """
+    Calls API method with rate limiting and retries.
+
+    Parameters
+    ----------
+    func : callable
+        OpenAPI method, e.g. con.market.market_candles_get_with_http_info
+    limiter : rate_limiter.TokenBucket, optional
+        Limiter to take token from before each attempt. The default is shared limiter.
+    max_retries : int
+        How many times to repeat the request on 429/5xx responses. The default is 5.
+    backoff : float
+        Base delay in seconds. Delay doubles after each failed attempt (plus jitter).
+    **kwargs :
+        Arguments of func.
+
+    Returns
+    -------
+    Response of func.
+
+    Raises
+    ------
+    Exception raised by func if it is not retryable or retries are exhausted.
+    """
+    logger = logging.getLogger(apiname + call_with_retry.__name__)
+    if limiter is None:
+        limiter = get_rate_limiter()
+    registry = metrics.get_registry()
+    method = getattr(func, "__name__", "request")
+
+    for attempt in range(max_retries + 1):
+        waited = limiter.acquire()
+        if waited:
+            registry.inc("rate_limit_waits_total")
+            registry.inc("rate_limit_wait_seconds_total", waited)
+        try:
+            with registry.timer("api_request_seconds", method=method):
+                response = func(**kwargs)
+            registry.inc("api_requests_total", method=method, status="ok")
+            return response
+        except Exception as exc:
+            status = getattr(exc, "status", None)
+            registry.inc("api_requests_total", method=method, status=status or "error")
+            if status not in retry_statuses or attempt == max_retries:
+                raise
+            registry.inc("api_retries_total", method=method, status=status)
+            delay = backoff * 2 ** attempt * (1 + random.random())
+            logger.warning(
+                f"request failed with status {status}, retry {attempt + 1} of {max_retries} in {delay:.1f} s"
+            )
+            time.sleep(delay)
+
+
+##-------------------------------------------------------------------------------------------------
+def _utc_offset():
+    """Offset of gmt_time zone, local times are UTC + offset."""
+    sign = -1 if gmt_time.startswith("-") else 1
+    hours, minutes = gmt_time[1:].split(":")
+    return sign * timedelta(hours=int(hours), minutes=int(minutes))
+
+
+def _to_local(t):
+    """Naive time in gmt_time zone. Naive t is returned as is, aware t is converted."""
+    if t.tzinfo is None:
+        return t
+    return t.astimezone(timezone.utc).replace(tzinfo=None) + _utc_offset()
+
+
+##-------------------------------------------------------------------------------------------------
+def _time_windows(_from, to, interval="1min", calendar=None, days=None):
+    """
+    Splits [_from, to] into request windows as long as the API allows for interval.
+
+    Stretches without trading are skipped: days closed by calendar and, if days
+    is given, days not listed there. A window may span closed days, so a
+    weekend between two trading days costs nothing; the last window ends at to.
+
+    Parameters
+    ----------
+    _from, to : datetime
+        Naive times in gmt_time zone.
+    interval : str
+        Candles interval, defines window length (see max_windows).
+    calendar : trading_calendar.TradingCalendar, optional
+        The default is the shared calendar, see trading_calendar.get_calendar().
+    days : set of dates, optional
+        UTC days known to have trades (see _traded_days). All days by default.
+
+    Returns
+    -------
+    list of tuples (start, end) formatted as API compatible strings.
+    """
+    if calendar is None:
+        calendar = trading_calendar.get_calendar()
+    offset = _utc_offset()
+    window = max_windows[interval]
+
+    def is_open(day):
+        return calendar.is_trading_day(day) and (days is None or day in days)
+
+    def next_open(t):
+        # first moment from t which is on an open day, or to
+        while t < to:
+            day = (t - offset).date()
+            if is_open(day):
+                return t
+            t = datetime.combine(day + timedelta(days=1), datetime.min.time()) + offset
+        return to
+
+    windows = []
+    window_start = next_open(_from)
+    while window_start < to:
+        window_end = min(window_start + window, to)
+        windows.append(
+            (
+                window_start.strftime(timeformat) + gmt_time,
+                window_end.strftime(timeformat) + gmt_time,
+            )
+        )
+        window_start = next_open(window_end)
+    return windows
+
+
+##-------------------------------------------------------------------------------------------------
+def _traded_days(df):
+    """UTC days of daily candles in df, see _time_windows(days=...)."""
+    if len(df) == 0:
+        return set()
+    # daily candle time is the session start, or midnight of Moscow
+    # for some instruments: the day is taken in Moscow time
+    times = pd.to_datetime(df.time, utc=True).dt.tz_convert("Europe/Moscow")
+    return set(times.dt.date)
+
+
+##-------------------------------------------------------------------------------------------------
+def plan_requests(
+    con, ranges, interval="1min", max_workers=1, limiter=None, is_probe_days=True
+):
+    """
+    Builds (figi, _from, to) candles requests for {figi: (_from, to)} ranges.
+
+    Instruments that need more than probe_min_windows requests are probed
+    with daily candles first (one request per year), and only days with
+    trades are requested. Illiquid instruments trade on a few days of the
+    range, so the probe saves most of their requests.
+    """
+    logger = logging.getLogger(apiname + plan_requests.__name__)
+    calendar = trading_calendar.get_calendar()
+    days = {}
+    probe_tasks = []
+    if is_probe_days and max_windows[interval] < max_windows["day"]:
+        for figi, (figi_from, figi_to) in ranges.items():
+            if len(_time_windows(figi_from, figi_to, interval)) > probe_min_windows:
+                for w_start, w_end in _time_windows(figi_from, figi_to, "day"):
+                    probe_tasks.append((figi, w_start, w_end))
+                days[figi] = set()
+    for task, df in iter_candles(
+        con, probe_tasks, interval="day", max_workers=max_workers, limiter=limiter
+    ):
+        if df is None:
+            # without probe all days are requested
+            days[task[0]] = None
+        elif days[task[0]] is not None:
+            days[task[0]] |= _traded_days(df)
+
+    tasks = []
+    for figi, (figi_from, figi_to) in ranges.items():
+        figi_days = days.get(figi)
+        if figi_days is not None:
+            # daily candle of the current day may be not formed yet
+            last_day = (figi_to - _utc_offset()).date()
+            # daily candle is stamped at session start, so the probe misses
+            # the first day when _from is after it
+            first_day = (figi_from - _utc_offset()).date()
+            figi_days = figi_days | {first_day, last_day, last_day - timedelta(days=1)}
+        for w_start, w_end in _time_windows(
+            figi_from, figi_to, interval, calendar=calendar, days=figi_days
+        ):
+            tasks.append((figi, w_start, w_end))
+    logger.info(
+        f"{len(probe_tasks)} probe requests of daily candles for {len(days)} FIGIs, "
+        f"{len(tasks)} {interval} requests planned"
+    )
+    return tasks
+
+
+##-------------------------------------------------------------------------------------------------
+def _fetch_candles(con, figi, _from, to, interval="1min", limiter=None):
+    """
+    Single candles request for one FIGI and one time window.
+
+    Returns
+    -------
+    df : Pandas dataframe with candles. Empty if nothing was traded in the window.
+    """
+    response = call_with_retry(
+        con.market.market_candles_get_with_http_info,
+        limiter=limiter,
+        figi=figi,
+        _from=_from,
+        to=to,
+        interval=interval,
+    )
+    list_of_tickers = []
+    for item in response[0].payload.candles:
+        list_of_tickers.append(item.to_dict())
+    return pd.DataFrame.from_records(list_of_tickers)
+
+
+##-------------------------------------------------------------------------------------------------
+def iter_candles(con, tasks, interval="1min", max_workers=8, limiter=None):
+    """
+    Concurrent download engine. Keeps up to 2 * max_workers (figi, window) requests
+    in flight and yields results as soon as they are completed.
+    Throughput is bounded by limiter, not by number of workers.
+
+    Parameters
+    ----------
+    con(connector) : TinkoffAPI connector. Create one using connect() function
+    tasks : iterable of tuples (figi, _from, to)
+        _from and to are API compatible strings, see _time_windows()
+    interval : str
+        frequency of data to retrieve. The default is "1min".
+    max_workers : int
+        Number of download threads. The default is 8.
+    limiter : rate_limiter.TokenBucket, optional
+        The default is shared limiter of the process.
+
+    Yields
+    ------
+    (task, df) : df is None if request failed after all retries.
+    """
+    logger = logging.getLogger(apiname + iter_candles.__name__)
+    if limiter is None:
+        limiter = get_rate_limiter()
+
+    tasks = iter(tasks)
+    max_in_flight = 2 * max_workers
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = {}
+        while True:
+            for task in tasks:
+                figi, _from, to = task
+                future = executor.submit(
+                    _fetch_candles, con, figi, _from, to, interval, limiter
+                )
+                in_flight[future] = task
+                if len(in_flight) >= max_in_flight:
+                    break
+            if not in_flight:
+                return
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = in_flight.pop(future)
+                try:
+                    df = future.result()
+                except Exception as exc:
+                    logger.error(f"request {task} failed: {exc}")
+                    df = None
+                yield task, df
+
+
+##-------------------------------------------------------------------------------------------------
+def request_ranges(figis, _from, to, since=None, backfill_days=10, missing=None):
+    """
+    Time range to download for every FIGI, see since and missing of get_detailed_data().
+    The last stored candle is requested again: it could be still forming
+    when stored. Aggregate views count it twice until they are refreshed
+    (pipeline.download_to_clickhouse does it).
+
+    Returns
+    -------
+    ranges : dict {figi: (_from, to)}. FIGIs with nothing to download are left out.
+    """
+    logger = logging.getLogger(apiname + request_ranges.__name__)
+    if missing is None:
+        missing = {}
+    ranges = {}
+    n_new = 0
+    for figi in figis:
+        if since is None:
+            figi_from = _from
+        elif figi in since:
+            # upsert replaces the last stored candle
+            figi_from = _to_local(since[figi])
+        else:
+            figi_from = to - timedelta(days=backfill_days)
+            n_new += 1
+        if figi in missing:
+            # watermark is beyond candles lost by earlier runs
+            figi_from = min(figi_from, _to_local(missing[figi]))
+        if figi_from < to:
+            ranges[figi] = (figi_from, to)
+    if since is not None:
+        logger.info(
+            f"incremental mode: {n_new} FIGIs without history, "
+            f"backfill {backfill_days} days"
+        )
+    if missing:
+        logger.info(f"{len(missing)} FIGIs start early to cover missing candles")
+    return ranges
+
+
+##-------------------------------------------------------------------------------------------------
+@utilities_timers.timed(apiname)
 def detailed_history(
-    con=None, figi="BBG00M0C8YM7", _from=None, to=None, interval="1min", days_span=10
+    con=None,
+    figi="BBG00M0C8YM7",
+    _from=None,
+    to=None,
+    interval="1min",
+    days_span=10,
+    is_probe_days=True,
 ):
     """
     
 
     Parameters
     ----------
-    con(connector) : TinkoffAPI connector. Create one using connect() function
+    con(connector) : TinkoffAPI connector. Create one using connect() function.
+        Shared client by default, see get_client().
     figi : str, required
         FIGI identifier of instrument. The default is 'BBG00M0C8YM7'.
     _from : datetime, optional
@@ -146,6 +524,9 @@ def detailed_history(
         frequency of data to retrieve. The default is "1min".
     days_span : int, required
         How much day back to query from now. The default is 10 days.
+    is_probe_days : bool, optional
+        Request daily candles first and skip days without trades.
+        Used for ranges longer than a few request windows. The default is True.
 
     Returns
     -------
@@ -153,57 +534,44 @@ def detailed_history(
         Contains candles data for selected FIGI for given time period.
 
     """
-    start = time.time()
     logger = logging.getLogger(apiname + detailed_history.__name__)
+    if con is None:
+        con = get_client()
 
     logger.info(f"retrieving available data is in progress ...")
     if to == None:
         to = datetime.now()
-        endTime = to
-    else:
-        endTime = to
     if _from == None:
-        _from = endTime - timedelta(days=days_span)
-        startTime = _from
-    else:
-        startTime = _from
-
-    startTime_list = []
-    endTime_list = []
-
-    startTime_list.append(startTime.strftime(timeformat) + gmt_time)
-    endTime_list.append(endTime.strftime(timeformat) + gmt_time)
-
-    if (endTime - startTime).days > 1:
-        startTime_list = []
-        endTime_list = []
-        endTime = to
-        for i in range((to - _from).days):
-            # print(i)
-            newStartTime = endTime - timedelta(days=1)
-            startTime_list.append(newStartTime.strftime(timeformat) + gmt_time)
-            endTime_list.append(endTime.strftime(timeformat) + gmt_time)
-            endTime = newStartTime
+        _from = to - timedelta(days=days_span)
 
+    tasks = plan_requests(
+        con, {figi: (_from, to)}, interval=interval, is_probe_days=is_probe_days
+    )
     list_df = []
-    for i in range(len(startTime_list)):
-        tickers = con.market.market_candles_get_with_http_info(
-            figi=figi, _from=startTime_list[i], to=endTime_list[i], interval="1min"
-        )
-        list_of_tickers = []
-        for item in tickers[0].payload.candles:
-            list_of_tickers.append(item.to_dict())
-        df = pd.DataFrame.from_records(list_of_tickers)
+    for _, window_start, window_end in tasks:
+        df = _fetch_candles(con, figi, window_start, window_end, interval=interval)
         list_df.append(df)
 
-    df_merge = pd.concat(list_df)
-    timer_string = utilities_timers.format_timer_string(time.time() - start)
-    logger.info(timer_string)
+    df_merge = pd.concat(list_df) if list_df else pd.DataFrame(columns=["figi"])
     logger.info(f"Shape of dataframe {df_merge.shape} ...")
     return df_merge
 
 
-def get_detailed_data(con=None, data=None, _from=None, to=None, days_span=10):
+@utilities_timers.timed(apiname)
+def get_detailed_data(
+    con=None,
+    data=None,
+    _from=None,
+    to=None,
+    interval="1min",
+    days_span=10,
+    max_workers=1,
+    limiter=None,
+    since=None,
+    backfill_days=None,
+    is_probe_days=True,
+    missing=None,
+):
     """
     Function that retrieves the data 
 
@@ -215,49 +583,91 @@ def get_detailed_data(con=None, data=None, _from=None, to=None, days_span=10):
         Date (beginning of the period for query). The default is None.
     to : datetime, optional
         Date (end of the period for query). The default is None.
-    interval : str, required
-        frequency of data to retrieve. The default is "1min".@todo, not implemented
+    interval : str, optional
+        frequency of data to retrieve: 1min, 2min, 3min, 5min, 10min, 15min, 30min,
+        hour, day, week, month. The default is "1min".
     days_span : int, required
         How much day back to query from now. The default is 10 days.
+    max_workers : int, optional
+        Number of concurrent download threads. The default is 1 (serial download).
+        Request rate is limited by limiter regardless of number of workers.
+    limiter : rate_limiter.TokenBucket, optional
+        The default is shared limiter of the process, see get_rate_limiter().
+    since : dict, optional
+        Incremental mode. {figi: time of the last stored candle}, e.g. from
+        ClickhouseHelper.get_last_timestamps(). Only candles from that time on are
+        requested; _from is ignored for FIGIs found in the dict.
+        Watermarks must come from the table of the same interval.
+        Timezone-aware times are converted to gmt_time zone, naive ones
+        are taken as they are, in the same time zone as _from and to.
+    backfill_days : int, optional
+        Incremental mode. How much days back to query for FIGIs not found in since
+        (e.g. new listings). The default is days_span.
+    is_probe_days : bool, optional
+        Request daily candles first and skip days without trades, see plan_requests().
+        The default is True.
+    missing : dict, optional
+        {figi: start of the earliest missing range}, e.g. from
+        missing_ranges.MissingRanges.earliest(). Ranges of these FIGIs start
+        not later, so candles lost by failed requests of earlier runs are
+        requested again.
 
     Returns
     -------
-    df_merge : TYPE
-        DESCRIPTION.
+    df_merge : Pandas dataframe
+        Candles with instrument columns. df_merge.attrs["failed"] is the list
+        of failed requests (figi, _from, to), see missing.
 
     """
-    start = time.time()
     logger = logging.getLogger("TinkoffAPI::" + get_detailed_data.__name__)
+    if con is None:
+        con = get_client()
 
     logger.info(f"retrieving available data is in progress ...")
     if to == None:
         to = datetime.now()
-        endTime = to
-    else:
-        endTime = to
     if _from == None:
-        _from = endTime - timedelta(days=days_span)
+        _from = to - timedelta(days=days_span)
+    if backfill_days is None:
+        backfill_days = days_span
 
-    list_df = []
-    for figi in tqdm(data.figi.unique()):
-        logger.info(
-            "retrieving figi: "
-            + figi
-            + " ticker: "
-            + data[data.figi == figi].ticker.values
-        )
+    ranges = request_ranges(
+        data.figi.unique(), _from, to, since, backfill_days, missing=missing
+    )
+    tasks = plan_requests(
+        con,
+        ranges,
+        interval=interval,
+        max_workers=max_workers,
+        limiter=limiter,
+        is_probe_days=is_probe_days,
+    )
+    logger.info(
+        f"{len(tasks)} requests for {data.figi.nunique()} FIGIs using {max_workers} workers"
+    )
 
-        df = detailed_history(
-            con=con, figi=figi, _from=_from, to=to, interval="1min", days_span=days_span
+    list_df = []
+    failed = []
+    for task, df in tqdm(
+        iter_candles(
+            con, tasks, interval=interval, max_workers=max_workers, limiter=limiter
+        ),
+        total=len(tasks),
+    ):
+        if df is None:
+            failed.append(task)
+        elif len(df) > 0:
+            list_df.append(df)
+    if failed:
+        logger.error(
+            f"{len(failed)} of {len(tasks)} requests failed, their data is missing"
         )
-        time.sleep(2)
-        list_df.append(df)
 
     data.reset_index(inplace=True, drop=True)
-    df_merge = pd.concat(list_df)
+    df_merge = pd.concat(list_df) if list_df else pd.DataFrame(columns=["figi"])
     df_merge = pd.merge(left=df_merge, right=data, left_on="figi", right_on="figi")
-    timer_string = utilities_timers.format_timer_string(time.time() - start)
-    logger.info(timer_string)
+    # watermark of the stored result is beyond them, see missing
+    df_merge.attrs["failed"] = failed
     logger.info(f"retrieved dataframe with shape {df_merge.shape} ")
     return df_merge
 
@@ -273,7 +683,7 @@ if __name__ == "__main__":
     # testing the functions.
     # 1. Connection to API:
     
-    testcon, _ = connect(token)
+    testcon, _ = connect()
     logger.info(f"test connect: {testcon}")
     logger.info(
         f"expected answer: <openapi_client.openapi.SandboxOpenApi at 0x15b7294f4c8>"
@@ -283,7 +693,7 @@ if __name__ == "__main__":
     # 2.testing the instrument  querying.
     logger.info(f"test get_instruments function")
     
-    con, _ = connect(token)
+    con, _ = connect()
     df_etf = get_instruments(con=con, instrument="Etf")
     df_stock = get_instruments(con=con, instrument="Stock")
     df_bond = get_instruments(con=con, instrument="Bond")
@@ -291,13 +701,13 @@ if __name__ == "__main__":
     # 3. Testing FIGI querrying
     logger.info(f"test detailed_history function")
     
-    con, _ = connect(token)
+    con, _ = connect()
     df = detailed_history(con, days_span=10)
 
     # 3. Testing etf querrying
     logger.info(f"test get_detailed_data function")
     
-    con, _ = connect(token)
+    con, _ = connect()
     df = get_detailed_data(con=con, data=df_etf, _from=None, to=None, days_span=10)
 
 """
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 18:02:37 2026
+
+@author: SParkhonyuk
+"""
+# Days without trading, used to avoid requests that can only return nothing.
+# Days are UTC dates: Tinkoff trades Moscow Exchange and US instruments, whose
+# sessions are all inside one UTC day, while in local time (see gmt_time of
+# tinkoffAPIHelper) a friday evening session continues after midnight.
+import os
+from datetime import date
+
+import pandas as pd
+
+# days closed on every exchange available through the broker, (month, day)
+recurring_holidays = [(1, 1)]
+_calendar = None
+
+
+##-------------------------------------------------------------------------------------------------
+class TradingCalendar:
+    """
+    Calendar of non-trading days: weekends, recurring holidays and extra dates.
+
+    Parameters
+    ----------
+    holidays : iterable of dates, optional
+        Exchange holidays in addition to recurring_holidays.
+    weekend : tuple of int
+        Weekdays without trading, Monday is 0. The default is Saturday and Sunday.
+    """
+
+    def __init__(self, holidays=None, weekend=(5, 6)):
+        self.holidays = set(pd.to_datetime(list(holidays or [])).date)
+        self.weekend = set(weekend)
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """Calendar with holidays read from file, one date (YYYY-MM-DD) per line."""
+        with open(path) as file:
+            holidays = [line.strip() for line in file if line.strip()]
+        return cls(holidays=holidays, **kwargs)
+
+    def is_trading_day(self, day):
+        """True if there can be trades on day (date, UTC)."""
+        if day.weekday() in self.weekend:
+            return False
+        if (day.month, day.day) in recurring_holidays:
+            return False
+        return day not in self.holidays
+
+    def trading_days(self, first, last):
+        """List of trading days in [first, last]."""
+        days = pd.date_range(first, last, freq="D").date
+        return [day for day in days if self.is_trading_day(day)]
+
+
+##-------------------------------------------------------------------------------------------------
+def get_calendar():
+    """
+    Returns calendar shared by the process. Holidays are read from the file
+    in TRADING_HOLIDAYS_FILE environment variable, if it is set.
+    """
+    global _calendar
+    if _calendar is None:
+        path = os.environ.get("TRADING_HOLIDAYS_FILE")
+        if path:
+            _calendar = TradingCalendar.from_file(path)
+        else:
+            _calendar = TradingCalendar()
+    return _calendar
+
+
+##-------------------------------------------------------------------------------------------------
+if __name__ == "__main__":
+
+    calendar = get_calendar()
+    days = calendar.trading_days(date(2020, 1, 1), date(2020, 1, 31))
+    print(f"{len(days)} trading days in January 2020: {days}")
@@ -1,4 +1,28 @@
+import os
+import time
+import logging
+import threading
+import functools
+from datetime import datetime
+from contextlib import contextmanager
+
 import time_convertor
+import metrics
+
+try:
+    import pyinstrument
+except ImportError:  # optional, cProfile is used instead
+    pyinstrument = None
+
+apiname = "Timers::"
+# histogram of metrics registry keeping per-stage statistics
+stage_metric = "stage_seconds"
+# profiler of the whole run: "cprofile" or "pyinstrument", nothing to run without it
+profiler_env = "PROFILE_RUN"
+# functions printed to the log from cProfile statistics
+profile_top = 30
+
+_local = threading.local()
 
 
 def format_dt_str(dt):
@@ -41,3 +65,192 @@ def format_timer_string(dt=0.0, percent_complete=None, time_format=""):
         )
 
     return timer_string
+
+
+##-------------------------------------------------------------------------------------------------
+class Span:
+    """Timed stage. path is the names of enclosing stages of this thread joined by '/'."""
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.elapsed = None
+
+
+@contextmanager
+def timer(name, logger=None, level=logging.DEBUG):
+    """
+    Times the block as stage name nested in the stages open in this thread.
+    Duration is added to per-stage statistics (see get_stats) and to
+    stage_seconds histogram of metrics registry, so metric sinks get it too.
+
+    Usage:
+        with timer("download"):
+            with timer("parse") as span:
+                ...
+            print(span.elapsed)
+
+    Parameters
+    ----------
+    name : str
+    logger : logging.Logger or str, optional
+        Logger (or its name) to write format_timer_string of duration to.
+    level : int
+        Log level. The default is logging.DEBUG.
+    """
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    stack.append(name)
+    span = Span(name, "/".join(stack))
+    start = time.perf_counter()
+    try:
+        yield span
+    finally:
+        span.elapsed = time.perf_counter() - start
+        stack.pop()
+        metrics.get_registry().observe(stage_metric, span.elapsed, stage=span.path)
+        if logger is not None:
+            if isinstance(logger, str):
+                logger = logging.getLogger(logger)
+            logger.log(level, format_timer_string(span.elapsed))
+
+
+def timed(prefix="", level=logging.INFO):
+    """
+    Decorator timing every call of function as stage prefix + function name,
+    see timer(). Duration is logged by logger of the same name, so
+    @timed(apiname) replaces start = time.time() ... logger.info(timer_string).
+    Used bare (@timed), prefix is empty. level=None not to log.
+    Not for generator functions: only creation of generator would be timed.
+    """
+    if callable(prefix):
+        return timed()(prefix)
+
+    def decorator(func):
+        name = prefix + func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name, logger=None if level is None else name, level=level):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def get_stats():
+    """
+    Per-stage statistics of this process.
+
+    Returns
+    -------
+    dict : {path: {"count", "total", "mean", "max"}}, seconds.
+    """
+    stats = {}
+    for metric in metrics.get_registry().snapshot()["histograms"]:
+        if metric["name"] == stage_metric:
+            stats[metric["labels"]["stage"]] = {
+                "count": metric["count"],
+                "total": metric["sum"],
+                "mean": metric["sum"] / metric["count"],
+                "max": metric["max"],
+            }
+    return stats
+
+
+def format_stats(stats=None):
+    """Lines of stage statistics, nested stages indented under their parents."""
+    if stats is None:
+        stats = get_stats()
+    lines = []
+    for path in sorted(stats):
+        stage = stats[path]
+        depth = path.count("/")
+        lines.append(
+            "  " * depth
+            + f"{path.split('/')[-1]}: {stage['count']} calls, "
+            + f"total {format_dt_str(stage['total'])} s, "
+            + f"mean {format_dt_str(stage['mean'])} s, "
+            + f"max {format_dt_str(stage['max'])} s"
+        )
+    return lines
+
+
+##-------------------------------------------------------------------------------------------------
+class RunProfiler:
+    """
+    Profiler of a whole run, switched on by PROFILE_RUN environment variable:
+    "cprofile" or "pyinstrument" (cProfile if pyinstrument is not installed).
+    Without it start() and stop() do nothing, so it can stay in production scripts.
+
+    cProfile statistics are saved to PROFILE_OUTPUT (profile_<time>.prof by default,
+    open with snakeviz or pstats), top functions by cumulative time are logged.
+    pyinstrument report is saved as html (profile_<time>.html by default).
+
+    Usage:
+        profiler = RunProfiler().start()
+        ...
+        profiler.stop()
+    """
+
+    def __init__(self, mode=None, path=None):
+        self.mode = os.environ.get(profiler_env, "") if mode is None else mode
+        self.mode = self.mode.lower()
+        self.path = os.environ.get("PROFILE_OUTPUT") if path is None else path
+        self._profiler = None
+
+    def start(self):
+        logger = logging.getLogger(apiname + "RunProfiler")
+        if self.mode in ("", "0", "off"):
+            return self
+        stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        if self.mode == "pyinstrument" and pyinstrument is None:
+            logger.warning("pyinstrument is not installed, cProfile is used")
+            self.mode = "cprofile"
+        if self.mode == "pyinstrument":
+            self.path = self.path or f"profile_{stamp}.html"
+            self._profiler = pyinstrument.Profiler()
+        elif self.mode == "cprofile":
+            import cProfile
+
+            self.path = self.path or f"profile_{stamp}.prof"
+            self._profiler = cProfile.Profile()
+        else:
+            logger.warning(f"unknown {profiler_env}={self.mode}, profiling is off")
+            return self
+        logger.info(f"profiling with {self.mode} to {self.path}")
+        if self.mode == "pyinstrument":
+            self._profiler.start()
+        else:
+            self._profiler.enable()
+        return self
+
+    def stop(self):
+        logger = logging.getLogger(apiname + "RunProfiler")
+        if self._profiler is None:
+            return
+        if self.mode == "pyinstrument":
+            self._profiler.stop()
+            with open(self.path, "w", encoding="utf-8") as file:
+                file.write(self._profiler.output_html())
+        else:
+            self._profiler.disable()
+            import io
+            import pstats
+
+            self._profiler.dump_stats(self.path)
+            stream = io.StringIO()
+            pstats.Stats(self._profiler, stream=stream).sort_stats(
+                "cumulative"
+            ).print_stats(profile_top)
+            logger.info(stream.getvalue())
+        self._profiler = None
+        logger.info(f"profile saved to {self.path}")
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()